@@ -0,0 +1,148 @@
+# src/antiflood.py
+"""
+Per-user anti-flood limiter.
+
+`guard` runs as a TypeHandler in group -90, right after latency tracking and ahead of
+every real handler. Each update is classified once:
+  - "command"  — /start, /menu and other commands;
+  - "callback" — inline button presses;
+  - "flow:<name>" — text or photo sent while the user is inside a paid flow
+    (user_data["flow"]: natal, palm, num, feedback), so the answers of a multi-step
+    flow spend that flow's budget only and are never counted twice;
+  - "text" / "photo" — everything else.
+Payments (pre-checkout, successful_payment) and the admin are never limited.
+
+Budgets come from FLOOD_LIMITS ("class=count/seconds,…"; "flow" is the default for
+flows without their own entry). A sliding-window log per user and class counts accepted
+updates; an update over budget stops further handler groups (ApplicationHandlerStop),
+so it costs neither DB writes nor LLM calls. The user is told once per window; a
+callback is always answered so the button does not spin.
+
+Memory is bounded: users live in an LRU of FLOOD_MAX_USERS entries, the least recently
+active are evicted first.
+"""
+import logging
+import time
+from collections import OrderedDict, deque
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from .config import ADMIN_ID, FLOOD_LIMITS, FLOOD_MAX_USERS
+
+log = logging.getLogger("astro-num-bot.antiflood")
+
+
+def parse_limits(spec: str) -> dict[str, tuple[int, float]]:
+    limits = {}
+    for part in spec.split(","):
+        name, _, budget = part.strip().partition("=")
+        count, _, window = budget.partition("/")
+        try:
+            limits[name.strip()] = (int(count), float(window))
+        except ValueError:
+            log.warning("Bad FLOOD_LIMITS entry: %r", part)
+    return limits
+
+
+class FloodLimiter:
+    def __init__(self, limits: dict[str, tuple[int, float]], max_users: int = FLOOD_MAX_USERS):
+        self.limits = limits
+        self.max_users = max_users
+        # user_id -> {"hits": {class: deque[timestamps]}, "notice_until": float}
+        self._users: OrderedDict[int, dict] = OrderedDict()
+        self.blocked: dict[str, int] = {}
+        self.evicted = 0
+
+    def budget(self, cls: str) -> tuple[int, float] | None:
+        if cls in self.limits:
+            return self.limits[cls]
+        if cls.startswith("flow:"):
+            return self.limits.get("flow")
+        return None
+
+    def _user(self, user_id: int) -> dict:
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = {"hits": {}, "notice_until": 0.0}
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    def hit(self, user_id: int, cls: str, now: float | None = None) -> float | None:
+        """Count an update; returns None if allowed, else seconds until the budget frees up."""
+        budget = self.budget(cls)
+        if not budget:
+            return None
+        count, window = budget
+        now = time.monotonic() if now is None else now
+        hits = self._user(user_id)["hits"].setdefault(cls, deque())
+        while hits and hits[0] <= now - window:
+            hits.popleft()
+        if len(hits) >= count:
+            self.blocked[cls] = self.blocked.get(cls, 0) + 1
+            return hits[0] + window - now
+        hits.append(now)
+        return None
+
+    def should_notice(self, user_id: int, retry_in: float, now: float | None = None) -> bool:
+        """True once per blocked stretch: the user hears about the limit, not about every message."""
+        now = time.monotonic() if now is None else now
+        state = self._user(user_id)
+        if now < state["notice_until"]:
+            return False
+        state["notice_until"] = now + retry_in
+        return True
+
+    def report(self) -> str:
+        blocked = ", ".join(f"{k}: {v}" for k, v in sorted(self.blocked.items())) or "нет"
+        return (f"Антифлуд: пользователей в памяти {len(self._users)}/{self.max_users}, "
+                f"вытеснено {self.evicted}; отклонено — {blocked}")
+
+
+LIMITER = FloodLimiter(parse_limits(FLOOD_LIMITS))
+
+
+def classify(update: Update, user_data: dict | None) -> str | None:
+    if update.pre_checkout_query:
+        return None
+    if update.callback_query:
+        return "callback"
+    msg = update.message
+    if msg is None or msg.successful_payment:
+        return None
+    text = msg.text or ""
+    if text.startswith("/"):
+        return "command"
+    flow = (user_data or {}).get("flow")
+    if flow and (msg.text or msg.photo):
+        return f"flow:{flow}"
+    return "photo" if msg.photo else "text"
+
+
+async def guard(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Group -90 TypeHandler: drops updates over the user's budget."""
+    if not isinstance(update, Update) or not update.effective_user:
+        return
+    user_id = update.effective_user.id
+    if str(user_id) == str(ADMIN_ID):
+        return
+    cls = classify(update, context.user_data)
+    if cls is None:
+        return
+    retry_in = LIMITER.hit(user_id, cls)
+    if retry_in is None:
+        return
+    wait = max(1, int(retry_in + 0.999))
+    notice = f"Слишком много запросов подряд. Попробуй снова через {wait} с."
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(notice)
+        elif LIMITER.should_notice(user_id, retry_in):
+            await update.message.reply_text(notice)
+    except Exception as e:
+        log.debug("Flood notice for %s failed: %s", user_id, e)
+    raise ApplicationHandlerStop
@@ -0,0 +1,96 @@
+# src/api_budget.py
+"""
+Bot API call accounting per handler.
+
+`InstrumentedBot` is the ExtBot used by the Application: every outbound Bot API call
+(except getUpdates long polls) is timed and attributed to the handler currently running,
+which `instrument(app)` records in a context variable by wrapping every registered
+handler callback. Background tasks started from a handler inherit its name; everything
+else is accounted as "background". Per handler the report shows how many updates it
+served, calls per update (avg/max) and per-endpoint call counts and latency, which makes
+redundant calls (e.g. set_my_commands on every /start) visible in /api_stats.
+"""
+import contextvars
+import functools
+import time
+from collections import defaultdict
+
+from telegram.ext import Application, ExtBot
+
+_handler: contextvars.ContextVar[str] = contextvars.ContextVar("api_handler", default="background")
+# счётчик вызовов в рамках одного апдейта (список, чтобы его можно было менять по ссылке)
+_update_calls: contextvars.ContextVar[list | None] = contextvars.ContextVar("api_update_calls", default=None)
+
+# handler -> endpoint -> {"calls", "errors", "total_ms", "max_ms"}
+_endpoints: dict[str, dict[str, dict]] = defaultdict(lambda: defaultdict(lambda: {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}))
+# handler -> {"updates", "calls", "max_calls"}
+_updates: dict[str, dict] = defaultdict(lambda: {"updates": 0, "calls": 0, "max_calls": 0})
+
+
+class InstrumentedBot(ExtBot):
+    async def _do_post(self, endpoint, data, *args, **kwargs):
+        if endpoint == "getUpdates":
+            return await super()._do_post(endpoint, data, *args, **kwargs)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            result = await super()._do_post(endpoint, data, *args, **kwargs)
+            ok = True
+            return result
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            st = _endpoints[_handler.get()][endpoint]
+            st["calls"] += 1
+            st["errors"] += 0 if ok else 1
+            st["total_ms"] += ms
+            st["max_ms"] = max(st["max_ms"], ms)
+            counter = _update_calls.get()
+            if counter is not None:
+                counter[0] += 1
+
+
+def _wrap(callback, name: str):
+    @functools.wraps(callback)
+    async def wrapped(update, context):
+        h_token = _handler.set(name)
+        counter = [0]
+        c_token = _update_calls.set(counter)
+        try:
+            return await callback(update, context)
+        finally:
+            _update_calls.reset(c_token)
+            _handler.reset(h_token)
+            st = _updates[name]
+            st["updates"] += 1
+            st["calls"] += counter[0]
+            st["max_calls"] = max(st["max_calls"], counter[0])
+    return wrapped
+
+
+def instrument(app: Application):
+    """Wrap every registered handler callback (call after all add_handler calls)."""
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            cb = handler.callback
+            if not getattr(cb, "_api_instrumented", False):
+                handler.callback = _wrap(cb, getattr(cb, "__name__", type(handler).__name__))
+                handler.callback._api_instrumented = True
+
+
+def report(top: int = 15) -> str:
+    if not _endpoints:
+        return "Вызовов Bot API пока не было."
+    lines = ["Bot API по хендлерам (вызовов на апдейт: сред/макс):"]
+    rows = sorted(_endpoints.items(), key=lambda kv: -sum(e["calls"] for e in kv[1].values()))
+    for name, endpoints in rows[:top]:
+        total = sum(e["calls"] for e in endpoints.values())
+        upd = _updates.get(name)
+        per_update = ""
+        if upd and upd["updates"]:
+            per_update = f", на апдейт {upd['calls'] / upd['updates']:.1f}/{upd['max_calls']} ({upd['updates']} апд.)"
+        lines.append(f"• {name}: {total} вызовов{per_update}")
+        for ep, st in sorted(endpoints.items(), key=lambda kv: -kv[1]["calls"]):
+            avg = st["total_ms"] / st["calls"] if st["calls"] else 0.0
+            err = f", ошибок {st['errors']}" if st["errors"] else ""
+            lines.append(f"   {ep}: {st['calls']} × {avg:.0f} ms (макс {st['max_ms']:.0f}){err}")
+    return "\n".join(lines)
@@ -0,0 +1,228 @@
+# src/batch.py
+"""
+Offline batch generation for low-priority reports (re-deliveries, admin regenerations,
+a future "deferred, cheaper" tier).
+
+Prompts built by the regular numerology/natal builders are collected into a JSONL file
+in the provider batch format, submitted through a pluggable BatchClient and polled in
+the background. Finished results are handed back to the bot (`on_result`) which stores
+them in the order and delivers the report. Submitted batches are persisted in SQLite,
+so polling resumes after a restart. The poller is started from post_init (`start`) and
+stopped from post_shutdown (`stop`) between polls, so a batch is never left half-delivered.
+
+OpenAIBatchClient talks to OPENAI_BASE_URL, so it works against src.mock_llm too.
+"""
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Protocol
+
+import requests
+
+from .config import OPENAI_API_KEY, OPENAI_BASE_URL, LLM_BATCH_MODEL, LLM_BATCH_POLL_S
+from .storage import _conn
+
+log = logging.getLogger("astro-num-bot.batch")
+
+# Терминальные статусы батча у провайдера
+DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+_task: asyncio.Task | None = None
+_stop: asyncio.Event | None = None
+# сколько ждём идущий опрос, прежде чем отменить задачу
+_STOP_GRACE_S = 30.0
+
+
+def init_batch_db():
+    con = _conn(); cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS llm_batches(
+        id                INTEGER PRIMARY KEY AUTOINCREMENT,
+        provider          TEXT,
+        provider_batch_id TEXT,
+        status            TEXT,
+        items_json        TEXT,
+        created_at        TEXT,
+        updated_at        TEXT
+    )""")
+    con.commit(); con.close()
+
+
+class BatchClient(Protocol):
+    provider: str
+
+    def submit(self, jsonl: bytes) -> str: ...
+    def status(self, batch_id: str) -> dict: ...
+    def results(self, batch: dict) -> list[dict]: ...
+
+
+class OpenAIBatchClient:
+    """OpenAI Batch API: upload JSONL (purpose=batch) -> create batch -> poll -> download output file."""
+    provider = "openai"
+
+    def __init__(self, base_url: str = OPENAI_BASE_URL, api_key: str = OPENAI_API_KEY, timeout: int = 60):
+        self.base_url = base_url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.timeout = timeout
+
+    def submit(self, jsonl: bytes) -> str:
+        up = requests.post(
+            f"{self.base_url}/files", headers=self.headers, timeout=self.timeout,
+            files={"file": ("batch.jsonl", jsonl, "application/jsonl")}, data={"purpose": "batch"},
+        )
+        up.raise_for_status()
+        resp = requests.post(
+            f"{self.base_url}/batches", headers=self.headers, timeout=self.timeout,
+            json={"input_file_id": up.json()["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"},
+        )
+        resp.raise_for_status()
+        return resp.json()["id"]
+
+    def status(self, batch_id: str) -> dict:
+        resp = requests.get(f"{self.base_url}/batches/{batch_id}", headers=self.headers, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+    def results(self, batch: dict) -> list[dict]:
+        file_id = batch.get("output_file_id")
+        if not file_id:
+            return []
+        resp = requests.get(f"{self.base_url}/files/{file_id}/content", headers=self.headers, timeout=self.timeout)
+        resp.raise_for_status()
+        return [json.loads(line) for line in resp.text.splitlines() if line.strip()]
+
+
+def build_batch_line(custom_id: str, messages: list, *, model: str = LLM_BATCH_MODEL,
+                     temperature: float = 0.6, top_p: float = 0.9, max_tokens: int = 1400) -> dict:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "temperature": temperature,
+            "top_p": top_p,
+            "max_tokens": max_tokens,
+            "messages": messages,
+            "response_format": {"type": "json_object"},
+        },
+    }
+
+
+def _custom_id(item: dict) -> str:
+    return f"order-{item['order_id']}-{item['kind']}"
+
+
+async def submit_batch(client: BatchClient, items: list[dict]) -> int:
+    """items: [{"order_id", "kind", "chat_id", "messages"}]. Returns local batch row id."""
+    jsonl = "\n".join(
+        json.dumps(build_batch_line(_custom_id(it), it["messages"]), ensure_ascii=False) for it in items
+    ).encode("utf-8")
+    provider_batch_id = await asyncio.to_thread(client.submit, jsonl)
+    now = datetime.utcnow().isoformat()
+    stored = [{k: it[k] for k in ("order_id", "kind", "chat_id", "prompt_key") if k in it} for it in items]
+    con = _conn(); cur = con.cursor()
+    cur.execute("""INSERT INTO llm_batches(provider, provider_batch_id, status, items_json, created_at, updated_at)
+                   VALUES(?,?,?,?,?,?)""",
+                (client.provider, provider_batch_id, "submitted", json.dumps(stored, ensure_ascii=False), now, now))
+    bid = cur.lastrowid
+    con.commit(); con.close()
+    log.info("batch #%s submitted: %s (%d items)", bid, provider_batch_id, len(items))
+    return bid
+
+
+def _pending_batches(provider: str) -> list[tuple]:
+    con = _conn(); cur = con.cursor()
+    cur.execute("SELECT id, provider_batch_id, items_json FROM llm_batches WHERE provider=? AND status NOT IN ('done', 'failed')",
+                (provider,))
+    rows = cur.fetchall()
+    con.close()
+    return rows
+
+
+def _set_status(bid: int, status: str):
+    con = _conn(); cur = con.cursor()
+    cur.execute("UPDATE llm_batches SET status=?, updated_at=? WHERE id=?", (status, datetime.utcnow().isoformat(), bid))
+    con.commit(); con.close()
+
+
+OnResult = Callable[[dict, str | None, dict | None], Awaitable[None]]
+
+
+async def poll_once(client: BatchClient, on_result: OnResult) -> int:
+    """Check every unfinished batch; fan out results of finished ones. Returns number of finished batches."""
+    finished = 0
+    for bid, provider_batch_id, items_json in await asyncio.to_thread(_pending_batches, client.provider):
+        try:
+            info = await asyncio.to_thread(client.status, provider_batch_id)
+        except Exception as e:
+            log.warning("batch #%s status failed: %s", bid, e)
+            continue
+        status = info.get("status", "")
+        if status not in DONE_STATUSES:
+            continue
+        items = {_custom_id(it): it for it in json.loads(items_json or "[]")}
+        results = await asyncio.to_thread(client.results, info) if status == "completed" else []
+        for line in results:
+            item = items.pop(line.get("custom_id"), None)
+            if not item:
+                continue
+            body = ((line.get("response") or {}).get("body")) or {}
+            content = ((body.get("choices") or [{}])[0].get("message") or {}).get("content")
+            try:
+                await on_result(item, content, body)
+            except Exception as e:
+                log.exception("batch #%s result for order %s failed: %s", bid, item.get("order_id"), e)
+        # Всё, что не вернулось (ошибка/просрочка), тоже отдаём — с пустым контентом
+        for item in items.values():
+            try:
+                await on_result(item, None, None)
+            except Exception as e:
+                log.exception("batch #%s missing result for order %s: %s", bid, item.get("order_id"), e)
+        await asyncio.to_thread(_set_status, bid, "done" if status == "completed" else "failed")
+        log.info("batch #%s finished with provider status %s", bid, status)
+        finished += 1
+    return finished
+
+
+async def poll_forever(client: BatchClient, on_result: OnResult, interval_s: float = LLM_BATCH_POLL_S,
+                       stop: asyncio.Event | None = None):
+    stop = stop or asyncio.Event()
+    while not stop.is_set():
+        try:
+            await poll_once(client, on_result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("batch poll failed: %s", e)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval_s)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start(client: BatchClient, on_result: OnResult) -> asyncio.Task:
+    global _task, _stop
+    if _task is None or _task.done():
+        _stop = asyncio.Event()
+        _task = asyncio.get_running_loop().create_task(poll_forever(client, on_result, stop=_stop))
+    return _task
+
+
+async def stop():
+    """Let the current poll finish, then end the poller (cancel it after _STOP_GRACE_S)."""
+    global _task
+    if _task is None:
+        return
+    _stop.set()
+    try:
+        await asyncio.wait_for(asyncio.shield(_task), timeout=_STOP_GRACE_S)
+    except asyncio.TimeoutError:
+        log.warning("Batch poller did not finish in %ss, cancelling", _STOP_GRACE_S)
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+    _task = None
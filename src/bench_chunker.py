@@ -0,0 +1,128 @@
+# src/bench_chunker.py
+"""
+Benchmark: messages per report, old newline splitter vs. src.tg_html.
+
+Reports come from the mock generators in src.mock_llm (seeded; --scale repeats every
+paragraph to emulate long LLM answers) and, with --db, from real reports stored in the
+orders table. Each report is rendered with the bot's own renderers and split both ways.
+
+    python -m src.bench_chunker --n 200 --scale 3
+    python -m src.bench_chunker --db data.sqlite3
+"""
+import argparse
+import json
+import random
+import re
+import sqlite3
+import statistics
+import time
+from html import unescape
+
+from . import mock_llm, tg_html
+from .bot import _render_natal_report_html, _render_palm_report_html, _render_report_html
+
+_RENDERERS = {
+    "llm_report": _render_report_html,
+    "natal_llm_report": _render_natal_report_html,
+    "palm_llm_report": _render_palm_report_html,
+}
+
+
+def _legacy_split(html: str, limit: int = 3500) -> list[str]:
+    """The previous splitter: newline boundaries only, len() instead of UTF-16, no tag handling."""
+    html = html.strip()
+    if len(html) <= limit:
+        return [html]
+    parts, buf, cur = [], [], 0
+    for line in html.split("\n"):
+        add_len = len(line) + (1 if buf else 0)
+        if cur + add_len > limit:
+            parts.append("\n".join(buf))
+            buf, cur = [line], len(line)
+        else:
+            buf.append(line)
+            cur += add_len
+    if buf:
+        parts.append("\n".join(buf))
+    return parts
+
+
+def _scaled(value, scale: int):
+    if isinstance(value, str):
+        return " ".join([value] * scale)
+    if isinstance(value, list):
+        return [_scaled(v, scale) for v in value]
+    if isinstance(value, dict):
+        return {k: _scaled(v, scale) for k, v in value.items()}
+    return value
+
+
+def _mock_reports(n: int, scale: int, seed: int) -> list[tuple[str, dict]]:
+    rng = random.Random(seed)
+    makers = [("llm_report", mock_llm._numerology_report), ("natal_llm_report", mock_llm._natal_report),
+              ("palm_llm_report", mock_llm._palm_report)]
+    out = []
+    for i in range(n):
+        kind, make = makers[i % len(makers)]
+        out.append((kind, _scaled(make(rng), scale)))
+    return out
+
+
+def _db_reports(path: str) -> list[tuple[str, dict]]:
+    con = sqlite3.connect(path)
+    rows = con.execute("SELECT meta_json FROM orders WHERE meta_json IS NOT NULL").fetchall()
+    con.close()
+    out = []
+    for (raw,) in rows:
+        meta = json.loads(raw or "{}")
+        for kind in _RENDERERS:
+            if isinstance(meta.get(kind), dict):
+                out.append((kind, meta[kind]))
+    return out
+
+
+def _broken(chunks: list[str]) -> int:
+    """Chunks that Telegram would reject: over 4096 UTF-16 units or with unbalanced tags."""
+    bad = 0
+    for c in chunks:
+        visible = tg_html.utf16_len(unescape(re.sub(r"<[^>]*>", "", c)))
+        opened = len(re.findall(r"<[a-zA-Z][^>]*>", c))
+        closed = len(re.findall(r"</[^>]+>", c))
+        bad += visible > tg_html.TELEGRAM_LIMIT or opened != closed
+    return bad
+
+
+def run(reports: list[tuple[str, dict]]):
+    rows = {}
+    for name, split in (("legacy", _legacy_split), ("tg_html", tg_html.split_html)):
+        counts, times, broken = [], [], 0
+        for kind, report in reports:
+            html = _RENDERERS[kind](report)
+            t0 = time.perf_counter()
+            chunks = split(html)
+            times.append((time.perf_counter() - t0) * 1000)
+            counts.append(len(chunks))
+            broken += _broken(chunks)
+        rows[name] = (counts, times, broken)
+    print(f"{len(reports)} reports")
+    print(f"{'splitter':>8} {'msgs_total':>10} {'msgs_avg':>8} {'msgs_max':>8} {'split_ms_avg':>12} {'broken':>6}")
+    for name, (counts, times, broken) in rows.items():
+        print(f"{name:>8} {sum(counts):>10} {statistics.mean(counts):>8.2f} {max(counts):>8} "
+              f"{statistics.mean(times):>12.3f} {broken:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Messages per report: legacy splitter vs tg_html")
+    parser.add_argument("--n", type=int, default=150, help="mock reports to generate")
+    parser.add_argument("--scale", type=int, default=3, help="repeat every text field N times")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="also use reports stored in this SQLite database")
+    args = parser.parse_args()
+    reports = _mock_reports(args.n, args.scale, args.seed)
+    if args.db:
+        reports += _db_reports(args.db)
+    run(reports)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# src/bench_vision.py
+"""
+Benchmark: end-to-end palm vision latency vs. image size.
+
+For every image in --images and every --sizes value the photo is preprocessed
+(src.palm_image) and sent through the bot's own `_mistral_vision_analyze_palm`, so the
+usual transport applies: cassette record/replay, retries and MISTRAL_BASE_URL.
+
+Typical use:
+    # 1) один раз записать реальные ответы
+    LLM_CASSETTE_MODE=record MISTRAL_API_KEY=... python -m src.bench_vision --images fixtures/palms
+    # 2) дальше — воспроизводимо, без сети, с исходными задержками
+    LLM_CASSETTE_MODE=replay MISTRAL_API_KEY=x python -m src.bench_vision --images fixtures/palms
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from . import cassette, palm_image, prompts
+from .bot import _mistral_vision_analyze_palm
+from .config import MISTRAL_VISION_MODEL
+
+
+def _pct(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def run(images_dir: str, sizes: list[int], repeat: int):
+    paths = sorted(
+        os.path.join(images_dir, n) for n in os.listdir(images_dir)
+        if n.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))
+    )
+    if not paths:
+        raise SystemExit(f"No images in {images_dir}")
+    static_prompt = prompts.render("palm.vision")
+    user_text = prompts.render("palm.vision.user", full_name="", dominant_hand="", user_context="")
+
+    print(f"{'max_side':>8} {'bytes_avg':>10} {'prep_ms':>8} {'p50_ms':>8} {'p95_ms':>8} {'prompt_tok':>10} {'errors':>6}")
+    for size in sizes:
+        prep_ms, lat_ms, sizes_b, tokens, errors = [], [], [], [], 0
+        for _ in range(repeat):
+            cassette.reset_replay_positions()
+            for path in paths:
+                with open(path, "rb") as f:
+                    data = f.read()
+                t0 = time.perf_counter()
+                uri, info = await palm_image.prepare_for_vision(data, max_side=size)
+                t1 = time.perf_counter()
+                try:
+                    raw = await _mistral_vision_analyze_palm(static_prompt, uri, model=MISTRAL_VISION_MODEL, user_text=user_text)
+                except Exception as e:
+                    errors += 1
+                    print(f"  {os.path.basename(path)} @ {size}: {e}")
+                    continue
+                t2 = time.perf_counter()
+                prep_ms.append((t1 - t0) * 1000)
+                lat_ms.append((t2 - t0) * 1000)
+                sizes_b.append(info.get("bytes", 0))
+                tokens.append(((raw or {}).get("usage") or {}).get("prompt_tokens", 0))
+        print(
+            f"{size:>8} {int(statistics.mean(sizes_b or [0])):>10} {statistics.mean(prep_ms or [0]):>8.1f} "
+            f"{_pct(lat_ms, 0.5):>8.0f} {_pct(lat_ms, 0.95):>8.0f} {int(statistics.mean(tokens or [0])):>10} {errors:>6}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Palm vision latency vs. image size")
+    parser.add_argument("--images", required=True, help="directory with palm photos")
+    parser.add_argument("--sizes", default="512,768,1024,1536", help="comma-separated max sides")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(run(args.images, [int(x) for x in args.sizes.split(",") if x.strip()], args.repeat))
+
+
+if __name__ == "__main__":
+    main()
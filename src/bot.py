@@ -1,27 +1,6 @@
 
-def _get_telegram_file_url(file_id: str) -> str | None:
-    """Resolve Telegram file_id to a public file URL that Mistral can fetch directly."""
-    try:
-        # Resolve file_path
-        info = requests.get(
-            f"https://api.telegram.org/bot{BOT_TOKEN}/getFile",
-            params={"file_id": file_id},
-            timeout=20,
-        )
-        if info.status_code // 100 != 2:
-            log.warning("getFile failed: %s %s", info.status_code, info.text)
-            return None
-        file_path = info.json().get("result", {}).get("file_path")
-        if not file_path:
-            return None
-        # Return direct file URL (small payload; avoids giant base64 data URI)
-        return f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-    except Exception as e:
-        log.warning("_get_telegram_file_url error: %s", e)
-        return None
-
-async def _mistral_vision_analyze_palm(prompt_text: str, image_url: str, model: str = "pixtral-12b") -> dict:
-    url = "https://api.mistral.ai/v1/chat/completions"
+async def _mistral_vision_analyze_palm(prompt_text: str, image_url: str, model: str = "pixtral-12b", user_text: str | None = None) -> dict:
+    url = f"{MISTRAL_BASE_URL}/chat/completions"
     headers = {
         "Authorization": f"Bearer {MISTRAL_API_KEY}",
         "Content-Type": "application/json",
@@ -33,16 +12,17 @@ async def _mistral_vision_analyze_palm(prompt_text: str, image_url: str, model:
         "max_tokens": 720,
         "messages": [{
             "role": "user",
+            # Статическая инструкция первой, затем персональные данные и само фото
             "content": [
                 {"type": "text", "text": prompt_text},
+                *([{"type": "text", "text": user_text}] if user_text else []),
                 {"type": "image_url", "image_url": image_url}
             ],
         }],
         "response_format": {"type": "json_object"},
     }
-    def _post():
-        return requests.post(url, headers=headers, data=json.dumps(payload), timeout=60)
-    resp = await asyncio.to_thread(_post)
+    with retry.deadline(LLM_REQUEST_DEADLINE_S):
+        resp = await _provider_post("mistral_vision", url, headers=headers, payload=payload)
     if resp.status_code // 100 == 2:
         return resp.json()
     raise RuntimeError(f"Mistral vision error {resp.status_code}: {resp.text}")
@@ -50,18 +30,27 @@ import logging
 import re
 from datetime import datetime
 import os, json, sqlite3
+import hashlib
 import asyncio
+import time
 import requests
 from html import escape
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice, BotCommand, BotCommandScopeAllPrivateChats
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
-    ContextTypes, PreCheckoutQueryHandler, MessageHandler, filters
+    ContextTypes, PreCheckoutQueryHandler, MessageHandler, TypeHandler, filters
 )
+from telegram.request import HTTPXRequest
+from . import antiflood, api_budget, batch, broadcast, cassette, dedup, outbox, palm_cache, palm_image, palm_quality, progress, prompts, retry, tg_html, tracing, webhook
+from .tg_files import FILE_CACHE
+from .update_processor import PerUserUpdateProcessor
 from .config import (
     BOT_TOKEN, TEST_MODE, ADMIN_ID,
     OPENAI_API_KEY, GEMINI_API_KEY, MISTRAL_API_KEY,
     PALM_VISION, VISION_PROVIDER, MISTRAL_VISION_MODEL,
+    OPENAI_BASE_URL, MISTRAL_BASE_URL, GEMINI_BASE_URL, TG_BASE_URL, TG_BASE_FILE_URL,
+    LLM_REQUEST_DEADLINE_S, PALM_QUALITY_GATE,
+    PALM_PREFETCH, PALM_PREFETCH_VISION, PALM_PREFETCH_TTL_S, BOT_MODE,
 )
 
 logging.basicConfig(
@@ -116,6 +105,13 @@ def init_db():
     )
     """
   )
+  # /my_reports: заказы пользователя по дате
+  cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)")
+  # Один платёж — один заказ (повторный successful_payment не создаёт второй)
+  try:
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_charge ON orders(charge_id) WHERE charge_id IS NOT NULL")
+  except sqlite3.IntegrityError:
+    log.warning("orders.charge_id has duplicates; unique index not created")
   # Метаданные приложения (например, точка сброса статистики)
   cur.execute("""
     CREATE TABLE IF NOT EXISTS app_meta(
@@ -124,6 +120,12 @@ def init_db():
     )
   """)
   con.commit(); con.close()
+  batch.init_batch_db()
+  broadcast.init_broadcast_db()
+  outbox.init_outbox_db()
+  palm_cache.init_palm_cache_db()
+  dedup.init_dedup_db()
+  tracing.init_tracing_db()
 
 
 # --- App meta helpers ---
@@ -149,8 +151,9 @@ def upsert_profile(user_id: int, full_name: str = "", username: str = "", lang:
   cur.execute("SELECT user_id FROM profiles WHERE user_id=?", (user_id,))
   row = cur.fetchone()
   if row:
+    # пользователь снова пишет боту — значит, он его не блокирует
     cur.execute("""UPDATE profiles
-                   SET full_name=?, username=?, lang=?, last_seen=?
+                   SET full_name=?, username=?, lang=?, last_seen=?, blocked_at=NULL
                    WHERE user_id=?""",
                 (full_name, username, lang, now, user_id))
   else:
@@ -162,11 +165,15 @@ def upsert_profile(user_id: int, full_name: str = "", username: str = "", lang:
 def create_order(user_id: int, payload: str, amount_stars: int, status: str = "awaiting_input", charge_id: str | None = None, meta: dict | None = None) -> int:
   now = datetime.utcnow().isoformat()
   con = _conn(); cur = con.cursor()
-  cur.execute("""INSERT INTO orders(user_id, payload, amount_stars, status, charge_id, meta_json, created_at, updated_at)
-                 VALUES(?,?,?,?,?,?,?,?)""",
-              (user_id, payload, amount_stars, status, charge_id, json.dumps(meta or {}, ensure_ascii=False), now, now))
-  oid = cur.lastrowid
-  con.commit(); con.close()
+  try:
+    # повтор charge_id упадёт на уникальном индексе — соединение всё равно закрываем
+    cur.execute("""INSERT INTO orders(user_id, payload, amount_stars, status, charge_id, meta_json, created_at, updated_at)
+                   VALUES(?,?,?,?,?,?,?,?)""",
+                (user_id, payload, amount_stars, status, charge_id, json.dumps(meta or {}, ensure_ascii=False), now, now))
+    oid = cur.lastrowid
+    con.commit()
+  finally:
+    con.close()
   return oid
 
 def update_order(order_id: int, *, status: str | None = None, meta_merge: dict | None = None, charge_id: str | None = None):
@@ -216,10 +223,60 @@ def fetch_last_orders(limit: int = 5):
     con.close()
     return rows
 
+# --- Helper to fetch a single order ---
+def fetch_order(order_id: int) -> dict | None:
+    con = _conn(); cur = con.cursor()
+    cur.execute("SELECT id, user_id, payload, status, meta_json FROM orders WHERE id=?", (order_id,))
+    row = cur.fetchone()
+    con.close()
+    if not row:
+        return None
+    return {
+        "id": row[0], "user_id": row[1], "payload": row[2], "status": row[3],
+        "meta": json.loads(row[4]) if row[4] else {},
+    }
+
+# --- Helper to find the order created for a payment ---
+def fetch_order_by_charge(charge_id: str) -> int | None:
+    con = _conn(); cur = con.cursor()
+    cur.execute("SELECT id FROM orders WHERE charge_id=?", (charge_id,))
+    row = cur.fetchone()
+    con.close()
+    return row[0] if row else None
+
+# --- Helper to fetch a user's finished reports (/my_reports) ---
+# ключ отчёта в meta -> название услуги
+REPORT_TITLES = {
+    "llm_report": "🔢 Нумерология",
+    "natal_llm_report": "🌌 Натальная карта",
+    "palm_llm_report": "🪬 Хиромантия",
+}
+
+def fetch_user_reports(user_id: int, limit: int = 5, offset: int = 0) -> tuple[list[dict], int]:
+    """Done orders of the user that have a stored report, newest first; returns (page, total)."""
+    has_report = " OR ".join(f"json_extract(meta_json, '$.{k}') IS NOT NULL" for k in REPORT_TITLES)
+    where = f"WHERE user_id=? AND status='done' AND ({has_report})"
+    con = _conn(); cur = con.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM orders {where}", (user_id,))
+    total = cur.fetchone()[0]
+    cur.execute(
+        f"""SELECT id, created_at, meta_json FROM orders {where}
+            ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?""",
+        (user_id, limit, offset),
+    )
+    rows = cur.fetchall()
+    con.close()
+    page = []
+    for oid, created_at, raw in rows:
+        meta = json.loads(raw) if raw else {}
+        kind = next((k for k in REPORT_TITLES if meta.get(k)), None)
+        page.append({"id": oid, "created_at": created_at, "kind": kind})
+    return page, total
+
 # --- Helper to fetch all user_ids from profiles ---
 def fetch_all_user_ids() -> list[int]:
     con = _conn(); cur = con.cursor()
-    cur.execute("SELECT user_id FROM profiles ORDER BY user_id ASC")
+    cur.execute("SELECT user_id FROM profiles WHERE blocked_at IS NULL ORDER BY user_id ASC")
     rows = cur.fetchall()
     con.close()
     return [r[0] for r in rows if r and r[0]]
@@ -304,137 +361,105 @@ AMOUNT_BY_PAYLOAD = {
     "NATAL_500": PRICE_NATAL,
 }
 
-# --- LLM: Prompt builders for detailed numerology report ---
-SYSTEM_PROMPT = (
-    "Вы — команда AstroMagic: практикующие астрологи и нумерологи. "
-    "Готовьте развёрнутый, художественно-эзотерический, но структурированный отчёт на русском, "
-    "используя ТОЛЬКО переданные данные. Проверяйте согласованность и мягко отмечайте расхождения. "
-    "Без фатализма и без медицинских/финансовых советов."
-)
-
-DEVELOPER_PROMPT = (
-    "Правила вывода: верните СТРОГО один JSON-объект ТОЛЬКО в теле ответа,\n"
-    "без markdown, без пояснений, без комментариев, без подсказок языка.\n"
-    "JSON должен быть МИНИФИЦИРОВАН (в одну строку, без пробелов и переносов),\n"
-    "чтобы исключить артефакты форматирования.\n"
-    "{"
-    "\"title\": str,"
-    "\"summary\": str,"
-    "\"life_path\":{\"value\":int,\"meaning\":str,\"strengths\":[str],\"risks\":[str],\"advice\":[str]},"
-    "\"pythagoras_matrix\":{"
-      "\"grid_text\": str,"
-      "\"lines_overview\":[{\"axis\":str,\"total\":int,\"tone\":str,\"comment\":str}],"
-      "\"digits\":[{\"digit\":int,\"count\":int,\"meaning\":str,\"advice\":str}],"
-      "\"missing\":[int],\"dominant\":[int]"
-    "},"
-    "\"practical_recs\":{\"week\":[str],\"month\":[str],\"focus_areas\":[str]},"
-    "\"data_notes\":[str]"
-    "}"
-)
-
+# --- LLM: Prompt builders (тексты и версии — в src/prompts.py) ---
 def build_user_prompt_for_numerology(input_payload: dict) -> str:
   # Compose a deterministic, readable block the model will parse
-  return (
-    "Ниже — данные пользователя для нумерологического разбора. Проверьте согласованность и подготовьте JSON отчёт.\n\n"
-    f"full_name: {input_payload.get('full_name','')}\n"
-    f"dob_ddmmyyyy: {input_payload.get('dob_ddmmyyyy','')}\n"
-    f"life_path: {input_payload.get('life_path','')}\n\n"
-    "pythagoras_counts:\n" + json.dumps(input_payload.get('pythagoras_counts', {}), ensure_ascii=False) + "\n\n"
-    "pythagoras_lines:\n" + json.dumps(input_payload.get('pythagoras_lines', {}), ensure_ascii=False) + "\n\n"
-    "pythagoras_ext:\n" + json.dumps(input_payload.get('pythagoras_ext', {}), ensure_ascii=False) + "\n"
+  return prompts.render(
+    "numerology.user",
+    full_name=input_payload.get('full_name',''),
+    dob_ddmmyyyy=input_payload.get('dob_ddmmyyyy',''),
+    life_path=input_payload.get('life_path',''),
+    pythagoras_counts=json.dumps(input_payload.get('pythagoras_counts', {}), ensure_ascii=False),
+    pythagoras_lines=json.dumps(input_payload.get('pythagoras_lines', {}), ensure_ascii=False),
+    pythagoras_ext=json.dumps(input_payload.get('pythagoras_ext', {}), ensure_ascii=False),
   )
 
 
-# --- LLM: Prompt builders for detailed natal report ---
-
-NATAL_DEVELOPER_PROMPT = (
-    "Правила вывода: верните СТРОГО один JSON-объект ТОЛЬКО в теле ответа,\n"
-    "без markdown/комментариев/подсказок языка. Объект ДОЛЖЕН быть минифицирован (в одну строку).\n"
-    "{"
-    "\"title\":str,"
-    "\"summary\":str,"
-    "\"birth\":{\"full_name\":str,\"date\":str,\"time\":(str|null),\"city\":str,\"timezone_note\":str},"
-    "\"chart\":{"
-      "\"sun\":{\"sign\":str,\"comment\":str},"
-      "\"moon\":{\"sign\":str,\"comment\":str},"
-      "\"ascendant\":{\"sign\":str,\"comment\":str}"
-    "},"
-    "\"houses\":[{\"house\":int,\"topic\":str,\"comment\":str}],"
-    "\"aspects\":[{\"pair\":str,\"type\":str,\"tightness\":str,\"meaning\":str}],"
-    "\"numerology\":{\"life_path\":{\"value\":int,\"comment\":str}},"
-    "\"practical_recs\":{\"week\":[str],\"month\":[str],\"focus_areas\":[str]},"
-    "\"data_notes\":[str]"
-    "}"
-)
-
-
-
 def build_user_prompt_for_natal(input_payload: dict) -> str:
     """
     Собираем читабельный блок для модели (Наталка PRO).
     Ожидаемые ключи: full_name, date (ДД.ММ.ГГГГ), time (ЧЧ:ММ или None), city, life_path (int).
     """
-    return (
-        "Данные пользователя для астрологического разбора (Наталка PRO). "
-        "Проверьте согласованность и подготовьте JSON отчёт по схеме.\n\n"
-        f"full_name: {input_payload.get('full_name','')}\n"
-        f"date_ddmmyyyy: {input_payload.get('date','')}\n"
-        f"time_hhmm: {input_payload.get('time','')}\n"
-        f"city_country: {input_payload.get('city','')}\n"
-        f"life_path: {input_payload.get('life_path','')}\n"
-        "timezone_hint: если время неизвестно — добавьте в data_notes допущение про полдень/локальную зону."
+    return prompts.render(
+        "natal.user",
+        full_name=input_payload.get('full_name',''),
+        date=input_payload.get('date',''),
+        time=input_payload.get('time',''),
+        city=input_payload.get('city',''),
+        life_path=input_payload.get('life_path',''),
     )
 
 
-# --- LLM: Prompt for Palmistry (Хиромантия) ---
-
-PALM_DEVELOPER_PROMPT = (
-    "Верните СТРОГО один JSON-объект ТОЛЬКО в теле ответа, без markdown/комментариев. "
-    "JSON ДОЛЖЕН быть минифицирован (в одну строку). Строго избегайте построчного/помесячного перечня букв — "
-    "не раскладывайте текст по символам. Все списки возвращайте как массивы строк. "
-    "Для каждой линии (сердца, головы, жизни) добавьте 3–5 детализированных наблюдений. "
-    "Используйте художественные метафоры и образные описания: не только факты, но и интерпретацию "
-    "(например: ‘линия сердца тянется мягко, как река — это указывает на…’). "
-    "Для холмов укажите степень выраженности и значение через образы (например: ‘Холм Венеры сияет теплом…’). "
-    "В summary дайте цельный художественный портрет, как будто вы рассказываете историю судьбы человека, "
-    "с плавными переходами и тёплым, поддерживающим тоном. Избегайте медицинских/финансовых советов.\n"
-    "Структура:"
-    "{"
-    "\"title\":str,"
-    "\"summary\":str,"
-    "\"hand_overview\":{\"dominant\":(str|null),\"general\":[str]},"
-    "\"lines\":{"
-      "\"heart\":{\"tone\":str,\"details\":[str]},"
-      "\"head\":{\"tone\":str,\"details\":[str]},"
-      "\"life\":{\"tone\":str,\"details\":[str]},"
-      "\"fate\":{\"present\":bool,\"details\":[str]}"
-    "},"
-    "\"mounts\":[{\"name\":str,\"expression\":str,\"comment\":str}],"
-    "\"patterns\":[str],"
-    "\"practical_recs\":{\"week\":[str],\"month\":[str],\"focus_areas\":[str]},"
-    "\"data_notes\":[str]"
-    "}"
-)
-
 def build_user_prompt_for_palm(*, full_name: str | None, dominant_hand: str | None, user_context: str | None, has_photo: bool, tg_file_id: str | None) -> str:
     """
     Собираем вход для модели: имя (опц.), доминантная рука (опц.), контекст пользователя (опц.),
     факт наличия фото (да/нет) и telegram file_id (как идентификатор, без содержимого).
     """
-    return (
-        "Хиромантия (разбор по фото ладони). "
-        "Напишите образный, но структурированный отчёт на русском по схеме JSON. "
-        "Не давайте медицинских/финансовых советов. Учитывайте, что модель НЕ видит само фото; "
-        "используйте мягкие формулировки и допускайте неопределённость.\n\n"
-        f"full_name: {full_name or ''}\n"
-        f"dominant_hand: {dominant_hand or ''}\n"
-        f"user_context: {user_context or ''}\n"
-        f"photo_provided: {'yes' if has_photo else 'no'}\n"
-        f"telegram_file_id: {tg_file_id or ''}\n"
-        "Пояснение: если чего-то нельзя утверждать без визуального подтверждения, добавляйте сноску в data_notes."
+    return prompts.render(
+        "palm.user",
+        full_name=full_name or '',
+        dominant_hand=dominant_hand or '',
+        user_context=user_context or '',
+        photo_provided='yes' if has_photo else 'no',
+        tg_file_id=tg_file_id or '',
     )
 
 
+# --- HTTP transport for all LLM providers (retries + record/replay support) ---
+async def _provider_post(provider: str, url: str, *, headers: dict, payload: dict, params: dict | None = None, timeout: int = 60):
+    """POST JSON to a provider, retrying 429/503 per its RetryPolicy within the request deadline.
+    In cassette replay mode the network is never touched."""
+    policy = retry.policy_for(provider)
+    attempt = 0
+    while True:
+        left = retry.remaining()
+        if left is not None and left <= 0:
+            retry.count(provider, "deadline_exhausted")
+            raise RuntimeError(f"{provider}: LLM request deadline exceeded")
+        retry.count(provider, "requests")
+        resp = await _provider_send(provider, url, headers=headers, payload=payload, params=params,
+                                    timeout=timeout if left is None else max(1.0, min(timeout, left)))
+        if resp.status_code // 100 == 2:
+            retry.count(provider, "ok")
+        if resp.status_code not in policy.retry_statuses:
+            return resp
+        retry.count(provider, "throttled")
+        if attempt >= policy.max_retries:
+            return resp
+        delay = retry.backoff_delay(policy, attempt, resp.headers.get("Retry-After"))
+        left = retry.remaining()
+        if left is not None and delay >= left:
+            # ждать дольше, чем осталось до дедлайна, бессмысленно — отдаём ответ на фолбэк
+            retry.count(provider, "deadline_exhausted")
+            return resp
+        log.info("%s HTTP %s, retry %d in %.2fs", provider, resp.status_code, attempt + 1, delay)
+        retry.count(provider, "retries")
+        retry.count(provider, "retry_sleep_s", delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _provider_send(provider: str, url: str, *, headers: dict, payload: dict, params: dict | None, timeout: float):
+    if cassette.is_replaying():
+        return await cassette.replay(provider, url, payload)
+
+    def _post():
+        return requests.post(url, headers=headers, params=params, data=json.dumps(payload), timeout=timeout)
+
+    t0 = time.monotonic()
+    resp = await asyncio.to_thread(_post)
+    if cassette.is_recording():
+        try:
+            await asyncio.to_thread(
+                cassette.record, provider, url, payload,
+                status_code=resp.status_code, text=resp.text,
+                headers=dict(resp.headers), elapsed_s=time.monotonic() - t0,
+            )
+        except Exception as e:
+            log.warning("cassette record failed: %s", e)
+    return resp
+
+
 def _format_messages_for_gemini(messages: list) -> str:
     """Gemini принимает простой текст. Склеиваем роли и контент в один промпт."""
     chunks = []
@@ -455,7 +480,7 @@ async def _openai_chat_completion(messages: list, *, temperature: float = 0.6, t
     """Call OpenAI Chat Completions API with JSON-only response and model fallbacks."""
     if not OPENAI_API_KEY:
         raise RuntimeError("OPENAI_API_KEY is not set")
-    url = "https://api.openai.com/v1/chat/completions"
+    url = f"{OPENAI_BASE_URL}/chat/completions"
     headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
 
     # Prefer lightweight models that доступны на free-tier; при ошибке пробуем следующую
@@ -476,10 +501,7 @@ async def _openai_chat_completion(messages: list, *, temperature: float = 0.6, t
             "response_format": {"type": "json_object"},
         }
 
-        def _post():
-            return requests.post(url, headers=headers, data=json.dumps(payload), timeout=60)
-
-        resp = await asyncio.to_thread(_post)
+        resp = await _provider_post("openai", url, headers=headers, payload=payload)
         if resp.status_code // 100 == 2:
             return resp.json()
         else:
@@ -501,7 +523,7 @@ async def _mistral_chat_completion(messages: list, *, temperature: float = 0.6,
     if not MISTRAL_API_KEY:
         raise RuntimeError("MISTRAL_API_KEY is not set")
 
-    url = "https://api.mistral.ai/v1/chat/completions"
+    url = f"{MISTRAL_BASE_URL}/chat/completions"
     headers = {
         "Authorization": f"Bearer {MISTRAL_API_KEY}",
         "Content-Type": "application/json",
@@ -524,10 +546,7 @@ async def _mistral_chat_completion(messages: list, *, temperature: float = 0.6,
             "response_format": {"type": "json_object"},
         }
 
-        def _post():
-            return requests.post(url, headers=headers, data=json.dumps(payload), timeout=60)
-
-        resp = await asyncio.to_thread(_post)
+        resp = await _provider_post("mistral", url, headers=headers, payload=payload)
         if resp.status_code // 100 == 2:
             return resp.json()
         else:
@@ -543,12 +562,19 @@ async def _mistral_chat_completion(messages: list, *, temperature: float = 0.6,
 # Primary LLM router: OpenAI → Gemini → Mistral fallback
 async def _llm_chat_completion(messages: list, *, temperature: float = 0.6, top_p: float = 0.9, max_tokens: int = 1400) -> dict:
     """Primary LLM router: OpenAI → Gemini → Mistral fallback. Возвращает объект в формате OpenAI ChatCompletions."""
+    # Один дедлайн на весь запрос: ретраи и фолбэки делят общий бюджет времени
+    with retry.deadline(LLM_REQUEST_DEADLINE_S):
+        return await _llm_chat_completion_routed(messages, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+
+
+async def _llm_chat_completion_routed(messages: list, *, temperature: float, top_p: float, max_tokens: int) -> dict:
     last_error = None
 
     # 1) Try OpenAI if key exists
     if OPENAI_API_KEY:
         try:
-            return await _openai_chat_completion(messages, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+            with tracing.span("llm.openai"):
+                return await _openai_chat_completion(messages, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
         except Exception as e:
             last_error = e
             log.warning("OpenAI failed, will try Gemini fallback: %s", e)
@@ -556,7 +582,7 @@ async def _llm_chat_completion(messages: list, *, temperature: float = 0.6, top_
     # 2) Try Gemini if key exists
     if GEMINI_API_KEY:
         try:
-            url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+            url = f"{GEMINI_BASE_URL}/models/gemini-2.0-flash:generateContent"
             headers = {"Content-Type": "application/json"}
             params = {"key": GEMINI_API_KEY}
             prompt_text = _format_messages_for_gemini(messages)
@@ -569,28 +595,28 @@ async def _llm_chat_completion(messages: list, *, temperature: float = 0.6, top_
                     "responseMimeType": "application/json"
                 },
             }
-            def _post():
-                return requests.post(url, headers=headers, params=params, data=json.dumps(payload), timeout=60)
-            resp = await asyncio.to_thread(_post)
-            if resp.status_code // 100 == 2:
-                data = resp.json()
-                text = ""
-                try:
-                    text = data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-                except Exception:
+            with tracing.span("llm.gemini"):
+                resp = await _provider_post("gemini", url, headers=headers, params=params, payload=payload)
+                if resp.status_code // 100 == 2:
+                    data = resp.json()
                     text = ""
-                # Нормализуем под openai-формат для дальнейшего кода
-                return {"choices": [{"message": {"content": text}}]}
-            else:
-                log.error("Gemini error %s: %s", resp.status_code, resp.text)
-                raise RuntimeError(f"Gemini HTTP {resp.status_code}: {resp.text}")
+                    try:
+                        text = data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+                    except Exception:
+                        text = ""
+                    # Нормализуем под openai-формат для дальнейшего кода (usageMetadata — для статистики промптов)
+                    return {"choices": [{"message": {"content": text}}], "usageMetadata": data.get("usageMetadata") or {}}
+                else:
+                    log.error("Gemini error %s: %s", resp.status_code, resp.text)
+                    raise RuntimeError(f"Gemini HTTP {resp.status_code}: {resp.text}")
         except Exception as e:
             last_error = e
 
     # 3) Try Mistral if key exists
     if MISTRAL_API_KEY:
         try:
-            return await _mistral_chat_completion(messages, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+            with tracing.span("llm.mistral"):
+                return await _mistral_chat_completion(messages, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
         except Exception as e:
             last_error = e
             log.warning("Mistral failed as well: %s", e)
@@ -654,40 +680,21 @@ def _ensure_list(val) -> list[str]:
     parts = [p.strip(" .,;\t") for p in re.split(r"[\n;]+", txt) if p.strip()]
     return parts
 
-# --- Helper: split long HTML into safe Telegram chunks ---
-def _split_html_for_telegram(html: str, limit: int = 3500) -> list[str]:
-    """Split long HTML text into chunks under Telegram's ~4096 chars. We keep boundaries on line breaks."""
-    if not html:
-        return []
-    html = html.strip()
-    if len(html) <= limit:
-        return [html]
-    parts = []
-    buf = []
-    cur = 0
-    for line in html.split("\n"):
-        # +1 for the newline that we re-add when joining
-        add_len = len(line) + (1 if buf else 0)
-        if cur + add_len > limit:
-            parts.append("\n".join(buf))
-            buf = [line]
-            cur = len(line)
-        else:
-            if buf:
-                buf.append(line)
-            else:
-                buf = [line]
-            cur += add_len
-    if buf:
-        parts.append("\n".join(buf))
-    return parts
-
 # --- Helper: quick "Back to menu" button ---
 
 BACK_MENU_KB = InlineKeyboardMarkup(
     [[InlineKeyboardButton("← В главное меню", callback_data="back_home")]]
 )
 
+def _enqueue_report(chat_id: int, order_id: int | None, pieces):
+    """Put the rendered report (and the back-to-menu message) into the outbox; the sender delivers it."""
+    # рендер ленивый: чанки собираются, пока enqueue их пишет, поэтому меряем оба шага вместе
+    with tracing.span("render", order_id=order_id):
+        outbox.enqueue(
+            chat_id, tg_html.iter_chunks(pieces, empty="Готово."), order_id=order_id,
+            tail=("Можешь вернуться в главное меню:", BACK_MENU_KB),
+        )
+
 async def _send_back_menu(update: Update, text: str = "Можешь вернуться в главное меню:"):
     try:
         await update.message.reply_text(text, reply_markup=BACK_MENU_KB)
@@ -696,55 +703,62 @@ async def _send_back_menu(update: Update, text: str = "Можешь вернут
 
 
 # --- Helper to ensure bot menu commands are set ("/menu" etc) ---
-async def _ensure_bot_menu_commands(context: ContextTypes.DEFAULT_TYPE):
-    """Ensure system menu shows /menu (Главное меню). Safe to call multiple times."""
+BOT_MENU_COMMANDS = [
+    BotCommand("menu", "Главное меню"),
+    BotCommand("start", "Запуск бота"),
+    BotCommand("my_reports", "Мои разборы"),
+    BotCommand("cancel", "Отмена и в главное меню"),
+]
+
+async def _ensure_bot_menu_commands(bot):
+    """Set the system menu (/menu etc) once per content: the hash is memoized in app_meta."""
+    scope = BotCommandScopeAllPrivateChats()
+    digest = hashlib.sha256(json.dumps(
+        [[c.command, c.description] for c in BOT_MENU_COMMANDS] + [scope.type], ensure_ascii=False,
+    ).encode("utf-8")).hexdigest()
+    meta_key = f"bot_commands_hash:{bot.id}"
+    if _get_meta(meta_key) == digest:
+        return
     try:
-        await context.bot.set_my_commands(
-            [
-                BotCommand("menu", "Главное меню"),
-                BotCommand("start", "Запуск бота"),
-                BotCommand("cancel", "Отмена и в главное меню"),
-            ],
-            scope=BotCommandScopeAllPrivateChats(),
-        )
+        await bot.set_my_commands(BOT_MENU_COMMANDS, scope=scope)
+        _set_meta(meta_key, digest)
     except Exception as e:
         log.warning("set_my_commands failed: %s", e)
 
 
-def _render_report_html(report: dict) -> str:
-    """Render LLM JSON report to HTML-safe text to avoid Telegram Markdown parse errors."""
-    parts: list[str] = []
+def _iter_report_html(report: dict):
+    """Yield the numerology report as HTML lines, section by section (HTML-safe for Telegram)."""
 
     title = report.get("title")
     if title:
-        parts.append(f"<b>{escape(str(title))}</b>")
+        yield f"<b>{escape(str(title))}</b>"
 
     summary = report.get("summary")
     if summary:
-        parts.append(escape(str(summary)))
+        yield escape(str(summary))
 
     lp = report.get("life_path", {})
     if lp:
-        parts.append("")
+        yield ""
         lp_line = f"<b>Число судьбы:</b> {escape(str(lp.get('value')))} — {escape(lp.get('meaning',''))}"
-        parts.append(lp_line)
+        yield lp_line
         if lp.get('strengths'):
-            parts.append("<i>Сильные стороны:</i> " + escape(", ".join(map(str, lp['strengths']))))
+            yield "<i>Сильные стороны:</i> " + escape(", ".join(map(str, lp['strengths'])))
         if lp.get('risks'):
-            parts.append("<i>Риски:</i> " + escape(", ".join(map(str, lp['risks']))))
+            yield "<i>Риски:</i> " + escape(", ".join(map(str, lp['risks'])))
         if lp.get('advice'):
-            parts.append("<i>Советы:</i> " + escape(", ".join(map(str, lp['advice']))))
+            yield "<i>Советы:</i> " + escape(", ".join(map(str, lp['advice'])))
 
     pm = report.get("pythagoras_matrix", {})
     if pm:
         grid = pm.get('grid_text')
         if grid:
-            parts.append("")
-            parts.append("<b>Матрица Пифагора</b>:")
-            parts.append(f"<pre>{escape(str(grid))}</pre>")
+            yield ""
+            yield "<b>Матрица Пифагора</b>:"
+            yield f"<pre>{escape(str(grid))}</pre>"
         lo = pm.get('lines_overview') or []
         if lo:
-            parts.append("")
+            yield ""
             lines = []
             for i in lo:
                 axis = escape(str(i.get('axis','')))
@@ -752,7 +766,7 @@ def _render_report_html(report: dict) -> str:
                 tone = escape(str(i.get('tone','')))
                 comment = escape(str(i.get('comment','')))
                 lines.append(f"• {axis}: {total} — {tone}. {comment}")
-            parts.append("<b>Линии и оси:</b>\n" + "\n".join(lines))
+            yield "<b>Линии и оси:</b>\n" + "\n".join(lines)
 
     pr = report.get("practical_recs", {})
     if pr:
@@ -760,172 +774,174 @@ def _render_report_html(report: dict) -> str:
         month = _ensure_list(pr.get('month'))
         focus = _ensure_list(pr.get('focus_areas'))
         if week:
-            parts.append("")
-            parts.append("<b>Рекомендации на неделю:</b>\n" + "\n".join("• " + escape(x) for x in week))
+            yield ""
+            yield "<b>Рекомендации на неделю:</b>\n" + "\n".join("• " + escape(x) for x in week)
         if month:
-            parts.append("")
-            parts.append("<b>Рекомендации на месяц:</b>\n" + "\n".join("• " + escape(x) for x in month))
+            yield ""
+            yield "<b>Рекомендации на месяц:</b>\n" + "\n".join("• " + escape(x) for x in month)
         if focus:
-            parts.append("")
-            parts.append("<b>Фокусы:</b> " + escape(", ".join(focus)))
+            yield ""
+            yield "<b>Фокусы:</b> " + escape(", ".join(focus))
 
     dn = _ensure_list(report.get("data_notes"))
     if dn:
-        parts.append("")
-        parts.append("<i>Примечания к данным:</i>\n" + "\n".join("• " + escape(x) for x in dn))
+        yield ""
+        yield "<i>Примечания к данным:</i>\n" + "\n".join("• " + escape(x) for x in dn)
+
 
-    # Join with double breaks between sections
-    html_text = "\n".join(parts)
+def _render_report_html(report: dict) -> str:
+    """Render LLM JSON report to HTML-safe text to avoid Telegram Markdown parse errors."""
+    html_text = "\n".join(_iter_report_html(report))
     return html_text if html_text.strip() else "Готово."
 
 
 # --- Natalka PRO: Render HTML report for natal chart ---
-def _render_natal_report_html(report: dict) -> str:
-    from html import escape
-    out: list[str] = []
+def _iter_natal_report_html(report: dict):
+    """Yield the natal report as HTML lines, section by section."""
 
     title = report.get("title")
     if title:
-        out.append(f"<b>{escape(str(title))}</b>")
+        yield f"<b>{escape(str(title))}</b>"
 
     summary = report.get("summary")
     if summary:
-        out.append(escape(str(summary)))
+        yield escape(str(summary))
 
     birth = report.get("birth", {})
     if birth:
-        out.append("")
-        out.append("<b>Исходные данные:</b>")
+        yield ""
+        yield "<b>Исходные данные:</b>"
         full_name = birth.get("full_name", "")
         date = birth.get("date", "")
         time = birth.get("time") or "неизвестно"
         city = birth.get("city", "")
-        out.append("• " + escape(f"{full_name} — {date} {time} — {city}"))
+        yield "• " + escape(f"{full_name} — {date} {time} — {city}")
         tz = birth.get("timezone_note")
         if tz:
-            out.append("<i>" + escape(str(tz)) + "</i>")
+            yield "<i>" + escape(str(tz)) + "</i>"
 
     chart = report.get("chart", {})
     if chart:
-        out.append("")
-        out.append("<b>Карта:</b>")
+        yield ""
+        yield "<b>Карта:</b>"
         for key, label in (("sun", "Солнце"), ("moon", "Луна"), ("ascendant", "Асцендент")):
             node = chart.get(key) or {}
             sign = node.get("sign", "")
             cmt = node.get("comment", "")
             if sign or cmt:
-                out.append(f"• {label}: {escape(str(sign))} — {escape(str(cmt))}")
+                yield f"• {label}: {escape(str(sign))} — {escape(str(cmt))}"
 
     houses = report.get("houses") or []
     if houses:
-        out.append("")
-        out.append("<b>Дома:</b>")
+        yield ""
+        yield "<b>Дома:</b>"
         for h in houses:
             house = h.get("house")
             topic = h.get("topic", "")
             comment = h.get("comment", "")
-            out.append(f"• Дом {escape(str(house))} — {escape(str(topic))}. {escape(str(comment))}")
+            yield f"• Дом {escape(str(house))} — {escape(str(topic))}. {escape(str(comment))}"
 
     aspects = report.get("aspects") or []
     if aspects:
-        out.append("")
-        out.append("<b>Ключевые аспекты:</b>")
+        yield ""
+        yield "<b>Ключевые аспекты:</b>"
         for a in aspects:
             pair = a.get("pair", "")
             type_ = a.get("type", "")
             tight = a.get("tightness", "")
             meaning = a.get("meaning", "")
-            out.append("• " + escape(f"{pair} ({type_}, {tight}) — {meaning}"))
+            yield "• " + escape(f"{pair} ({type_}, {tight}) — {meaning}")
 
     num = (report.get("numerology") or {}).get("life_path") or {}
     if num:
-        out.append("")
+        yield ""
         value = num.get("value")
         comment = num.get("comment", "")
-        out.append(f"<b>Число судьбы:</b> {escape(str(value))} — {escape(str(comment))}")
+        yield f"<b>Число судьбы:</b> {escape(str(value))} — {escape(str(comment))}"
 
     recs = report.get("practical_recs") or {}
     week = _ensure_list(recs.get("week"))
     month = _ensure_list(recs.get("month"))
     focus = _ensure_list(recs.get("focus_areas"))
     if week:
-        out.append("")
-        out.append("<b>Рекомендации на неделю:</b>\n" + "\n".join("• " + escape(x) for x in week))
+        yield ""
+        yield "<b>Рекомендации на неделю:</b>\n" + "\n".join("• " + escape(x) for x in week)
     if month:
-        out.append("")
-        out.append("<b>Рекомендации на месяц:</b>\n" + "\n".join("• " + escape(x) for x in month))
+        yield ""
+        yield "<b>Рекомендации на месяц:</b>\n" + "\n".join("• " + escape(x) for x in month)
     if focus:
-        out.append("")
-        out.append("<b>Фокусы:</b> " + escape(", ".join(focus)))
+        yield ""
+        yield "<b>Фокусы:</b> " + escape(", ".join(focus))
 
     notes = _ensure_list(report.get("data_notes"))
     if notes:
-        out.append("")
-        out.append("<i>Примечания к данным:</i>\n" + "\n".join("• " + escape(x) for x in notes))
+        yield ""
+        yield "<i>Примечания к данным:</i>\n" + "\n".join("• " + escape(x) for x in notes)
 
-    html = "\n".join(out).strip()
+
+def _render_natal_report_html(report: dict) -> str:
+    html = "\n".join(_iter_natal_report_html(report)).strip()
     return html or "Готово."
 
 
 # --- Palmistry: Render HTML report for palmistry report ---
-def _render_palm_report_html(report: dict) -> str:
-    from html import escape
-    out: list[str] = []
+def _iter_palm_report_html(report: dict):
+    """Yield the palmistry report as HTML lines, section by section."""
 
     title = report.get("title")
     if title:
-        out.append(f"<b>{escape(str(title))}</b>")
+        yield f"<b>{escape(str(title))}</b>"
 
     summary = report.get("summary")
     if summary:
-        out.append(escape(str(summary)))
+        yield escape(str(summary))
 
     hov = report.get("hand_overview") or {}
     if hov:
-        out.append("")
+        yield ""
         dom = hov.get("dominant")
         gen = _ensure_list(hov.get("general"))
         if dom:
-            out.append(f"<b>Ведущая рука:</b> {escape(str(dom))}")
+            yield f"<b>Ведущая рука:</b> {escape(str(dom))}"
         if gen:
-            out.append("<b>Общее впечатление:</b>")
-            out.extend("• " + escape(x) for x in gen)
+            yield "<b>Общее впечатление:</b>"
+            yield from ("• " + escape(x) for x in gen)
 
     lines = report.get("lines") or {}
     if lines:
-        out.append("")
-        out.append("<b>Линии:</b>")
+        yield ""
+        yield "<b>Линии:</b>"
         def _block(name_ru: str, key: str):
             node = lines.get(key) or {}
             tone = node.get("tone", "")
             dets = _ensure_list(node.get("details"))
             if tone or dets:
-                out.append(f"• {name_ru}: {escape(str(tone))}")
+                yield f"• {name_ru}: {escape(str(tone))}"
                 for d in dets:
-                    out.append("   — " + escape(d))
-        _block("Сердца", "heart")
-        _block("Головы", "head")
-        _block("Жизни", "life")
+                    yield "   — " + escape(d)
+        yield from _block("Сердца", "heart")
+        yield from _block("Головы", "head")
+        yield from _block("Жизни", "life")
         fate = lines.get("fate") or {}
         if fate:
             present = fate.get("present")
             dets = _ensure_list(fate.get("details"))
-            out.append("• Судьбы: " + ("есть" if present else "не выражена/неопределима"))
+            yield "• Судьбы: " + ("есть" if present else "не выражена/неопределима")
             for d in dets:
-                out.append("   — " + escape(d))
+                yield "   — " + escape(d)
 
     mounts = report.get("mounts") or []
     if mounts:
-        out.append("")
-        out.append("<b>Холмы:</b>")
+        yield ""
+        yield "<b>Холмы:</b>"
         for m in mounts:
-            out.append("• " + escape(f"{m.get('name','')}: {m.get('expression','')} — {m.get('comment','')}"))
+            yield "• " + escape(f"{m.get('name','')}: {m.get('expression','')} — {m.get('comment','')}")
 
     pats = _ensure_list(report.get("patterns"))
     if pats:
-        out.append("")
-        out.append("<b>Особые рисунки:</b>")
-        out.extend("• " + escape(x) for x in pats)
+        yield ""
+        yield "<b>Особые рисунки:</b>"
+        yield from ("• " + escape(x) for x in pats)
 
     recs = report.get("practical_recs") or {}
     if isinstance(recs, dict):
@@ -933,23 +949,45 @@ def _render_palm_report_html(report: dict) -> str:
         month = _ensure_list(recs.get("month"))
         focus = _ensure_list(recs.get("focus_areas"))
         if week:
-            out.append("")
-            out.append("<b>Рекомендации на неделю:</b>\n" + "\n".join("• " + escape(x) for x in week))
+            yield ""
+            yield "<b>Рекомендации на неделю:</b>\n" + "\n".join("• " + escape(x) for x in week)
         if month:
-            out.append("")
-            out.append("<b>Рекомендации на месяц:</b>\n" + "\n".join("• " + escape(x) for x in month))
+            yield ""
+            yield "<b>Рекомендации на месяц:</b>\n" + "\n".join("• " + escape(x) for x in month)
         if focus:
-            out.append("")
-            out.append("<b>Фокусы:</b> " + escape(", ".join(focus)))
+            yield ""
+            yield "<b>Фокусы:</b> " + escape(", ".join(focus))
 
     notes = _ensure_list(report.get("data_notes"))
     if notes:
-        out.append("")
-        out.append("<i>Примечания:</i>\n" + "\n".join("• " + escape(x) for x in notes))
+        yield ""
+        yield "<i>Примечания:</i>\n" + "\n".join("• " + escape(x) for x in notes)
+
 
-    html = "\n".join(out).strip()
+def _render_palm_report_html(report: dict) -> str:
+    html = "\n".join(_iter_palm_report_html(report)).strip()
     return html or "Готово."
 
+def _numerology_messages(input_payload: dict) -> tuple[list, str]:
+    # Статический префикс (system + схема) всегда идёт первым — так работает кэш промптов у провайдера
+    messages = [
+        {"role": "system", "content": prompts.render("system")},
+        {"role": "system", "content": prompts.render("numerology.developer")},
+        {"role": "user", "content": build_user_prompt_for_numerology(input_payload)},
+    ]
+    return messages, prompts.prefix_key("system", "numerology.developer", "numerology.user")
+
+
+def _natal_messages(input_payload: dict) -> tuple[list, str]:
+    messages = [
+        {"role": "system", "content": prompts.render("system")},
+        {"role": "system", "content": prompts.render("natal.developer")},
+        {"role": "user", "content": build_user_prompt_for_natal(input_payload)},
+    ]
+    return messages, prompts.prefix_key("system", "natal.developer", "natal.user")
+
+
+@tracing.traced("generate")
 async def generate_and_send_numerology_report(update: Update, context: ContextTypes.DEFAULT_TYPE, *, full_name: str, dob: str, life_path: int, counts: dict, lines: dict, ext: dict, order_id: int | None):
     """Build prompt, call LLM, parse JSON, save to order meta, and send nicely formatted text."""
     input_payload = {
@@ -963,13 +1001,10 @@ async def generate_and_send_numerology_report(update: Update, context: ContextTy
     if not OPENAI_API_KEY and not GEMINI_API_KEY:
         await update.message.reply_text("(Подробный отчёт временно недоступен: нет ключей LLM. Обратимся только к экспресс-разбору.)")
         return
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "system", "content": DEVELOPER_PROMPT},
-        {"role": "user", "content": build_user_prompt_for_numerology(input_payload)},
-    ]
+    messages, prompt_key = _numerology_messages(input_payload)
     try:
         raw = await _llm_chat_completion(messages)
+        prompts.record_usage(prompt_key, raw)
         content = (raw.get("choices") or [{}])[0].get("message", {}).get("content", "")
         report = _try_parse_json_from_text(content)
         if not report:
@@ -991,14 +1026,13 @@ async def generate_and_send_numerology_report(update: Update, context: ContextTy
                 await update.message.reply_text("Parse error: LLM вернул не-JSON. Сниппет ответа:\n" + snippet)
             await update.message.reply_text("Не удалось распарсить отчёт LLM. Попробуйте ещё раз позднее.")
             return
+        progress.stage("Оформляю отчёт…")
         # Save JSON to order meta
         if order_id:
-            update_order(order_id, meta_merge={"llm_report": report})
+            update_order(order_id, meta_merge={"llm_report": report, "prompt_key": prompt_key})
         # Render and send
-        html_text = _render_report_html(report)
-        for chunk in _split_html_for_telegram(html_text):
-            await update.message.reply_text(chunk, parse_mode="HTML")
-        await _send_back_menu(update)
+        _enqueue_report(update.effective_chat.id, order_id, _iter_report_html(report))
+        progress.done()
     except Exception as e:
         log.exception("LLM error: %s", e)
         # если пишет админ — покажем тех. причину
@@ -1013,6 +1047,7 @@ async def generate_and_send_numerology_report(update: Update, context: ContextTy
 
 
 # --- Natalka PRO: Generate and send natal report via LLM ---
+@tracing.traced("generate")
 async def generate_and_send_natal_report(
     update: Update, context: ContextTypes.DEFAULT_TYPE,
     *, full_name: str, date: str, time: str | None, city: str, order_id: int | None
@@ -1032,14 +1067,11 @@ async def generate_and_send_natal_report(
         "life_path": life_path,
     }
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "system", "content": NATAL_DEVELOPER_PROMPT},
-        {"role": "user", "content": build_user_prompt_for_natal(input_payload)},
-    ]
+    messages, prompt_key = _natal_messages(input_payload)
 
     try:
         raw = await _llm_chat_completion(messages)
+        prompts.record_usage(prompt_key, raw)
         content = (raw.get("choices") or [{}])[0].get("message", {}).get("content", "")
         report = _try_parse_json_from_text(content)
         if not report:
@@ -1061,13 +1093,12 @@ async def generate_and_send_natal_report(
             await update.message.reply_text("Не удалось собрать натальный отчёт. Попробуйте ещё раз позже.")
             return
 
+        progress.stage("Оформляю отчёт…")
         if order_id:
-            update_order(order_id, meta_merge={"natal_llm_report": report})
+            update_order(order_id, meta_merge={"natal_llm_report": report, "prompt_key": prompt_key})
 
-        html_text = _render_natal_report_html(report)
-        for chunk in _split_html_for_telegram(html_text):
-            await update.message.reply_text(chunk, parse_mode="HTML")
-        await _send_back_menu(update)
+        _enqueue_report(update.effective_chat.id, order_id, _iter_natal_report_html(report))
+        progress.done()
     except Exception as e:
         log.exception("Natal LLM error: %s", e)
         try:
@@ -1080,51 +1111,157 @@ async def generate_and_send_natal_report(
             await update.message.reply_text("Во время генерации натального отчёта произошла ошибка. Попробуем позже.")
 
 
+# --- Palmistry: vision pass and speculative prefetch ---
+async def _prepare_palm_image(bot, tg_file_id: str, tg_file_unique_id: str | None) -> tuple[str | None, dict]:
+    # Качаем фото сами (через HTTP-клиент бота, с кэшем) и отдаём провайдеру байты,
+    # а не ссылку с токеном бота — без лишнего похода Mistral → Telegram
+    image_bytes = await FILE_CACHE.get_bytes(bot, tg_file_id, tg_file_unique_id)
+    if not image_bytes:
+        return None, {}
+    return await palm_image.prepare_for_vision(image_bytes)
+
+
+async def _palm_vision_report(
+    image_url: str, image_info: dict,
+    *, full_name: str | None, dominant_hand: str | None, user_context: str | None,
+) -> tuple[dict | None, str, dict]:
+    """Vision call over a prepared image. Returns (report or None, prompt_key, cache info)."""
+    if user_context and len(user_context) > 700:
+        user_context = user_context[:700] + "…"
+    vision_user = prompts.render(
+        "palm.vision.user",
+        full_name=full_name or '',
+        dominant_hand=dominant_hand or '',
+        user_context=user_context or '',
+    )
+    vision_key = prompts.prefix_key("palm.vision", "palm.vision.user")
+    # Повторная отправка того же (или почти того же) фото с тем же контекстом — берём из кэша
+    ctx_hash = palm_cache.context_hash(
+        prompt_key=vision_key, model=MISTRAL_VISION_MODEL, user_text=vision_user,
+    )
+    cached = palm_cache.lookup(image_info.get("phash"), ctx_hash)
+    if cached:
+        return cached["report"], vision_key, {"hit": True, "id": cached["id"], "distance": cached["distance"]}
+    with tracing.span("llm.vision"):
+        raw = await _mistral_vision_analyze_palm(
+            prompts.render("palm.vision"),
+            image_url,
+            model=MISTRAL_VISION_MODEL,
+            user_text=vision_user,
+        )
+    prompts.record_usage(vision_key, raw)
+    content = (raw.get("choices") or [{}])[0].get("message", {}).get("content", "")
+    report = _try_parse_json_from_text(content)
+    if report:
+        palm_cache.store(
+            image_info.get("phash"), ctx_hash, report,
+            model=MISTRAL_VISION_MODEL, prompt_key=vision_key,
+        )
+    return report, vision_key, {"hit": False}
+
+
+# Спекулятивная подготовка фото, пока пользователь пишет контекст: user_id -> запись
+_PALM_PREFETCH: dict[int, dict] = {}
+
+
+def _palm_vision_available() -> bool:
+    return bool(PALM_VISION) and VISION_PROVIDER == "mistral" and bool(MISTRAL_API_KEY)
+
+
+async def _palm_prefetch_run(bot, tg_file_id: str, tg_file_unique_id: str | None, full_name: str | None) -> dict:
+    image_url, image_info = await _prepare_palm_image(bot, tg_file_id, tg_file_unique_id)
+    result = {"image_url": image_url, "image_info": image_info, "vision": None}
+    if image_url and PALM_PREFETCH_VISION:
+        # Разбор без контекста: пригодится как есть, если пользователь ответит «пропустить»
+        args = (full_name, None, None)
+        report, key, cache_info = await _palm_vision_report(
+            image_url, image_info, full_name=full_name, dominant_hand=None, user_context=None,
+        )
+        if report:
+            result["vision"] = {"args": args, "report": report, "prompt_key": key, "cache": cache_info}
+    return result
+
+
+def _log_palm_prefetch_error(task: asyncio.Task):
+    # забираем исключение сразу, чтобы брошенная задача не давала "exception was never retrieved"
+    if not task.cancelled() and task.exception() is not None:
+        log.info("palm prefetch failed: %s", task.exception())
+
+
+def _start_palm_prefetch(bot, user_id: int, tg_file_id: str, tg_file_unique_id: str | None, full_name: str | None):
+    now = time.monotonic()
+    for uid, entry in list(_PALM_PREFETCH.items()):
+        if uid == user_id or now - entry["started"] > PALM_PREFETCH_TTL_S:
+            entry["task"].cancel()
+            _PALM_PREFETCH.pop(uid, None)
+    task = asyncio.get_running_loop().create_task(
+        _palm_prefetch_run(bot, tg_file_id, tg_file_unique_id, full_name)
+    )
+    task.add_done_callback(_log_palm_prefetch_error)
+    _PALM_PREFETCH[user_id] = {"file_id": tg_file_id, "task": task, "started": now}
+
+
+async def _take_palm_prefetch(user_id: int | None, tg_file_id: str) -> dict | None:
+    entry = _PALM_PREFETCH.pop(user_id, None) if user_id is not None else None
+    if not entry:
+        return None
+    if entry["file_id"] != tg_file_id:
+        entry["task"].cancel()
+        return None
+    try:
+        return await entry["task"]
+    except Exception as e:
+        log.warning("Palm prefetch failed, preparing again: %s", e)
+        return None
+
+
 # --- Palmistry: Generate and send palm report via LLM ---
+@tracing.traced("generate")
 async def generate_and_send_palm_report(
     update: Update, context: ContextTypes.DEFAULT_TYPE,
     *, full_name: str | None, dominant_hand: str | None, user_context: str | None,
-    tg_file_id: str | None, order_id: int | None
+    tg_file_id: str | None, order_id: int | None, tg_file_unique_id: str | None = None
 ):
     """Build prompt for Palmistry, call LLM, parse JSON, store meta, send HTML."""
-    vision_enabled = bool(PALM_VISION)
-    if vision_enabled and tg_file_id and VISION_PROVIDER == "mistral" and MISTRAL_API_KEY:
+    if tg_file_id and _palm_vision_available():
         try:
-            image_url = await asyncio.to_thread(_get_telegram_file_url, tg_file_id)
+            progress.stage("Обрабатываю фото…")
+            user_id = update.effective_user.id if update.effective_user else None
+            prefetched = await _take_palm_prefetch(user_id, tg_file_id)
+            if prefetched and prefetched["image_url"]:
+                image_url, image_info = prefetched["image_url"], prefetched["image_info"]
+            else:
+                image_url, image_info = await _prepare_palm_image(context.bot, tg_file_id, tg_file_unique_id)
             if image_url:
-                if user_context and len(user_context) > 700:
-                    user_context = user_context[:700] + "…"
-                vision_prompt = (
-                    "Ты практикующий хиромант и эзотерический рассказчик. На основе ПРИЛОЖЕННОГО ФОТО правой ладони выполни визуальный анализ. "
-                    f"Имя: {full_name or ''}. Доминирующая рука: {dominant_hand or ''}. "
-                    f"Контекст: {user_context or ''}. "
-                    "Опиши не только факты, но и их смысл через мягкие метафоры и образные формулировки (без эзотерического пафоса). "
-                    "Верни СТРОГО один минифицированный JSON (в одну строку) по следующей схеме. "
-                ) + PALM_DEVELOPER_PROMPT
-                raw = await _mistral_vision_analyze_palm(
-                    vision_prompt,
-                    image_url,
-                    model=MISTRAL_VISION_MODEL,
-                )
-                content = (raw.get("choices") or [{}])[0].get("message", {}).get("content", "")
-                report = _try_parse_json_from_text(content)
+                spec = prefetched and prefetched["vision"]
+                if spec and spec["args"] == (full_name, dominant_hand, user_context):
+                    report, vision_key, cache_info = spec["report"], spec["prompt_key"], {**spec["cache"], "prefetched": True}
+                else:
+                    progress.stage("Изучаю линии ладони…")
+                    report, vision_key, cache_info = await _palm_vision_report(
+                        image_url, image_info,
+                        full_name=full_name, dominant_hand=dominant_hand, user_context=user_context,
+                    )
                 if report:
                     if order_id:
                         update_order(order_id, status="done", meta_merge={
                             "palm_llm_report": report, "palm_photo_file_id": tg_file_id,
-                            "vision": {"provider": "mistral", "model": MISTRAL_VISION_MODEL},
+                            "vision": {
+                                "provider": "mistral", "model": MISTRAL_VISION_MODEL,
+                                "image": image_info, "cache": cache_info,
+                            },
+                            "prompt_key": vision_key,
                         })
-                    html_text = _render_palm_report_html(report)
-                    for chunk in _split_html_for_telegram(html_text):
-                        await update.message.reply_text(chunk, parse_mode="HTML")
-                    await _send_back_menu(update)
+                    _enqueue_report(update.effective_chat.id, order_id, _iter_palm_report_html(report))
+                    progress.done()
                     return
         except Exception as e:
             log.warning("Palm vision path failed: %s", e)
     # fallback to text-only path
+    progress.stage("Пишу разбор…")
     messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "system", "content": PALM_DEVELOPER_PROMPT},
+        {"role": "system", "content": prompts.render("system")},
+        {"role": "system", "content": prompts.render("palm.developer")},
         {"role": "user", "content": build_user_prompt_for_palm(
             full_name=full_name,
             dominant_hand=dominant_hand,
@@ -1133,8 +1270,10 @@ async def generate_and_send_palm_report(
             tg_file_id=tg_file_id,
         )},
     ]
+    prompt_key = prompts.prefix_key("system", "palm.developer", "palm.user")
     try:
         raw = await _llm_chat_completion(messages)
+        prompts.record_usage(prompt_key, raw)
         content = (raw.get("choices") or [{}])[0].get("message", {}).get("content", "")
         report = _try_parse_json_from_text(content)
         if not report:
@@ -1156,13 +1295,12 @@ async def generate_and_send_palm_report(
             await update.message.reply_text("Не удалось собрать разбор по ладони. Попробуем позже.")
             return
 
+        progress.stage("Оформляю отчёт…")
         if order_id:
-            update_order(order_id, status="done", meta_merge={"palm_llm_report": report, "palm_photo_file_id": tg_file_id})
+            update_order(order_id, status="done", meta_merge={"palm_llm_report": report, "palm_photo_file_id": tg_file_id, "prompt_key": prompt_key})
 
-        html_text = _render_palm_report_html(report)
-        for chunk in _split_html_for_telegram(html_text):
-            await update.message.reply_text(chunk, parse_mode="HTML")
-        await _send_back_menu(update)
+        _enqueue_report(update.effective_chat.id, order_id, _iter_palm_report_html(report))
+        progress.done()
     except Exception as e:
         log.exception("Palm LLM error: %s", e)
         try:
@@ -1174,6 +1312,56 @@ async def generate_and_send_palm_report(
         else:
             await update.message.reply_text("Во время генерации разбора по ладони произошла ошибка.")
 
+# --- Batch mode: отложенная генерация отчётов через Batch API ---
+def _batch_item_for_order(order: dict) -> dict | None:
+    """Rebuild the LLM request for a stored order from its meta (numerology and natal only)."""
+    meta = order.get("meta") or {}
+    if order.get("payload") == "NUM_200" and meta.get("num_dob"):
+        messages, prompt_key = _numerology_messages({
+            "full_name": meta.get("num_name", ""),
+            "dob_ddmmyyyy": meta.get("num_dob", ""),
+            "life_path": meta.get("life_path", ""),
+            "pythagoras_counts": meta.get("pythagoras_counts", {}),
+            "pythagoras_lines": meta.get("pythagoras_lines", {}),
+            "pythagoras_ext": meta.get("pythagoras_ext", {}),
+        })
+        kind = "num"
+    elif order.get("payload") == "NATAL_500" and meta.get("natal_date"):
+        try:
+            life_path = calc_life_path_ddmmyyyy(meta["natal_date"])
+        except Exception:
+            life_path = None
+        messages, prompt_key = _natal_messages({
+            "full_name": meta.get("natal_full_name", ""),
+            "date": meta.get("natal_date"),
+            "time": meta.get("natal_time"),
+            "city": meta.get("natal_city", ""),
+            "life_path": life_path,
+        })
+        kind = "natal"
+    else:
+        return None
+    return {"order_id": order["id"], "kind": kind, "chat_id": order["user_id"],
+            "messages": messages, "prompt_key": prompt_key}
+
+
+async def _deliver_batch_result(bot, item: dict, content: str | None, body: dict | None):
+    order_id = item["order_id"]
+    report = _try_parse_json_from_text(content or "")
+    if not report:
+        update_order(order_id, meta_merge={"batch_error": (content or "no result")[:4000]})
+        log.warning("Batch result for order %s is empty or not JSON", order_id)
+        return
+    prompts.record_usage(item.get("prompt_key", "batch"), body)
+    if item["kind"] == "natal":
+        update_order(order_id, meta_merge={"natal_llm_report": report, "prompt_key": item.get("prompt_key"), "delivery": "batch"})
+        pieces = _iter_natal_report_html(report)
+    else:
+        update_order(order_id, meta_merge={"llm_report": report, "prompt_key": item.get("prompt_key"), "delivery": "batch"})
+        pieces = _iter_report_html(report)
+    _enqueue_report(item["chat_id"], order_id, pieces)
+
+
 # --- Нумерология: расчёт числа судьбы + короткие трактовки ---
 NUM_DESCRIPTIONS = {
     1: "Лидерство, самостоятельность, импульс к началу.",
@@ -1371,6 +1559,20 @@ def extended_matrix_meta(counts: dict) -> dict:
 
 
 # --- Natalka PRO: helper to parse all-in-one input ---
+def _parse_num_input(text: str):
+    """
+    Парсит строку «ДД.ММ.ГГГГ Имя Фамилия».
+    Возвращает (ok: bool, (dob, full_name)|str)
+    """
+    parts = (text or "").split(maxsplit=1)
+    if len(parts) < 2 or not re.fullmatch(r"\d{2}\.\d{2}\.\d{4}", parts[0]):
+        return False, "Пожалуйста, укажи: `ДД.ММ.ГГГГ Имя Фамилия`.\nНапример: `07.03.1995 Анна Петрова`"
+    try:
+        _ = datetime.strptime(parts[0], "%d.%m.%Y")
+    except ValueError:
+        return False, "Дата выглядит некорректно. Проверь и пришли ещё раз."
+    return True, (parts[0], parts[1])
+
 def _parse_natal_all_input(text: str):
     """
     Парсит 4 строки из одного сообщения:
@@ -1450,7 +1652,6 @@ MENU = [
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
     upsert_profile(u.id, u.full_name or "", u.username or "", (u.language_code or ""))
-    await _ensure_bot_menu_commands(context)
     intro = (
         "✨ Добро пожаловать в *AstroMagic* ✨\n\n"
         "Мы — команда практикующих астрологов, нумерологов и исследователей эзотерики.\n"
@@ -1471,7 +1672,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
     upsert_profile(u.id, u.full_name or "", u.username or "", (u.language_code or ""))
-    await _ensure_bot_menu_commands(context)
     intro = (
         "✨ Добро пожаловать в *AstroMagic* ✨\n\n"
         "Мы — команда практикующих астрологов, нумерологов и исследователей эзотерики.\n"
@@ -1493,7 +1693,6 @@ async def menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ud = context.user_data
     ud.clear()
-    await _ensure_bot_menu_commands(context)
 
     intro = (
         "✨ Добро пожаловать в *AstroMagic* ✨\n\n"
@@ -1513,6 +1712,80 @@ async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(intro, reply_markup=InlineKeyboardMarkup(MENU), parse_mode="Markdown")
 
 
+# --- /my_reports: повторная отправка готовых разборов без обращения к LLM ---
+MY_REPORTS_PAGE = 5
+
+def _my_reports_view(user_id: int, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    items, total = fetch_user_reports(user_id, limit=MY_REPORTS_PAGE, offset=page * MY_REPORTS_PAGE)
+    if not total:
+        return "Готовых разборов пока нет. Выбери услугу в главном меню.", BACK_MENU_KB
+    pages = (total + MY_REPORTS_PAGE - 1) // MY_REPORTS_PAGE
+    rows = []
+    for it in items:
+        try:
+            date = datetime.fromisoformat(it["created_at"]).strftime("%d.%m.%Y")
+        except (TypeError, ValueError):
+            date = ""
+        label = f"{REPORT_TITLES.get(it['kind'], 'Разбор')} · {date}" if date else REPORT_TITLES.get(it["kind"], "Разбор")
+        rows.append([InlineKeyboardButton(label, callback_data=f"myrep:send:{it['id']}")])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("← Новее", callback_data=f"myrep:page:{page - 1}"))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("Старее →", callback_data=f"myrep:page:{page + 1}"))
+    if nav:
+        rows.append(nav)
+    rows.append([InlineKeyboardButton("← В главное меню", callback_data="back_home")])
+    text = f"Твои разборы ({total}), стр. {page + 1}/{pages}. Нажми на разбор, чтобы получить его ещё раз:"
+    return text, InlineKeyboardMarkup(rows)
+
+async def my_reports_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text, kb = _my_reports_view(update.effective_user.id, 0)
+    await update.message.reply_text(text, reply_markup=kb)
+
+async def my_reports_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    _, action, arg = (q.data.split(":") + ["", ""])[:3]
+    try:
+        arg = int(arg)
+    except ValueError:
+        await q.answer()
+        return
+    if action == "page":
+        await q.answer()
+        text, kb = _my_reports_view(q.from_user.id, max(0, arg))
+        try:
+            await q.edit_message_text(text, reply_markup=kb)
+        except Exception:
+            await q.message.chat.send_message(text, reply_markup=kb)
+        return
+    if action != "send":
+        await q.answer()
+        return
+    order = fetch_order(arg)
+    if not order or order["user_id"] != q.from_user.id or order["status"] != "done":
+        await q.answer("Разбор не найден.", show_alert=True)
+        return
+    chat_id = q.message.chat.id
+    # Повторные нажатия, пока копия ещё в очереди, не ставят ещё одну
+    if outbox.has_pending(order["id"], chat_id):
+        await q.answer("Этот разбор уже отправляется.")
+        return
+    # Уже отрисованные сообщения из outbox; для старых заказов — рендер сохранённого отчёта
+    if not outbox.resend(order["id"], chat_id):
+        renderers = {
+            "llm_report": _iter_report_html,
+            "natal_llm_report": _iter_natal_report_html,
+            "palm_llm_report": _iter_palm_report_html,
+        }
+        kind = next((k for k in renderers if isinstance(order["meta"].get(k), dict)), None)
+        if not kind:
+            await q.answer("Текст этого разбора не сохранился.", show_alert=True)
+            return
+        _enqueue_report(chat_id, order["id"], renderers[kind](order["meta"][kind]))
+    await q.answer("Отправляю разбор…")
+
+
 # --- Whoami command handler ---
 async def whoami(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
@@ -1570,23 +1843,37 @@ async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Использование:\n/broadcast ТЕКСТ\nили ответьте командой /broadcast на сообщение, которое хотите разослать.")
         return
 
-    user_ids = fetch_all_user_ids()
-    if not user_ids:
+    if not fetch_all_user_ids():
         await update.message.reply_text("В базе нет пользователей для рассылки.")
         return
 
-    sent = 0; failed = 0
-    for uid in user_ids:
-        try:
-            await context.bot.send_message(chat_id=uid, text=msg)
-            sent += 1
-            # Небольшая пауза, чтобы не упереться в лимиты Telegram
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            failed += 1
-            log.warning("Broadcast to %s failed: %s", uid, e)
+    # Рассылка идёт в фоне (с общим лимитом скорости и курсором в БД), хендлер сразу освобождается
+    job_id = broadcast.create_job(msg, update.effective_chat.id)
+    status = await update.message.reply_text(broadcast.progress_text(broadcast.get_job(job_id)))
+    broadcast.set_status_message(job_id, status.message_id)
+    broadcast.start_job(context.bot, job_id)
 
-    await update.message.reply_text(f"Рассылка завершена. Отправлено: {sent}, ошибок: {failed}.")
+
+# --- Admin command: stop a running broadcast ---
+async def broadcast_cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    try:
+        admin_id_val = int(ADMIN_ID)
+    except Exception:
+        admin_id_val = 0
+    if not admin_id_val or int(u.id) != admin_id_val:
+        await update.message.reply_text("Недостаточно прав.")
+        return
+
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Использование: /broadcast_cancel ID")
+        return
+    job = broadcast.get_job(int(context.args[0]))
+    if not job or job["status"] != "running":
+        await update.message.reply_text("Активной рассылки с таким номером нет.")
+        return
+    broadcast.set_status(job["id"], "cancelled")
+    await update.message.reply_text(f"Рассылка #{job['id']} будет остановлена после текущей порции.")
 
 
 
@@ -1671,6 +1958,125 @@ async def stats_reset_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _set_meta("stats_reset_at", now)
     await update.message.reply_text(f"Точка отсчёта статистики обновлена на {now} UTC.")
 
+# --- Admin: /prompts (версии промптов и попадания в кэш провайдера) ---
+async def prompts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    try:
+        admin_id_val = int(ADMIN_ID)
+    except Exception:
+        admin_id_val = 0
+    if not admin_id_val or int(u.id) != admin_id_val:
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    await update.message.reply_text(prompts.report())
+
+# --- Admin: /llm_stats (ретраи и пропускная способность провайдеров) ---
+async def llm_stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    try:
+        admin_id_val = int(ADMIN_ID)
+    except Exception:
+        admin_id_val = 0
+    if not admin_id_val or int(u.id) != admin_id_val:
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    await update.message.reply_text(retry.report())
+
+# --- Admin: /updates_stats — задержка доставки апдейтов и очередь обработки ---
+async def updates_stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    try:
+        admin_id_val = int(ADMIN_ID)
+    except Exception:
+        admin_id_val = 0
+    if not admin_id_val or int(u.id) != admin_id_val:
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    text = webhook.report(BOT_MODE)
+    processor = context.application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        text += "\n\n" + processor.report()
+    text += "\n" + progress.GENERATION_QUEUE.report()
+    text += "\n" + antiflood.LIMITER.report()
+    text += "\n" + dedup.DEDUP.report()
+    await update.message.reply_text(text)
+
+# --- Admin: /api_stats — вызовы Bot API по хендлерам ---
+async def api_stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    try:
+        admin_id_val = int(ADMIN_ID)
+    except Exception:
+        admin_id_val = 0
+    if not admin_id_val or int(u.id) != admin_id_val:
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    await update.message.reply_text(api_budget.report())
+
+# --- Admin: /latency [часы] — перцентили этапов заказа по услугам ---
+PRODUCT_TITLES = {
+    "NUM_200": "🔢 Нумерология",
+    "PALM_300": "🪬 Хиромантия",
+    "NATAL_500": "🌌 Натальная карта",
+}
+
+async def latency_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    try:
+        admin_id_val = int(ADMIN_ID)
+    except Exception:
+        admin_id_val = 0
+    if not admin_id_val or int(u.id) != admin_id_val:
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    try:
+        hours = float(context.args[0]) if context.args else 24
+        hours = max(0.1, min(hours, 24 * 30))
+    except Exception:
+        hours = 24
+    await update.message.reply_text(tracing.report(hours, PRODUCT_TITLES))
+
+# --- Admin: /regen_batch <order_id> [...] — перегенерация отчётов через Batch API ---
+async def regen_batch_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    try:
+        admin_id_val = int(ADMIN_ID)
+    except Exception:
+        admin_id_val = 0
+    if not admin_id_val or int(u.id) != admin_id_val:
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    if not OPENAI_API_KEY:
+        await update.message.reply_text("Batch-режим недоступен: нет OPENAI_API_KEY.")
+        return
+
+    items, skipped = [], []
+    for arg in context.args or []:
+        try:
+            order = fetch_order(int(arg))
+        except ValueError:
+            order = None
+        item = _batch_item_for_order(order) if order else None
+        if item:
+            items.append(item)
+        else:
+            skipped.append(arg)
+    if not items:
+        await update.message.reply_text(
+            "Использование: /regen_batch ID [ID ...]\nПоддерживаются заказы нумерологии и натальной карты с введёнными данными.")
+        return
+
+    try:
+        bid = await batch.submit_batch(batch.OpenAIBatchClient(), items)
+    except Exception as e:
+        log.exception("Batch submit failed: %s", e)
+        await update.message.reply_text(f"Не удалось отправить батч: {e}")
+        return
+    text = f"Батч #{bid} отправлен: {len(items)} заказ(ов). Результаты придут пользователям после обработки."
+    if skipped:
+        text += "\nПропущены: " + ", ".join(skipped)
+    await update.message.reply_text(text)
+
 # Универсальная отправка инвойса в Stars
 async def send_stars_invoice(
     update_or_query, context: ContextTypes.DEFAULT_TYPE,
@@ -1734,10 +2140,6 @@ async def on_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         await send_service_text(q, caption_natal, "buy_natal", "Оплатить 220 ⭐")
     elif q.data == "back_home":
-        try:
-            await q.message.delete()
-        except Exception:
-            pass
         intro = (
             "✨ Добро пожаловать в *AstroMagic* ✨\n\n"
             "Мы — команда практикующих астрологов, нумерологов и исследователей эзотерики.\n"
@@ -1753,11 +2155,16 @@ async def on_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         if TEST_MODE:
             intro += "\n\n_Сейчас включён тестовый режим: оплата отключена, доступ выдаётся для проверки флоу._"
-        await q.message.chat.send_message(
-            intro,
-            reply_markup=InlineKeyboardMarkup(MENU),
-            parse_mode="Markdown",
-        )
+        # Один editMessageText вместо deleteMessage + sendMessage
+        try:
+            await q.edit_message_text(intro, reply_markup=InlineKeyboardMarkup(MENU), parse_mode="Markdown")
+        except Exception:
+            # Сообщение нельзя отредактировать (фото, слишком старое) — отправим новым
+            await q.message.chat.send_message(
+                intro,
+                reply_markup=InlineKeyboardMarkup(MENU),
+                parse_mode="Markdown",
+            )
     elif q.data == "buy_num":
         if TEST_MODE:
             await _begin_flow_after_payment("NUM_200", update, context)
@@ -1806,11 +2213,20 @@ async def on_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def precheckout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.pre_checkout_query.answer(ok=True)
 
+@tracing.traced("begin_flow")
 async def _begin_flow_after_payment(payload: str, update: Update, context: ContextTypes.DEFAULT_TYPE, charge_id: str | None = None):
     """Starts the appropriate dialog flow as if payment succeeded, and creates an order."""
     u = update.effective_user
     amount = AMOUNT_BY_PAYLOAD.get(payload, 0)
-    order_id = create_order(u.id, payload, amount, status="awaiting_input", charge_id=charge_id)
+    if charge_id and fetch_order_by_charge(charge_id):
+        log.warning(f"Payment {charge_id} already has an order, repeated delivery ignored")
+        return
+    try:
+        order_id = create_order(u.id, payload, amount, status="awaiting_input", charge_id=charge_id)
+    except sqlite3.IntegrityError:
+        log.warning(f"Payment {charge_id} already has an order, repeated delivery ignored")
+        return
+    tracing.bind(order_id)
     ud = context.user_data
     ud.clear()
     ud["order_id"] = order_id
@@ -1858,6 +2274,7 @@ async def _begin_flow_after_payment(payload: str, update: Update, context: Conte
 
     await update.effective_chat.send_message("Оплата получена ✅")
 
+@tracing.traced("payment")
 async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sp = update.message.successful_payment
     payload = sp.invoice_payload
@@ -1871,6 +2288,7 @@ async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     flow = ud.get("flow"); state = ud.get("state")
     if not flow:
         return
+    tracing.bind(ud.get("order_id"))
 
     # ---------- Обратная связь ----------
     if flow == "feedback" and state == FEEDBACK_WAIT:
@@ -1918,7 +2336,8 @@ async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ---------- Наталка ----------
     if flow == "natal":
         if state == NATAL_ALL:
-            ok, data = _parse_natal_all_input(text)
+            with tracing.span("input"):
+                ok, data = _parse_natal_all_input(text)
             if not ok:
                 await update.message.reply_text(str(data), parse_mode="Markdown")
                 return
@@ -1945,14 +2364,15 @@ async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             # Генерация подробного отчёта через LLM
             try:
-                await generate_and_send_natal_report(
-                    update, context,
-                    full_name=data["full_name"],
-                    date=data["natal_date"],
-                    time=data["natal_time"],
-                    city=data["natal_city"],
-                    order_id=order_id,
-                )
+                async with progress.GenerationStatus(context.bot, update.effective_chat.id, "Натальная карта"):
+                    await generate_and_send_natal_report(
+                        update, context,
+                        full_name=data["full_name"],
+                        date=data["natal_date"],
+                        time=data["natal_time"],
+                        city=data["natal_city"],
+                        order_id=order_id,
+                    )
             except Exception as e:
                 log.exception("Failed to generate Natal LLM report: %s", e)
             return
@@ -2050,48 +2470,42 @@ async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     dominant = "правая"
 
             ud["flow"] = None; ud["state"] = None
-            await update.message.reply_text("Готовлю разбор по ладони…", parse_mode="Markdown")
-
             try:
-                await generate_and_send_palm_report(
-                    update, context,
-                    full_name=update.effective_user.full_name,
-                    dominant_hand=dominant,
-                    user_context=ctx_text,
-                    tg_file_id=tg_file_id,
-                    order_id=order_id,
-                )
+                async with progress.GenerationStatus(context.bot, update.effective_chat.id, "Разбор по ладони"):
+                    await generate_and_send_palm_report(
+                        update, context,
+                        full_name=update.effective_user.full_name,
+                        dominant_hand=dominant,
+                        user_context=ctx_text,
+                        tg_file_id=tg_file_id,
+                        order_id=order_id,
+                        tg_file_unique_id=ud.get("palm_photo_unique_id"),
+                    )
             except Exception as e:
                 log.exception("Failed to generate Palm LLM report: %s", e)
             return
 
     # ---------- Нумерология ----------
     if flow == "num" and state == NUM_INPUT:
-        parts = text.split(maxsplit=1)
-        if len(parts) < 2 or not re.fullmatch(r"\d{2}\.\d{2}\.\d{4}", parts[0]):
-            await update.message.reply_text(
-                "Пожалуйста, укажи: `ДД.ММ.ГГГГ Имя Фамилия`.\nНапример: `07.03.1995 Анна Петрова`",
-                parse_mode="Markdown",
-            )
-            return
-        dob_str, full_name = parts[0], parts[1]
-        try:
-            _ = datetime.strptime(dob_str, "%d.%m.%Y")
-        except ValueError:
-            await update.message.reply_text("Дата выглядит некорректно. Проверь и пришли ещё раз.")
+        # ответ пользователю — вне спана: "input" меряет разбор и расчёт, а не сеть
+        with tracing.span("input"):
+            ok, data = _parse_num_input(text)
+            if ok:
+                dob_str, full_name = data
+                life_path = calc_life_path_ddmmyyyy(dob_str)
+                meaning = NUM_DESCRIPTIONS.get(life_path, "Личный путь и опыт через число судьбы.")
+
+                # Матрица Пифагора
+                counts = pythagoras_counts(dob_str)
+                grid_str = render_pythagoras_grid(counts)
+                line_totals = pythagoras_lines(counts)
+                lines_summary = render_pythagoras_summary(counts)
+                ext = extended_matrix_meta(counts)
+                digits_block = render_digit_interpretations(counts)
+        if not ok:
+            await update.message.reply_text(data, parse_mode="Markdown")
             return
 
-        life_path = calc_life_path_ddmmyyyy(dob_str)
-        meaning = NUM_DESCRIPTIONS.get(life_path, "Личный путь и опыт через число судьбы.")
-
-        # Матрица Пифагора
-        counts = pythagoras_counts(dob_str)
-        grid_str = render_pythagoras_grid(counts)
-        line_totals = pythagoras_lines(counts)
-        lines_summary = render_pythagoras_summary(counts)
-        ext = extended_matrix_meta(counts)
-        digits_block = render_digit_interpretations(counts)
-
         order_id = ud.get("order_id")
         if order_id:
             update_order(order_id, status="done", meta_merge={
@@ -2122,16 +2536,17 @@ async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         # Генерация подробного отчёта через GPT (параллельно после экспресс-вывода)
         try:
-            await generate_and_send_numerology_report(
-                update, context,
-                full_name=full_name,
-                dob=dob_str,
-                life_path=life_path,
-                counts=counts,
-                lines=line_totals,
-                ext=ext,
-                order_id=order_id,
-            )
+            async with progress.GenerationStatus(context.bot, update.effective_chat.id, "Полный разбор по нумерологии"):
+                await generate_and_send_numerology_report(
+                    update, context,
+                    full_name=full_name,
+                    dob=dob_str,
+                    life_path=life_path,
+                    counts=counts,
+                    lines=line_totals,
+                    ext=ext,
+                    order_id=order_id,
+                )
         except Exception as e:
             log.exception("Failed to generate LLM report: %s", e)
         return
@@ -2145,17 +2560,43 @@ async def photo_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not photos:
         return
     file_id = photos[-1].file_id
+    file_unique_id = photos[-1].file_unique_id
 
     order_id = ud.get("order_id")
+    tracing.bind(order_id)
+
+    # Быстрая локальная проверка качества: плохое фото не доходит до платного vision
+    # (без vision защищать нечего — текстовый разбор фото не смотрит, не отклоняем зря)
+    if PALM_QUALITY_GATE and _palm_vision_available():
+        try:
+            with tracing.span("input"):
+                data = await FILE_CACHE.get_bytes(context.bot, file_id, file_unique_id)
+                quality = await palm_image.check_quality(data)
+        except Exception as e:
+            log.warning("Palm photo download for quality check failed: %s", e)
+            quality = {"ok": True, "reasons": [], "metrics": {"error": str(e)}}
+        if not quality["ok"]:
+            if order_id:
+                update_order(order_id, meta_merge={"palm_quality_rejected": quality})
+            await update.message.reply_text(palm_quality.retake_hint(quality["reasons"]))
+            return
+
     if order_id:
         # держим статус ожидания ввода контекста, фото сохраняем в мету
         update_order(order_id, status="awaiting_input", meta_merge={"palm_photo_file_id": file_id})
 
     # Сохраним file_id и попросим короткий контекст
     ud["palm_photo_file_id"] = file_id
+    ud["palm_photo_unique_id"] = file_unique_id
     ud["state"] = PALM_CTX
     ud["flow"] = "palm"
 
+    # Пока пользователь пишет контекст, заранее качаем и готовим фото (и, опционально, разбор без контекста)
+    if PALM_PREFETCH and _palm_vision_available():
+        _start_palm_prefetch(
+            context.bot, update.effective_user.id, file_id, file_unique_id, update.effective_user.full_name,
+        )
+
     await update.message.reply_text(
         "Фото получено ✅\n\n"
         "Если хочешь — добавь пару строк контекста (возраст, ведущая рука, на что обратить внимание). "
@@ -2163,19 +2604,68 @@ async def photo_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown",
     )
 
+async def _post_init(app: Application):
+    # Системное меню команд ставим один раз при старте (и только если оно изменилось)
+    await _ensure_bot_menu_commands(app.bot)
+    # Прогреваем пул предобработки фото (детектор ладони грузится один раз на воркер)
+    if _palm_vision_available():
+        try:
+            await palm_image.warm_up()
+        except Exception as e:
+            log.warning("palm image warm-up failed: %s", e)
+    # Фоновые задачи, которые живут всё время работы бота
+    broadcast.resume_jobs(app.bot)
+    outbox.start(app.bot)
+    tracing.start()
+    dedup.start()
+    if OPENAI_API_KEY:
+        client = batch.OpenAIBatchClient()
+        batch.start(client, lambda item, content, body: _deliver_batch_result(app.bot, item, content, body))
+
+async def _post_shutdown(app: Application):
+    # сначала фоновые задачи: батч отдаёт результаты в outbox, отправки outbox пишут статусы и спаны
+    await batch.stop()
+    await outbox.stop()
+    # дописываем спаны, которые не успел сбросить фоновый flush
+    await tracing.stop()
+    await dedup.stop()
+
 def main():
     if not BOT_TOKEN:
         raise RuntimeError("Не найден BOT_TOKEN в окружении. Добавь его в .env или Railway Variables.")
 
     init_db()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .bot(api_budget.InstrumentedBot(
+            BOT_TOKEN,
+            base_url=TG_BASE_URL,
+            base_file_url=TG_BASE_FILE_URL,
+            request=HTTPXRequest(connection_pool_size=256),
+            get_updates_request=HTTPXRequest(),
+        ))
+        .update_queue(webhook.TimedUpdateQueue())
+        .concurrent_updates(PerUserUpdateProcessor())
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
+    # Замер задержки "апдейт пришёл -> хендлер" (в обоих режимах)
+    app.add_handler(TypeHandler(Update, webhook.track_update), group=-100)
+    # Повторно доставленные апдейты отбрасываем раньше всего остального
+    app.add_handler(TypeHandler(Update, dedup.guard), group=-95)
+    # Антифлуд — до всех остальных хендлеров
+    app.add_handler(TypeHandler(Update, antiflood.guard), group=-90)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("menu", menu_cmd))
     app.add_handler(CommandHandler("cancel", cancel_cmd))
     app.add_handler(CommandHandler("whoami", whoami))
     app.add_handler(CommandHandler("orders_last", orders_last))
     app.add_handler(CommandHandler("broadcast", broadcast_cmd))
+    app.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_cmd))
+    app.add_handler(CommandHandler("my_reports", my_reports_cmd))
+    app.add_handler(CallbackQueryHandler(my_reports_cb, pattern=r"^myrep:"))
     app.add_handler(CallbackQueryHandler(on_menu))
     app.add_handler(PreCheckoutQueryHandler(precheckout_handler))
     app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
@@ -2184,7 +2674,20 @@ def main():
     app.add_handler(CommandHandler("stats", stats_cmd))
     app.add_handler(CommandHandler("stats_today", stats_today_cmd))
     app.add_handler(CommandHandler("stats_reset", stats_reset_cmd))
-
+    app.add_handler(CommandHandler("prompts", prompts_cmd))
+    app.add_handler(CommandHandler("llm_stats", llm_stats_cmd))
+    app.add_handler(CommandHandler("regen_batch", regen_batch_cmd))
+    app.add_handler(CommandHandler("updates_stats", updates_stats_cmd))
+    app.add_handler(CommandHandler("api_stats", api_stats_cmd))
+    app.add_handler(CommandHandler("latency", latency_cmd))
+
+    # Учёт вызовов Bot API по хендлерам — после регистрации всех хендлеров
+    api_budget.instrument(app)
+
+    if BOT_MODE == "webhook":
+        log.info("Bot is starting in webhook mode...")
+        asyncio.run(webhook.serve(app))
+        return
     log.info("Bot is starting with long polling...")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
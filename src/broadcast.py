@@ -0,0 +1,258 @@
+# src/broadcast.py
+"""
+Resumable admin broadcasts.
+
+A broadcast is a row in `broadcast_jobs` with a cursor over profiles.user_id. The runner
+reads recipients page by page (ascending user_id), fans each page out to
+BROADCAST_WORKERS concurrent senders that share the global Telegram token bucket
+(src.ratelimit), and persists the cursor and counters after every page, so a redeploy
+resumes from the last finished page (at most one page can be delivered twice).
+
+RetryAfter pauses the whole bucket and retries the same user; Forbidden ("bot was
+blocked") and "chat not found" mark the profile as blocked, so later broadcasts skip it
+(the mark is cleared when the user writes to the bot again). Progress is shown live by
+editing the admin's status message every BROADCAST_PROGRESS_S seconds.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from .config import BROADCAST_WORKERS, BROADCAST_PAGE_SIZE, BROADCAST_PROGRESS_S, BROADCAST_MAX_ATTEMPTS
+from .ratelimit import TELEGRAM_BUCKET, retry_after_seconds
+from .storage import _conn
+
+log = logging.getLogger("astro-num-bot.broadcast")
+
+_FIELDS = (
+    "id", "text", "status", "cursor", "total", "sent", "failed", "blocked",
+    "admin_chat_id", "status_message_id", "created_at", "updated_at",
+)
+
+# job_id -> asyncio.Task выполняющейся рассылки
+_running: dict[int, asyncio.Task] = {}
+
+
+def init_broadcast_db():
+    con = _conn(); cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_jobs(
+        id                INTEGER PRIMARY KEY AUTOINCREMENT,
+        text              TEXT,
+        status            TEXT,
+        cursor            INTEGER DEFAULT 0,
+        total             INTEGER DEFAULT 0,
+        sent              INTEGER DEFAULT 0,
+        failed            INTEGER DEFAULT 0,
+        blocked           INTEGER DEFAULT 0,
+        admin_chat_id     INTEGER,
+        status_message_id INTEGER,
+        created_at        TEXT,
+        updated_at        TEXT
+    )""")
+    # Отметка "бот заблокирован" у профиля — такие пользователи в рассылки не попадают
+    cur.execute("PRAGMA table_info(profiles)")
+    if "blocked_at" not in {row[1] for row in cur.fetchall()}:
+        cur.execute("ALTER TABLE profiles ADD COLUMN blocked_at TEXT")
+    con.commit(); con.close()
+
+
+def create_job(text: str, admin_chat_id: int) -> int:
+    now = datetime.utcnow().isoformat()
+    con = _conn(); cur = con.cursor()
+    cur.execute("SELECT COUNT(*) FROM profiles WHERE blocked_at IS NULL")
+    total = cur.fetchone()[0] or 0
+    cur.execute(
+        """INSERT INTO broadcast_jobs(text, status, cursor, total, admin_chat_id, created_at, updated_at)
+           VALUES(?, 'running', 0, ?, ?, ?, ?)""",
+        (text, total, admin_chat_id, now, now),
+    )
+    job_id = cur.lastrowid
+    con.commit(); con.close()
+    return job_id
+
+
+def get_job(job_id: int) -> dict | None:
+    con = _conn(); cur = con.cursor()
+    cur.execute(f"SELECT {', '.join(_FIELDS)} FROM broadcast_jobs WHERE id=?", (job_id,))
+    row = cur.fetchone()
+    con.close()
+    return dict(zip(_FIELDS, row)) if row else None
+
+
+def _save_job(job: dict):
+    con = _conn(); cur = con.cursor()
+    cur.execute(
+        """UPDATE broadcast_jobs SET status=?, cursor=?, sent=?, failed=?, blocked=?, status_message_id=?, updated_at=?
+           WHERE id=?""",
+        (job["status"], job["cursor"], job["sent"], job["failed"], job["blocked"],
+         job["status_message_id"], datetime.utcnow().isoformat(), job["id"]),
+    )
+    con.commit(); con.close()
+
+
+def set_status_message(job_id: int, message_id: int):
+    con = _conn(); cur = con.cursor()
+    cur.execute("UPDATE broadcast_jobs SET status_message_id=? WHERE id=?", (message_id, job_id))
+    con.commit(); con.close()
+
+
+def set_status(job_id: int, status: str):
+    con = _conn(); cur = con.cursor()
+    cur.execute("UPDATE broadcast_jobs SET status=?, updated_at=? WHERE id=?",
+                (status, datetime.utcnow().isoformat(), job_id))
+    con.commit(); con.close()
+
+
+def _next_page(cursor: int, size: int) -> list[int]:
+    con = _conn(); cur = con.cursor()
+    cur.execute(
+        "SELECT user_id FROM profiles WHERE user_id>? AND blocked_at IS NULL ORDER BY user_id ASC LIMIT ?",
+        (cursor, size),
+    )
+    rows = cur.fetchall()
+    con.close()
+    return [r[0] for r in rows if r and r[0]]
+
+
+def _mark_blocked(user_ids: list[int]):
+    if not user_ids:
+        return
+    now = datetime.utcnow().isoformat()
+    con = _conn(); cur = con.cursor()
+    cur.executemany("UPDATE profiles SET blocked_at=? WHERE user_id=?", [(now, uid) for uid in user_ids])
+    con.commit(); con.close()
+
+
+async def _send_one(bot, chat_id: int, text: str) -> str:
+    """Returns 'sent' | 'blocked' | 'failed'."""
+    for _ in range(BROADCAST_MAX_ATTEMPTS):
+        await TELEGRAM_BUCKET.acquire()
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+            return "sent"
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+            log.warning("Broadcast hit flood limit, pausing %.1fs", delay)
+            TELEGRAM_BUCKET.pause(delay)
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "blocked"
+            log.warning("Broadcast to %s failed: %s", chat_id, e)
+            return "failed"
+        except TelegramError as e:
+            # сетевые сбои и таймауты — пробуем ещё раз
+            log.warning("Broadcast to %s failed: %s", chat_id, e)
+    return "failed"
+
+
+def progress_text(job: dict) -> str:
+    done = job["sent"] + job["failed"] + job["blocked"]
+    total = max(job["total"], done)
+    pct = (100 * done // total) if total else 100
+    status = {
+        "running": "идёт", "done": "завершена", "cancelled": "остановлена",
+    }.get(job["status"], job["status"])
+    text = (
+        f"Рассылка #{job['id']} — {status}\n"
+        f"Обработано: {done}/{total} ({pct}%)\n"
+        f"Отправлено: {job['sent']}, ошибок: {job['failed']}, заблокировали бота: {job['blocked']}"
+    )
+    if TELEGRAM_BUCKET.paused_for > 0:
+        text += f"\nПауза по лимиту Telegram: {TELEGRAM_BUCKET.paused_for:.0f}s"
+    return text
+
+
+async def _report_progress(bot, job: dict):
+    text = progress_text(job)
+    try:
+        if job["status_message_id"]:
+            await bot.edit_message_text(text, chat_id=job["admin_chat_id"], message_id=job["status_message_id"])
+        else:
+            msg = await bot.send_message(chat_id=job["admin_chat_id"], text=text)
+            job["status_message_id"] = msg.message_id
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            log.warning("Broadcast progress update failed: %s", e)
+    except TelegramError as e:
+        log.warning("Broadcast progress update failed: %s", e)
+
+
+async def run_job(bot, job_id: int):
+    job = get_job(job_id)
+    if not job or job["status"] != "running":
+        return
+    queue: asyncio.Queue = asyncio.Queue()
+    results: dict[int, str] = {}
+
+    async def worker():
+        while True:
+            uid = await queue.get()
+            try:
+                results[uid] = await _send_one(bot, uid, job["text"])
+            except Exception as e:
+                log.warning("Broadcast to %s failed: %s", uid, e)
+                results[uid] = "failed"
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+    last_report = 0.0
+    try:
+        while True:
+            if (get_job(job_id) or {}).get("status") != "running":
+                job["status"] = "cancelled"
+                break
+            page = _next_page(job["cursor"], BROADCAST_PAGE_SIZE)
+            if not page:
+                job["status"] = "done"
+                break
+            results.clear()
+            for uid in page:
+                queue.put_nowait(uid)
+            await queue.join()
+            blocked = [uid for uid, r in results.items() if r == "blocked"]
+            _mark_blocked(blocked)
+            job["sent"] += sum(1 for r in results.values() if r == "sent")
+            job["failed"] += sum(1 for r in results.values() if r == "failed")
+            job["blocked"] += len(blocked)
+            job["cursor"] = page[-1]
+            _save_job(job)
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_S:
+                await _report_progress(bot, job)
+                _save_job(job)
+                last_report = time.monotonic()
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    _save_job(job)
+    await _report_progress(bot, job)
+    log.info("Broadcast #%s %s: sent=%s failed=%s blocked=%s",
+             job_id, job["status"], job["sent"], job["failed"], job["blocked"])
+
+
+def start_job(bot, job_id: int) -> asyncio.Task:
+    task = _running.get(job_id)
+    if task and not task.done():
+        return task
+    task = asyncio.get_running_loop().create_task(run_job(bot, job_id))
+    _running[job_id] = task
+    task.add_done_callback(lambda t: _running.pop(job_id, None))
+    return task
+
+
+def resume_jobs(bot) -> list[int]:
+    """Restart every job left 'running' by a previous process (called from post_init)."""
+    con = _conn(); cur = con.cursor()
+    cur.execute("SELECT id FROM broadcast_jobs WHERE status='running' ORDER BY id")
+    ids = [r[0] for r in cur.fetchall()]
+    con.close()
+    for job_id in ids:
+        log.info("Resuming broadcast #%s", job_id)
+        start_job(bot, job_id)
+    return ids
@@ -0,0 +1,152 @@
+# src/cassette.py
+"""
+Record/replay of LLM provider traffic.
+
+LLM_CASSETTE_MODE=record  — every provider call is performed for real and the
+                            request/response pair is appended to a gzip fixture.
+LLM_CASSETTE_MODE=replay  — calls never hit the network; the response is served
+                            from the fixture with the same request hash.
+
+Fixtures live in LLM_CASSETTE_DIR as <hash>.json.gz, one file per distinct request.
+Repeated identical requests are stored as a list and replayed in the same order
+(the last one is repeated once the list is exhausted), so retries/fallbacks replay
+deterministically. API keys, bot tokens and inline image payloads are redacted
+before hashing and storing. LLM_CASSETTE_TIME_SCALE scales the recorded latency on
+replay (1.0 = original timing, 0 = instant).
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from .config import LLM_CASSETTE_MODE, LLM_CASSETTE_DIR, LLM_CASSETTE_TIME_SCALE
+
+log = logging.getLogger("astro-num-bot.cassette")
+
+# Заголовки ответа, которые имеет смысл сохранять (остальные — шум)
+_KEEP_HEADERS = ("content-type", "retry-after")
+_BOT_TOKEN_RE = re.compile(r"/bot\d+:[A-Za-z0-9_-]+/")
+_ENDPOINT_RE = re.compile(r"/v\d+(?:beta)?/(.+)$")
+_DATA_URI_RE = re.compile(r"^data:([^;,]+)(;base64)?,(.*)$", re.DOTALL)
+
+_lock = threading.Lock()
+_replay_pos: dict[str, int] = {}
+
+
+class CassetteMiss(RuntimeError):
+    """No recorded interaction for the request in replay mode."""
+
+
+class CassetteResponse:
+    """Minimal stand-in for requests.Response used by the provider helpers."""
+
+    def __init__(self, status_code: int, text: str, headers: dict | None = None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _redact(value):
+    if isinstance(value, dict):
+        return {k: _redact(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact(v) for v in value]
+    if isinstance(value, str):
+        m = _DATA_URI_RE.match(value)
+        if m:
+            # Картинку не храним целиком: в ключ идёт только её хэш
+            digest = hashlib.sha256(m.group(3).encode()).hexdigest()[:16]
+            return f"data:{m.group(1)};sha256={digest}"
+        return _BOT_TOKEN_RE.sub("/bot<redacted>/", value)
+    return value
+
+
+def _strip_url(url: str) -> str:
+    """Keep only the endpoint after the API version, so fixtures recorded against one base URL replay against another."""
+    path = url.split("?", 1)[0]
+    m = _ENDPOINT_RE.search(path)
+    return m.group(1) if m else _BOT_TOKEN_RE.sub("/bot<redacted>/", re.sub(r"^[a-z]+://[^/]+", "", path))
+
+
+def request_key(provider: str, url: str, payload: dict) -> str:
+    canon = json.dumps(
+        {"provider": provider, "path": _strip_url(url), "payload": _redact(payload)},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+
+def _path_for(key: str) -> str:
+    return os.path.join(LLM_CASSETTE_DIR, f"{key}.json.gz")
+
+
+def _load(key: str) -> dict | None:
+    path = _path_for(key)
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def record(provider: str, url: str, payload: dict, *, status_code: int, text: str,
+           headers: dict | None, elapsed_s: float) -> None:
+    key = request_key(provider, url, payload)
+    interaction = {
+        "status_code": status_code,
+        "headers": {k.lower(): v for k, v in (headers or {}).items() if k.lower() in _KEEP_HEADERS},
+        "text": text,
+        "elapsed_s": round(elapsed_s, 4),
+        "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    with _lock:
+        os.makedirs(LLM_CASSETTE_DIR, exist_ok=True)
+        data = _load(key) or {
+            "provider": provider,
+            "path": _strip_url(url),
+            "request": _redact(payload),
+            "interactions": [],
+        }
+        data["interactions"].append(interaction)
+        tmp = _path_for(key) + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, _path_for(key))
+    log.info("cassette: recorded %s %s -> %s (%.2fs)", provider, key[:12], status_code, elapsed_s)
+
+
+async def replay(provider: str, url: str, payload: dict) -> CassetteResponse:
+    key = request_key(provider, url, payload)
+    data = await asyncio.to_thread(_load, key)
+    if not data or not data.get("interactions"):
+        raise CassetteMiss(f"cassette miss for {provider} {_strip_url(url)} ({key[:12]})")
+    with _lock:
+        pos = _replay_pos.get(key, 0)
+        _replay_pos[key] = pos + 1
+    items = data["interactions"]
+    it = items[min(pos, len(items) - 1)]
+    delay = float(it.get("elapsed_s") or 0.0) * LLM_CASSETTE_TIME_SCALE
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return CassetteResponse(int(it["status_code"]), it.get("text", ""), it.get("headers") or {})
+
+
+def reset_replay_positions() -> None:
+    """Start every fixture from its first interaction again (e.g. between benchmark runs)."""
+    with _lock:
+        _replay_pos.clear()
+
+
+def is_recording() -> bool:
+    return LLM_CASSETTE_MODE == "record"
+
+
+def is_replaying() -> bool:
+    return LLM_CASSETTE_MODE == "replay"
@@ -13,6 +13,111 @@ PALM_VISION = os.getenv("PALM_VISION", "off").lower() == "on"
 VISION_PROVIDER = os.getenv("VISION_PROVIDER", "mistral")
 MISTRAL_VISION_MODEL = os.getenv("MISTRAL_VISION_MODEL", "pixtral-12b")
 
+# Базовые URL провайдеров LLM (можно направить на локальный стенд: python -m src.mock_llm)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+MISTRAL_BASE_URL = os.getenv("MISTRAL_BASE_URL", "https://api.mistral.ai/v1").rstrip("/")
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+
+# Адрес Bot API (можно направить на локальный стенд: python -m src.mock_telegram)
+TG_BASE_URL = os.getenv("TG_BASE_URL", "https://api.telegram.org/bot")
+TG_BASE_FILE_URL = os.getenv("TG_BASE_FILE_URL", "https://api.telegram.org/file/bot")
+
+# Запись/воспроизведение трафика провайдеров: off | record | replay
+LLM_CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "off").lower()
+LLM_CASSETTE_DIR = os.getenv("LLM_CASSETTE_DIR", "fixtures/cassettes")
+# Масштаб задержек при воспроизведении: 1.0 — как записано, 0 — мгновенно
+LLM_CASSETTE_TIME_SCALE = float(os.getenv("LLM_CASSETTE_TIME_SCALE", "1.0"))
+
+# Повторы запросов к LLM при 429/503 (переопределяются по провайдеру: OPENAI_RETRY_MAX и т.п.)
+LLM_REQUEST_DEADLINE_S = float(os.getenv("LLM_REQUEST_DEADLINE_S", "120"))
+LLM_RETRY_MAX = int(os.getenv("LLM_RETRY_MAX", "2"))
+LLM_RETRY_BASE_S = float(os.getenv("LLM_RETRY_BASE_S", "0.5"))
+LLM_RETRY_CAP_S = float(os.getenv("LLM_RETRY_CAP_S", "8"))
+LLM_RETRY_AFTER_MAX_S = float(os.getenv("LLM_RETRY_AFTER_MAX_S", "20"))
+
+# Пакетная (отложенная) генерация отчётов через Batch API провайдера
+LLM_BATCH_MODEL = os.getenv("LLM_BATCH_MODEL", "gpt-4.1-mini")
+LLM_BATCH_POLL_S = float(os.getenv("LLM_BATCH_POLL_S", "60"))
+
+# Кэш файлов Telegram (фото ладоней): TTL для file_path и лимит байтов в памяти
+TG_FILE_PATH_TTL_S = float(os.getenv("TG_FILE_PATH_TTL_S", "3000"))
+TG_FILE_CACHE_MAX_MB = float(os.getenv("TG_FILE_CACHE_MAX_MB", "64"))
+
+# Предобработка фото ладони перед vision: максимальная сторона, режим (auto|color|gray|autocontrast), формат
+PALM_IMAGE_MAX_SIDE = int(os.getenv("PALM_IMAGE_MAX_SIDE", "1024"))
+PALM_IMAGE_MODE = os.getenv("PALM_IMAGE_MODE", "auto").lower()
+PALM_IMAGE_FORMAT = os.getenv("PALM_IMAGE_FORMAT", "jpeg").lower()
+PALM_IMAGE_QUALITY = int(os.getenv("PALM_IMAGE_QUALITY", "82"))
+PALM_IMAGE_WORKERS = int(os.getenv("PALM_IMAGE_WORKERS", "2"))
+# Обрезка фото по области ладони (mediapipe или сегментация кожи) и поля вокруг рамки
+PALM_CROP = os.getenv("PALM_CROP", "on").lower() == "on"
+PALM_CROP_MARGIN = float(os.getenv("PALM_CROP_MARGIN", "0.12"))
+# Проверка качества фото до платного vision-вызова: разрешение, резкость, экспозиция, наличие руки
+# (работает только при включённом vision)
+PALM_QUALITY_GATE = os.getenv("PALM_QUALITY_GATE", "on").lower() == "on"
+PALM_MIN_SIDE = int(os.getenv("PALM_MIN_SIDE", "400"))
+PALM_BLUR_MIN_VAR = float(os.getenv("PALM_BLUR_MIN_VAR", "40"))
+PALM_HAND_MIN_SCORE = float(os.getenv("PALM_HAND_MIN_SCORE", "0.15"))
+# Кэш vision-разборов по перцептивному хэшу фото: порог расстояния Хэмминга, лимит строк, срок жизни
+PALM_CACHE = os.getenv("PALM_CACHE", "on").lower() == "on"
+PALM_CACHE_MAX_DIST = int(os.getenv("PALM_CACHE_MAX_DIST", "6"))
+PALM_CACHE_MAX_ROWS = int(os.getenv("PALM_CACHE_MAX_ROWS", "5000"))
+PALM_CACHE_TTL_DAYS = float(os.getenv("PALM_CACHE_TTL_DAYS", "30"))
+# Подготовка фото, пока пользователь пишет контекст; PALM_PREFETCH_VISION — ещё и разбор без контекста (лишний вызов, если контекст будет)
+PALM_PREFETCH = os.getenv("PALM_PREFETCH", "on").lower() == "on"
+PALM_PREFETCH_VISION = os.getenv("PALM_PREFETCH_VISION", "off").lower() == "on"
+PALM_PREFETCH_TTL_S = float(os.getenv("PALM_PREFETCH_TTL_S", "900"))
+
+# Общий лимит отправки сообщений ботом (Telegram: ~30 сообщений/с на бота)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_GLOBAL_BURST = float(os.getenv("TG_GLOBAL_BURST", "30"))
+# Рассылки: число параллельных отправителей, размер страницы (шаг сохранения курсора), частота обновления прогресса
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+BROADCAST_PROGRESS_S = float(os.getenv("BROADCAST_PROGRESS_S", "5"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5"))
+
+# Режим получения апдейтов: polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Публичный адрес для вебхука (без пути); пусто — сервер слушает локально, вебхук не регистрируется
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Параллельная обработка апдейтов (апдейты одного пользователя — строго по очереди):
+# сколько хендлеров работает одновременно и сколько апдейтов может ждать
+UPDATES_CONCURRENCY = int(os.getenv("UPDATES_CONCURRENCY", "64"))
+UPDATES_PENDING_MAX = int(os.getenv("UPDATES_PENDING_MAX", "1024"))
+
+# Доставка отчётов через outbox: попыток на сообщение и сколько чатов обслуживаем параллельно
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "16"))
+
+# Генерация отчётов: сколько идёт одновременно (остальные ждут в очереди и видят свою позицию),
+# как часто обновлять "печатает…" и не чаще какого интервала редактировать статус
+GEN_CONCURRENCY = int(os.getenv("GEN_CONCURRENCY", "16"))
+TYPING_INTERVAL_S = float(os.getenv("TYPING_INTERVAL_S", "4.5"))
+STATUS_EDIT_MIN_S = float(os.getenv("STATUS_EDIT_MIN_S", "3"))
+
+# Антифлуд: бюджеты "класс=сообщений/секунд" на пользователя (класс flow:<имя> — ответы внутри сценария)
+# и сколько пользователей держим в памяти (давно молчавшие вытесняются первыми)
+FLOOD_LIMITS = os.getenv(
+    "FLOOD_LIMITS",
+    "command=6/30,callback=20/30,text=8/30,photo=4/60,flow=10/60,flow:natal=12/120,flow:feedback=3/300",
+)
+FLOOD_MAX_USERS = int(os.getenv("FLOOD_MAX_USERS", "20000"))
+
+# Защита от повторной доставки апдейтов: сколько последних update_id помним (в памяти и в SQLite)
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "10000"))
+
+# Трассировка этапов заказа (/latency): спаны пишутся пачками раз в TRACE_FLUSH_S или по TRACE_FLUSH_BATCH штук
+TRACE_FLUSH_BATCH = int(os.getenv("TRACE_FLUSH_BATCH", "200"))
+TRACE_FLUSH_S = float(os.getenv("TRACE_FLUSH_S", "5"))
+TRACE_RETENTION_DAYS = int(os.getenv("TRACE_RETENTION_DAYS", "30"))
+
 
 
 
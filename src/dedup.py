@@ -0,0 +1,152 @@
+# src/dedup.py
+"""
+Drop redelivered updates before any handler work.
+
+After a crash or redeploy Telegram delivers again every update whose offset was not yet
+confirmed (polling) or whose webhook call did not return 200. Without a guard a repeated
+successful_payment starts the flow a second time and a repeated input message orders a
+second LLM report.
+
+`guard` is a TypeHandler in group -95 (before the anti-flood group, so duplicates do not
+spend the user's budget). The last DEDUP_WINDOW update_ids are kept in memory (set +
+deque, O(1) lookups) and in the `processed_updates` table, which is loaded back on start.
+Only membership in the window counts: update_ids are not guaranteed to grow (Telegram
+picks a random one after a week of silence, the local mock starts from 1 again).
+An update is marked as processed when it arrives: processing is at-most-once, which is
+what payments and LLM calls need. The table is written by a background task (`run`)
+once per _FLUSH_S in one transaction, off the event loop; a crash loses at most the ids
+of that last second.
+
+Payments are additionally idempotent by telegram_payment_charge_id: orders.charge_id has
+a unique index and `_begin_flow_after_payment` ignores a charge that already has an order.
+"""
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from .config import DEDUP_WINDOW
+from .storage import _conn
+
+log = logging.getLogger("astro-num-bot.dedup")
+
+_FLUSH_S = 1.0
+_task: asyncio.Task | None = None
+
+
+def init_dedup_db():
+    con = _conn(); cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS processed_updates(
+        update_id  INTEGER PRIMARY KEY,
+        seen_at    TEXT
+    )""")
+    con.commit(); con.close()
+
+
+class UpdateDeduplicator:
+    def __init__(self, window: int = DEDUP_WINDOW):
+        self.window = window
+        self._ids: set[int] = set()
+        self._order: deque[int] = deque()
+        self._pending: list[tuple[int, str]] = []
+        self._loaded = False
+        self.duplicates = 0
+
+    def load(self):
+        """Restore the window from SQLite (called once, lazily)."""
+        con = _conn(); cur = con.cursor()
+        cur.execute("SELECT update_id FROM processed_updates ORDER BY seen_at DESC LIMIT ?", (self.window,))
+        ids = [r[0] for r in cur.fetchall()]
+        con.close()
+        for uid in reversed(ids):
+            self._remember(uid)
+        self._loaded = True
+
+    def _remember(self, update_id: int):
+        self._ids.add(update_id)
+        self._order.append(update_id)
+        while len(self._order) > self.window:
+            self._ids.discard(self._order.popleft())
+
+    def seen(self, update_id: int) -> bool:
+        """True if the update was already processed; otherwise records it and returns False."""
+        if not self._loaded:
+            self.load()
+        if update_id in self._ids:
+            self.duplicates += 1
+            return True
+        self._remember(update_id)
+        self._pending.append((update_id, datetime.utcnow().isoformat()))
+        return False
+
+    def flush(self):
+        """Write pending ids in one transaction and trim the table to the window."""
+        if not self._pending:
+            return
+        # подмена списка, а не copy+clear: seen() может дописать id, пока мы в потоке
+        rows, self._pending = self._pending, []
+        try:
+            con = _conn(); cur = con.cursor()
+            # REPLACE: id, повторно выданный после сброса нумерации, получает свежий seen_at
+            cur.executemany("INSERT OR REPLACE INTO processed_updates(update_id, seen_at) VALUES(?, ?)", rows)
+            cur.execute(
+                """DELETE FROM processed_updates WHERE seen_at <
+                   (SELECT seen_at FROM processed_updates ORDER BY seen_at DESC LIMIT 1 OFFSET ?)""",
+                (self.window - 1,),
+            )
+            con.commit(); con.close()
+        except Exception as e:
+            log.warning("Failed to store %s update ids: %s", len(rows), e)
+
+    def report(self) -> str:
+        return f"Дедупликация: окно {len(self._ids)}/{self.window}, отброшено повторов {self.duplicates}"
+
+
+DEDUP = UpdateDeduplicator()
+
+
+async def run():
+    while True:
+        await asyncio.sleep(_FLUSH_S)
+        writing = asyncio.ensure_future(asyncio.to_thread(DEDUP.flush))
+        try:
+            await asyncio.shield(writing)
+        except asyncio.CancelledError:
+            # отмена не останавливает поток — дожидаемся записи, чтобы stop() не писал параллельно
+            await writing
+            raise
+
+
+def start() -> asyncio.Task:
+    global _task
+    if not DEDUP._loaded:
+        DEDUP.load()
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(run())
+    return _task
+
+
+async def stop():
+    """Cancel the background writer, wait for it to end, then store what is pending."""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    DEDUP.flush()
+
+
+async def guard(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Group -95 TypeHandler: stops a repeated update before any other handler sees it."""
+    if not isinstance(update, Update):
+        return
+    if DEDUP.seen(update.update_id):
+        log.warning("Duplicate update %s dropped", update.update_id)
+        raise ApplicationHandlerStop
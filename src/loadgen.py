@@ -0,0 +1,339 @@
+# src/loadgen.py
+"""
+Synthetic traffic for the whole bot: virtual users walk through real purchase flows.
+
+The generator embeds src.mock_telegram (same process, so it sees every reply the bot
+sends to a chat) and injects updates for virtual users; the bot under test runs against
+it via TG_BASE_URL. Each user picks a scenario from --mix:
+  - num:   /start → "num" → "buy_num" (TEST_MODE purchase) → "ДД.ММ.ГГГГ Имя Фамилия";
+  - natal: /start → "natal" → "buy_natal" → 4-line input (validated with the bot's own
+           _parse_natal_all_input before sending);
+  - palm:  /start → "palm" → "buy_palm" → photo → short context.
+Users arrive as a Poisson process whose rate follows --profile (constant, ramp, step,
+spike) up to --rate users/s; --max-active caps concurrent users, --think-ms adds an
+exponential pause between steps.
+
+Reported per scenario and overall: p50/p95/p99 of update → first reply (every step)
+and of final input → report complete (the back-to-menu message after the report),
+throughput (updates/s, completed flows/s) and error rate (flows that timed out or got an
+error reply).
+
+    python -m src.mock_llm --port 8089 &
+    python -m src.loadgen --spawn-bot --llm-url http://127.0.0.1:8089 --rate 5 --duration 60 --profile ramp
+    # или бот уже запущен с TG_BASE_URL=http://127.0.0.1:8081/bot:
+    python -m src.loadgen --port 8081 --rate 2 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+from . import mock_telegram
+from .bot import _parse_natal_all_input
+
+# видимые ответы бота (answerCallbackQuery и "печатает…" ответом не считаем)
+_REPLY_METHODS = {"sendMessage", "editMessageText", "sendInvoice"}
+_DONE_MARK = "Можешь вернуться в главное меню"
+# начала сообщений об ошибках, которые шлёт бот (src/bot.py, src/antiflood.py)
+_ERROR_PREFIXES = (
+    "Во время генерации",
+    "Не удалось собрать",
+    "Не удалось распарсить отчёт LLM",
+    "(Подробный отчёт временно недоступен",
+    "Слишком много запросов подряд",
+)
+
+_NAMES = ["Анна Петрова", "Иван Смирнов", "Мария Кузнецова", "Олег Попов", "Елена Васильева", "Дмитрий Новиков"]
+_CITIES = ["Омск, Россия", "Москва, Россия", "Казань, Россия", "Минск, Беларусь", "Алматы, Казахстан"]
+
+
+class FlowError(Exception):
+    pass
+
+
+@dataclass
+class Metrics:
+    first_reply_ms: dict[str, list[float]] = field(default_factory=dict)
+    report_ms: dict[str, list[float]] = field(default_factory=dict)
+    started: dict[str, int] = field(default_factory=dict)
+    completed: dict[str, int] = field(default_factory=dict)
+    errors: dict[str, dict[str, int]] = field(default_factory=dict)
+    updates: int = 0
+
+    def add(self, bucket: dict, scenario: str, value):
+        bucket.setdefault(scenario, []).append(value)
+
+    def inc(self, bucket: dict, scenario: str):
+        bucket[scenario] = bucket.get(scenario, 0) + 1
+
+    def error(self, scenario: str, kind: str):
+        e = self.errors.setdefault(scenario, {})
+        e[kind] = e.get(kind, 0) + 1
+
+
+def _pct(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class VirtualUser:
+    def __init__(self, mock: mock_telegram.MockTelegram, user_id: int, scenario: str, metrics: Metrics,
+                 rng: random.Random, timeout_s: float, think_ms: float):
+        self.mock = mock
+        self.user_id = user_id
+        self.scenario = scenario
+        self.metrics = metrics
+        self.rng = rng
+        self.timeout_s = timeout_s
+        self.think_ms = think_ms
+        self.replies: asyncio.Queue = asyncio.Queue()
+
+    def observe(self, record: dict):
+        # ответы в наш чат (у editMessageText тоже есть chat_id)
+        if record["method"] in _REPLY_METHODS and str(record["params"].get("chat_id")) == str(self.user_id):
+            self.replies.put_nowait((time.monotonic(), record))
+
+    async def _think(self):
+        if self.think_ms:
+            await asyncio.sleep(self.rng.expovariate(1000.0 / self.think_ms))
+
+    async def step(self, spec: dict, *, until: str | None = None) -> float:
+        """Send an update, wait for the first reply (and for a reply containing `until`)."""
+        while not self.replies.empty():
+            self.replies.get_nowait()
+        t0 = time.monotonic()
+        self.mock.push(self.mock.build_update({"user_id": self.user_id, **spec}))
+        self.metrics.updates += 1
+        deadline = t0 + self.timeout_s
+        first = None
+        while True:
+            try:
+                t, record = await asyncio.wait_for(self.replies.get(), timeout=max(0.01, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                raise FlowError("timeout")
+            if record["status"] == 429:
+                # отправитель может повторить (outbox); не повторит — сработает таймаут
+                continue
+            if record["status"] != 200:
+                raise FlowError(f"http_{record['status']}")
+            text = record["params"].get("text") or ""
+            # чанки отчёта (HTML из outbox) не проверяем: в тексте LLM вполне может быть «ошибками»
+            if (record["params"].get("parse_mode") or "").upper() != "HTML" and text.startswith(_ERROR_PREFIXES):
+                raise FlowError("error_reply")
+            if first is None:
+                first = t
+                self.metrics.add(self.metrics.first_reply_ms, self.scenario, (t - t0) * 1000)
+            if until is None or until in text:
+                return (t - t0) * 1000
+
+    async def run(self):
+        self.metrics.inc(self.metrics.started, self.scenario)
+        self.mock.observers.append(self.observe)
+        try:
+            await self.step({"text": "/start"})
+            await self._think()
+            await self.step({"callback_data": self.scenario})
+            await self._think()
+            await self.step({"callback_data": f"buy_{self.scenario}"})
+            await self._think()
+            if self.scenario == "palm":
+                await self.step({"photo": True})
+                await self._think()
+                total = await self.step({"text": "правая рука, интересует карьера"}, until=_DONE_MARK)
+            else:
+                total = await self.step({"text": self._input_text()}, until=_DONE_MARK)
+            self.metrics.add(self.metrics.report_ms, self.scenario, total)
+            self.metrics.inc(self.metrics.completed, self.scenario)
+        except FlowError as e:
+            self.metrics.error(self.scenario, str(e))
+        finally:
+            self.mock.observers.remove(self.observe)
+
+    def _input_text(self) -> str:
+        name = self.rng.choice(_NAMES)
+        dob = f"{self.rng.randint(1, 28):02d}.{self.rng.randint(1, 12):02d}.{self.rng.randint(1950, 2010)}"
+        if self.scenario == "num":
+            return f"{dob} {name}"
+        birth_time = "не знаю" if self.rng.random() < 0.3 else f"{self.rng.randint(0, 23):02d}:{self.rng.randint(0, 59):02d}"
+        text = "\n".join([name, dob, birth_time, self.rng.choice(_CITIES)])
+        ok, err = _parse_natal_all_input(text)
+        if not ok:
+            raise ValueError(f"generated natal input rejected: {err}")
+        return text
+
+
+def rate_at(profile: str, t: float, rate: float, duration: float) -> float:
+    """Arrival rate (users/s) at second t of the run."""
+    if profile == "ramp":
+        # линейный рост за первую треть, дальше — полка
+        return rate * min(1.0, t / max(1e-9, duration / 3))
+    if profile == "step":
+        # четыре ступени по четверти rate
+        return rate * min(4, int(t / max(1e-9, duration / 4)) + 1) / 4
+    if profile == "spike":
+        # фон 20%, в середине прогона 10% времени — полный rate
+        return rate if abs(t - duration / 2) < duration / 20 else rate * 0.2
+    return rate
+
+
+async def arrivals(profile: str, rate: float, duration: float, rng: random.Random):
+    """Non-homogeneous Poisson arrivals (thinning): yields arrival offsets in seconds."""
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t >= duration:
+            return
+        if rng.random() <= rate_at(profile, t, rate, duration) / rate:
+            yield t
+
+
+def _parse_mix(spec: str) -> list[tuple[str, float]]:
+    mix = []
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+async def run(args) -> Metrics:
+    rng = random.Random(args.seed)
+    mock = mock_telegram.MockTelegram(mock_telegram.MockTelegramConfig(
+        latency=args.tg_latency, latency_ms=args.tg_latency_ms, rate_429=args.tg_rate_429, seed=args.seed,
+    ))
+    runner = web.AppRunner(mock.build_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+
+    procs = []
+    if args.spawn_bot:
+        procs.append(await _spawn_bot(args))
+    await asyncio.sleep(args.warmup_s)
+
+    metrics = Metrics()
+    names, weights = zip(*_parse_mix(args.mix))
+    active = asyncio.Semaphore(args.max_active)
+    tasks = []
+    started = time.monotonic()
+
+    async def one(user_id: int, scenario: str):
+        async with active:
+            await VirtualUser(mock, user_id, scenario, metrics, random.Random(rng.random()),
+                              args.timeout_s, args.think_ms).run()
+
+    n = 0
+    async for offset in arrivals(args.profile, args.rate, args.duration, rng):
+        await asyncio.sleep(max(0.0, started + offset - time.monotonic()))
+        n += 1
+        tasks.append(asyncio.create_task(one(args.user_base + n, rng.choices(names, weights)[0])))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+
+    for p in procs:
+        p.terminate()
+        try:
+            await asyncio.wait_for(p.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            p.kill()
+    await runner.cleanup()
+    _print_report(metrics, elapsed, mock)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(_summary(metrics, elapsed), f, ensure_ascii=False, indent=2)
+    return metrics
+
+
+async def _spawn_bot(args):
+    base = f"http://{args.host}:{args.port}"
+    env = {**os.environ, "TG_BASE_URL": f"{base}/bot", "TG_BASE_FILE_URL": f"{base}/file/bot",
+           "BOT_TOKEN": os.environ.get("BOT_TOKEN") or "1000:loadgen", "BOT_MODE": "polling",
+           "DB_PATH": args.db or os.path.join(tempfile.mkdtemp(prefix="loadgen-"), "data.sqlite3")}
+    if args.llm_url:
+        llm = args.llm_url.rstrip("/")
+        env.update(OPENAI_BASE_URL=f"{llm}/openai/v1", MISTRAL_BASE_URL=f"{llm}/mistral/v1",
+                   GEMINI_BASE_URL=f"{llm}/gemini/v1beta",
+                   OPENAI_API_KEY=env.get("OPENAI_API_KEY") or "mock", MISTRAL_API_KEY=env.get("MISTRAL_API_KEY") or "mock")
+    log_file = open(args.bot_log, "w") if args.bot_log else asyncio.subprocess.DEVNULL
+    return await asyncio.create_subprocess_exec(sys.executable, "-m", "src.bot", env=env,
+                                                stdout=log_file, stderr=asyncio.subprocess.STDOUT)
+
+
+def _summary(m: Metrics, elapsed: float) -> dict:
+    out = {"elapsed_s": round(elapsed, 2), "updates": m.updates,
+           "updates_per_s": round(m.updates / elapsed, 2) if elapsed else 0.0, "scenarios": {}}
+    for s in sorted(m.started):
+        first, report = m.first_reply_ms.get(s, []), m.report_ms.get(s, [])
+        failed = sum(m.errors.get(s, {}).values())
+        out["scenarios"][s] = {
+            "started": m.started[s], "completed": m.completed.get(s, 0), "errors": m.errors.get(s, {}),
+            "error_rate": round(failed / m.started[s], 4),
+            "flows_per_s": round(m.completed.get(s, 0) / elapsed, 3) if elapsed else 0.0,
+            "first_reply_ms": {f"p{q}": round(_pct(first, q / 100), 1) for q in (50, 95, 99)},
+            "report_ms": {f"p{q}": round(_pct(report, q / 100), 1) for q in (50, 95, 99)},
+        }
+    return out
+
+
+def _print_report(m: Metrics, elapsed: float, mock: mock_telegram.MockTelegram):
+    summary = _summary(m, elapsed)
+    print(f"{elapsed:.1f} s, {m.updates} updates ({summary['updates_per_s']}/s)")
+    print(f"{'scenario':>8} {'users':>5} {'done':>5} {'err%':>5} {'flows/s':>7} "
+          f"{'reply p50':>9} {'p95':>7} {'p99':>7} {'report p50':>10} {'p95':>7} {'p99':>7}")
+    rows = list(summary["scenarios"].items())
+    every = {"started": sum(v["started"] for _, v in rows), "completed": sum(v["completed"] for _, v in rows)}
+    for name, v in rows:
+        fr, rp = v["first_reply_ms"], v["report_ms"]
+        print(f"{name:>8} {v['started']:>5} {v['completed']:>5} {v['error_rate'] * 100:>5.1f} {v['flows_per_s']:>7.3f} "
+              f"{fr['p50']:>9.0f} {fr['p95']:>7.0f} {fr['p99']:>7.0f} {rp['p50']:>10.0f} {rp['p95']:>7.0f} {rp['p99']:>7.0f}")
+    if len(rows) > 1 and every["started"]:
+        first = [x for xs in m.first_reply_ms.values() for x in xs]
+        report = [x for xs in m.report_ms.values() for x in xs]
+        err = 1 - every["completed"] / every["started"]
+        print(f"{'all':>8} {every['started']:>5} {every['completed']:>5} {err * 100:>5.1f} {every['completed'] / elapsed:>7.3f} "
+              f"{_pct(first, .5):>9.0f} {_pct(first, .95):>7.0f} {_pct(first, .99):>7.0f} "
+              f"{_pct(report, .5):>10.0f} {_pct(report, .95):>7.0f} {_pct(report, .99):>7.0f}")
+    for name, errs in m.errors.items():
+        print(f"errors {name}: " + ", ".join(f"{k}={v}" for k, v in sorted(errs.items())))
+    api = {k: v for k, v in sorted(mock.stats.items()) if not k.startswith("getUpdates")}
+    print("Bot API: " + ", ".join(f"{k}={v}" for k, v in api.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator: virtual users through full purchase flows")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081, help="port of the embedded mock Bot API")
+    parser.add_argument("--rate", type=float, default=2.0, help="peak arrival rate, users/s")
+    parser.add_argument("--duration", type=float, default=30.0, help="arrival window, s")
+    parser.add_argument("--profile", default="constant", choices=["constant", "ramp", "step", "spike"])
+    parser.add_argument("--mix", default="num=0.5,natal=0.3,palm=0.2")
+    parser.add_argument("--max-active", type=int, default=500, help="cap on concurrent virtual users")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="mean pause between a user's steps")
+    parser.add_argument("--timeout-s", type=float, default=120.0, help="max wait for a reply / report")
+    parser.add_argument("--user-base", type=int, default=10_000_000, help="first virtual user id - 1")
+    parser.add_argument("--tg-latency", default="fixed", choices=["fixed", "uniform", "normal", "lognormal", "exp"])
+    parser.add_argument("--tg-latency-ms", type=float, default=30.0)
+    parser.add_argument("--tg-rate-429", type=float, default=0.0)
+    parser.add_argument("--spawn-bot", action="store_true", help="start `python -m src.bot` against the mock")
+    parser.add_argument("--llm-url", help="mock LLM base (python -m src.mock_llm) for the spawned bot")
+    parser.add_argument("--db", help="DB_PATH for the spawned bot (default: a temp file)")
+    parser.add_argument("--bot-log", help="write the spawned bot's output here")
+    parser.add_argument("--warmup-s", type=float, default=3.0, help="pause before the first arrival")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the summary as JSON")
+    args = parser.parse_args()
+    if args.rate <= 0 or not math.isfinite(args.rate):
+        raise SystemExit("--rate must be positive")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
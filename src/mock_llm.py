@@ -0,0 +1,416 @@
+# src/mock_llm.py
+"""
+Local stand-in for the LLM providers used by the bot (OpenAI, Mistral chat/vision, Gemini).
+
+Run:
+    python -m src.mock_llm --port 8089 --latency lognormal --latency-ms 800 --rate-429 0.1
+
+and point the bot at it:
+    OPENAI_BASE_URL=http://127.0.0.1:8089/openai/v1
+    MISTRAL_BASE_URL=http://127.0.0.1:8089/mistral/v1
+    GEMINI_BASE_URL=http://127.0.0.1:8089/gemini/v1beta
+
+Each request gets a synthetic JSON report matching the schema requested in the prompt
+(numerology / natal / palm). Latency and failures (429/500/timeout, truncated or
+```-fenced JSON) are injected according to the config, which can also be changed at
+runtime via POST /_mock/config. GET /_mock/stats returns counters.
+
+The OpenAI Batch API subset used by src.batch (/files, /batches, /files/{id}/content)
+is served under the same /openai/v1 prefix.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from dataclasses import dataclass, asdict, fields
+
+from aiohttp import web
+
+log = logging.getLogger("astro-num-bot.mock_llm")
+
+
+@dataclass
+class MockConfig:
+    latency: str = "fixed"          # fixed | uniform | normal | lognormal | exp
+    latency_ms: float = 300.0       # среднее (или фиксированное) время ответа
+    latency_jitter_ms: float = 100.0  # разброс для uniform/normal, sigma для lognormal (в долях от среднего)
+    rate_429: float = 0.0
+    rate_500: float = 0.0
+    rate_timeout: float = 0.0
+    timeout_hang_s: float = 120.0   # сколько "висеть" при имитации таймаута
+    retry_after_s: int = 1          # значение заголовка Retry-After для 429
+    rate_truncated: float = 0.0     # доля ответов с обрезанным JSON
+    rate_fenced: float = 0.0        # доля ответов, обёрнутых в ```json ... ```
+    stream_chunk_chars: int = 48
+    stream_chunk_delay_ms: float = 20.0
+    seed: int | None = None
+
+
+class MockLLM:
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.stats: dict[str, int] = {}
+        # Batch API: загруженные файлы и батчи
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+
+    # --- helpers ---
+    def _count(self, key: str):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def _latency_s(self) -> float:
+        c = self.config
+        return sample_latency_s(self.rng, c.latency, c.latency_ms, c.latency_jitter_ms)
+
+    async def _inject_failure(self, provider: str) -> web.Response | None:
+        """Returns an error response (or hangs) according to the configured failure rates."""
+        c = self.config
+        r = self.rng.random()
+        if r < c.rate_429:
+            self._count(f"{provider}.429")
+            return web.json_response(
+                {"error": {"message": "Rate limit exceeded (mock)", "type": "rate_limit_error"}},
+                status=429, headers={"Retry-After": str(c.retry_after_s)},
+            )
+        r -= c.rate_429
+        if r < c.rate_500:
+            self._count(f"{provider}.500")
+            return web.json_response({"error": {"message": "Internal error (mock)"}}, status=500)
+        r -= c.rate_500
+        if r < c.rate_timeout:
+            self._count(f"{provider}.timeout")
+            await asyncio.sleep(c.timeout_hang_s)
+            return web.json_response({"error": {"message": "Timed out (mock)"}}, status=504)
+        return None
+
+    def _mangle(self, text: str) -> str:
+        c = self.config
+        if self.rng.random() < c.rate_truncated:
+            self._count("truncated")
+            return text[: max(1, int(len(text) * self.rng.uniform(0.3, 0.9)))]
+        if self.rng.random() < c.rate_fenced:
+            self._count("fenced")
+            return "```json\n" + text + "\n```"
+        return text
+
+    # --- synthetic reports ---
+    def _report_for(self, prompt: str) -> dict:
+        if "pythagoras_matrix" in prompt:
+            return _numerology_report(self.rng)
+        if "ascendant" in prompt:
+            return _natal_report(self.rng)
+        if "hand_overview" in prompt:
+            return _palm_report(self.rng)
+        return {"title": "Mock", "summary": "Синтетический ответ тестового стенда.", "data_notes": []}
+
+    # --- handlers ---
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        provider = request.match_info["provider"]
+        self._count(f"{provider}.requests")
+        payload = await request.json()
+        messages = payload.get("messages") or []
+        prompt = "\n".join(_message_text(m) for m in messages)
+        if any(_has_image(m) for m in messages):
+            self._count(f"{provider}.vision")
+
+        await asyncio.sleep(self._latency_s())
+        err = await self._inject_failure(provider)
+        if err is not None:
+            return err
+
+        model = payload.get("model", "mock")
+        content = self._mangle(json.dumps(self._report_for(prompt), ensure_ascii=False, separators=(",", ":")))
+        if payload.get("stream"):
+            return await self._stream_openai(request, model, content)
+        return web.json_response({
+            "id": f"chatcmpl-mock-{self.rng.getrandbits(32):08x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": _usage(prompt, content),
+        })
+
+    async def _stream_openai(self, request: web.Request, model: str, content: str) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await resp.prepare(request)
+        step = max(1, self.config.stream_chunk_chars)
+        for i in range(0, len(content), step):
+            chunk = {
+                "id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": model,
+                "choices": [{"index": 0, "delta": {"content": content[i:i + step]}, "finish_reason": None}],
+            }
+            await resp.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode() + b"\n\n")
+            await asyncio.sleep(self.config.stream_chunk_delay_ms / 1000.0)
+        done = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        await resp.write(b"data: " + json.dumps(done).encode() + b"\n\ndata: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def gemini(self, request: web.Request) -> web.StreamResponse:
+        model, _, action = request.match_info["model_action"].partition(":")
+        self._count("gemini.requests")
+        payload = await request.json()
+        prompt = "\n".join(
+            p.get("text", "") for c in payload.get("contents") or [] for p in c.get("parts") or []
+        )
+        await asyncio.sleep(self._latency_s())
+        err = await self._inject_failure("gemini")
+        if err is not None:
+            return err
+
+        content = self._mangle(json.dumps(self._report_for(prompt), ensure_ascii=False, separators=(",", ":")))
+        if action == "streamGenerateContent":
+            resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await resp.prepare(request)
+            step = max(1, self.config.stream_chunk_chars)
+            for i in range(0, len(content), step):
+                chunk = {"candidates": [{"content": {"parts": [{"text": content[i:i + step]}], "role": "model"}}]}
+                await resp.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode() + b"\n\n")
+                await asyncio.sleep(self.config.stream_chunk_delay_ms / 1000.0)
+            await resp.write_eof()
+            return resp
+        usage = _usage(prompt, content)
+        return web.json_response({
+            "candidates": [{"content": {"parts": [{"text": content}], "role": "model"}, "finishReason": "STOP"}],
+            "usageMetadata": {
+                "promptTokenCount": usage["prompt_tokens"],
+                "candidatesTokenCount": usage["completion_tokens"],
+                "totalTokenCount": usage["total_tokens"],
+            },
+            "modelVersion": model,
+        })
+
+    # --- Batch API (OpenAI-формат) ---
+    async def upload_file(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        f = form.get("file")
+        data = f.file.read() if hasattr(f, "file") else str(f or "").encode()
+        file_id = f"file-mock-{self.rng.getrandbits(32):08x}"
+        self.files[file_id] = data
+        self._count("files.uploaded")
+        return web.json_response({"id": file_id, "object": "file", "bytes": len(data),
+                                  "purpose": form.get("purpose", "batch"), "created_at": int(time.time())})
+
+    async def file_content(self, request: web.Request) -> web.Response:
+        data = self.files.get(request.match_info["file_id"])
+        if data is None:
+            return web.json_response({"error": {"message": "No such file"}}, status=404)
+        return web.Response(body=data, content_type="application/jsonl")
+
+    async def create_batch(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        file_id = payload.get("input_file_id")
+        if file_id not in self.files:
+            return web.json_response({"error": {"message": "input_file_id not found"}}, status=400)
+        batch_id = f"batch_mock_{self.rng.getrandbits(32):08x}"
+        batch = {
+            "id": batch_id, "object": "batch", "endpoint": payload.get("endpoint"),
+            "input_file_id": file_id, "completion_window": payload.get("completion_window", "24h"),
+            "status": "validating", "output_file_id": None, "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        self.batches[batch_id] = batch
+        self._count("batches.created")
+        asyncio.get_running_loop().create_task(self._run_batch(batch))
+        return web.json_response(batch)
+
+    async def _run_batch(self, batch: dict):
+        lines = [json.loads(x) for x in self.files[batch["input_file_id"]].decode("utf-8").splitlines() if x.strip()]
+        batch["status"] = "in_progress"
+        batch["request_counts"]["total"] = len(lines)
+        await asyncio.sleep(self._latency_s())
+        out = []
+        for line in lines:
+            body = line.get("body") or {}
+            prompt = "\n".join(_message_text(m) for m in body.get("messages") or [])
+            if self.rng.random() < self.config.rate_500:
+                batch["request_counts"]["failed"] += 1
+                out.append({"id": f"batch_req_{len(out)}", "custom_id": line.get("custom_id"),
+                            "response": {"status_code": 500, "body": {"error": {"message": "mock failure"}}}, "error": None})
+                continue
+            content = self._mangle(json.dumps(self._report_for(prompt), ensure_ascii=False, separators=(",", ":")))
+            batch["request_counts"]["completed"] += 1
+            out.append({
+                "id": f"batch_req_{len(out)}", "custom_id": line.get("custom_id"),
+                "response": {"status_code": 200, "request_id": f"req_{len(out)}", "body": {
+                    "object": "chat.completion", "model": body.get("model", "mock"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": _usage(prompt, content),
+                }},
+                "error": None,
+            })
+        out_id = f"file-mock-{self.rng.getrandbits(32):08x}"
+        self.files[out_id] = "\n".join(json.dumps(x, ensure_ascii=False) for x in out).encode("utf-8")
+        batch["output_file_id"] = out_id
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+    async def get_batch(self, request: web.Request) -> web.Response:
+        batch = self.batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"message": "No such batch"}}, status=404)
+        return web.json_response(batch)
+
+    async def get_config(self, request: web.Request) -> web.Response:
+        return web.json_response(asdict(self.config))
+
+    async def set_config(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        known = {f.name for f in fields(MockConfig)}
+        for k, v in data.items():
+            if k in known:
+                setattr(self.config, k, v)
+        if "seed" in data:
+            self.rng.seed(data["seed"])
+        return web.json_response(asdict(self.config))
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post("/{provider}/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/gemini/v1beta/models/{model_action}", self.gemini)
+        app.router.add_post("/{provider}/v1/files", self.upload_file)
+        app.router.add_get("/{provider}/v1/files/{file_id}/content", self.file_content)
+        app.router.add_post("/{provider}/v1/batches", self.create_batch)
+        app.router.add_get("/{provider}/v1/batches/{batch_id}", self.get_batch)
+        app.router.add_get("/_mock/config", self.get_config)
+        app.router.add_post("/_mock/config", self.set_config)
+        app.router.add_get("/_mock/stats", self.get_stats)
+        return app
+
+
+def sample_latency_s(rng: random.Random, kind: str, mean_ms: float, jitter_ms: float) -> float:
+    """Response time in seconds for latency model `kind` (shared with src.mock_telegram)."""
+    mean = max(0.0, mean_ms)
+    if kind == "uniform":
+        ms = rng.uniform(mean - jitter_ms, mean + jitter_ms)
+    elif kind == "normal":
+        ms = rng.gauss(mean, jitter_ms)
+    elif kind == "lognormal":
+        # jitter_ms трактуем как sigma относительно среднего (100 -> 1.0)
+        sigma = max(0.01, jitter_ms / 100.0)
+        ms = mean * rng.lognormvariate(0.0, sigma)
+    elif kind == "exp":
+        ms = rng.expovariate(1.0 / mean) if mean else 0.0
+    else:
+        ms = mean
+    return max(0.0, ms) / 1000.0
+
+
+def _message_text(m: dict) -> str:
+    content = m.get("content", "")
+    if isinstance(content, list):
+        return "\n".join(str(p.get("text", "")) for p in content if isinstance(p, dict))
+    return str(content)
+
+
+def _has_image(m: dict) -> bool:
+    content = m.get("content")
+    return isinstance(content, list) and any(isinstance(p, dict) and p.get("type") == "image_url" for p in content)
+
+
+def _usage(prompt: str, content: str) -> dict:
+    # грубая оценка ~4 символа на токен — для стенда достаточно
+    pt, ct = max(1, len(prompt) // 4), max(1, len(content) // 4)
+    return {"prompt_tokens": pt, "completion_tokens": ct, "total_tokens": pt + ct}
+
+
+_PHRASES = [
+    "мягкий импульс к переменам", "устойчивая внутренняя опора", "творческая искра",
+    "важно беречь ресурс", "время собирать плоды", "гибкость и любопытство",
+    "тёплая забота о близких", "ясность целей", "доверие к интуиции",
+]
+
+
+def _phrases(rng: random.Random, n: int) -> list[str]:
+    return [rng.choice(_PHRASES).capitalize() for _ in range(n)]
+
+
+def _recs(rng: random.Random) -> dict:
+    return {"week": _phrases(rng, 3), "month": _phrases(rng, 3), "focus_areas": _phrases(rng, 2)}
+
+
+def _numerology_report(rng: random.Random) -> dict:
+    value = rng.choice([1, 2, 3, 4, 5, 6, 7, 8, 9, 11, 22])
+    return {
+        "title": "Нумерологический портрет (mock)",
+        "summary": " ".join(_phrases(rng, 4)),
+        "life_path": {"value": value, "meaning": rng.choice(_PHRASES),
+                      "strengths": _phrases(rng, 3), "risks": _phrases(rng, 2), "advice": _phrases(rng, 3)},
+        "pythagoras_matrix": {
+            "grid_text": "1   | 4   | 7\n2   | 5   | 8\n3   | 6   | 9",
+            "lines_overview": [{"axis": a, "total": rng.randint(0, 4), "tone": rng.choice(_PHRASES), "comment": rng.choice(_PHRASES)}
+                               for a in ("1-4-7", "2-5-8", "3-6-9")],
+            "digits": [{"digit": d, "count": rng.randint(0, 3), "meaning": rng.choice(_PHRASES), "advice": rng.choice(_PHRASES)}
+                       for d in range(1, 10)],
+            "missing": [], "dominant": [],
+        },
+        "practical_recs": _recs(rng),
+        "data_notes": _phrases(rng, 1),
+    }
+
+
+def _natal_report(rng: random.Random) -> dict:
+    signs = ["Овен", "Телец", "Близнецы", "Рак", "Лев", "Дева", "Весы", "Скорпион", "Стрелец", "Козерог", "Водолей", "Рыбы"]
+    return {
+        "title": "Натальная карта (mock)",
+        "summary": " ".join(_phrases(rng, 5)),
+        "birth": {"full_name": "Тест Тестов", "date": "01.01.2000", "time": None, "city": "Омск, Россия",
+                  "timezone_note": "Время неизвестно — принят полдень."},
+        "chart": {k: {"sign": rng.choice(signs), "comment": rng.choice(_PHRASES)} for k in ("sun", "moon", "ascendant")},
+        "houses": [{"house": h, "topic": rng.choice(_PHRASES), "comment": rng.choice(_PHRASES)} for h in range(1, 13)],
+        "aspects": [{"pair": "Солнце–Луна", "type": "трин", "tightness": "2°", "meaning": rng.choice(_PHRASES)}],
+        "numerology": {"life_path": {"value": rng.randint(1, 9), "comment": rng.choice(_PHRASES)}},
+        "practical_recs": _recs(rng),
+        "data_notes": _phrases(rng, 1),
+    }
+
+
+def _palm_report(rng: random.Random) -> dict:
+    return {
+        "title": "Разбор по ладони (mock)",
+        "summary": " ".join(_phrases(rng, 5)),
+        "hand_overview": {"dominant": "правая", "general": _phrases(rng, 3)},
+        "lines": {
+            "heart": {"tone": rng.choice(_PHRASES), "details": _phrases(rng, 4)},
+            "head": {"tone": rng.choice(_PHRASES), "details": _phrases(rng, 4)},
+            "life": {"tone": rng.choice(_PHRASES), "details": _phrases(rng, 4)},
+            "fate": {"present": rng.random() < 0.5, "details": _phrases(rng, 2)},
+        },
+        "mounts": [{"name": n, "expression": "умеренно", "comment": rng.choice(_PHRASES)} for n in ("Венеры", "Юпитера", "Луны")],
+        "patterns": _phrases(rng, 2),
+        "practical_recs": _recs(rng),
+        "data_notes": _phrases(rng, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of OpenAI/Mistral/Gemini APIs for the bot")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    defaults = MockConfig()
+    for f in fields(MockConfig):
+        flag = "--" + f.name.replace("_", "-")
+        if f.name == "latency":
+            parser.add_argument(flag, default=defaults.latency, choices=["fixed", "uniform", "normal", "lognormal", "exp"])
+        elif f.name == "seed":
+            parser.add_argument(flag, type=int, default=None)
+        else:
+            parser.add_argument(flag, type=type(getattr(defaults, f.name)), default=getattr(defaults, f.name))
+    args = parser.parse_args()
+    config = MockConfig(**{f.name: getattr(args, f.name) for f in fields(MockConfig)})
+
+    logging.basicConfig(format="%(asctime)s [%(levelname)s] %(name)s: %(message)s", level=logging.INFO)
+    log.info("Mock LLM on http://%s:%s (%s)", args.host, args.port, asdict(config))
+    web.run_app(MockLLM(config).build_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
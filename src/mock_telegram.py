@@ -0,0 +1,536 @@
+# src/mock_telegram.py
+"""
+Local stand-in for the Telegram Bot API, for end-to-end and load tests of the bot.
+
+Run:
+    python -m src.mock_telegram --port 8081 --latency-ms 40 --rate-429 0.01
+
+and point the bot at it:
+    TG_BASE_URL=http://127.0.0.1:8081/bot
+    TG_BASE_FILE_URL=http://127.0.0.1:8081/file/bot
+
+The bot talks to it exactly as to Telegram (any token is accepted). Implemented methods:
+getMe, getUpdates (long polling), setWebhook / deleteWebhook / getWebhookInfo (updates
+are then POSTed to the webhook with the secret header), sendMessage, editMessageText,
+deleteMessage, sendChatAction, answerCallbackQuery, sendInvoice, answerPreCheckoutQuery,
+getFile plus file download, setMyCommands / getMyCommands. Other methods answer 404
+"method not found" and are recorded, so gaps are visible.
+
+Like Telegram, sendMessage / editMessageText reject HTML that does not parse and text
+over 4096 UTF-16 units (400), and chats listed in `blocked_chats` answer 403. Latency
+(the models of src.mock_llm), random 429 with retry_after and deterministic flood limits
+(per chat and global) are configurable, also at runtime via POST /_mock/config.
+
+Users are simulated with POST /_mock/updates, e.g.
+    {"user_id": 7, "text": "/start"}
+    {"user_id": 7, "callback_data": "buy_num"}
+    {"user_id": 7, "photo": true}                    # synthetic JPEG, served by getFile
+    {"user_id": 7, "successful_payment": "NUM_200"}
+    {"update": {...}}                                # raw Update JSON
+With `auto_pay`, sendInvoice is followed by a pre_checkout_query and, once it is
+answered ok, by a successful_payment message, like a user paying instantly.
+
+Every Bot API call is recorded: GET /_mock/calls?method=sendMessage&chat_id=7 returns them
+(with status and latency), DELETE /_mock/calls clears them, GET /_mock/stats has counters.
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import random
+import re
+import time
+from dataclasses import dataclass, asdict, field, fields
+from html import unescape
+
+import aiohttp
+from aiohttp import web
+
+from .mock_llm import sample_latency_s
+from .tg_html import TELEGRAM_LIMIT, utf16_len
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:  # опциональная зависимость: без Pillow фото — заглушка
+    Image = None
+
+log = logging.getLogger("astro-num-bot.mock_telegram")
+
+# параметры, которые PTB передаёт JSON-строкой внутри form-data
+_JSON_PARAMS = {
+    "reply_markup", "prices", "allowed_updates", "commands", "scope", "entities",
+    "link_preview_options", "reply_parameters", "caption_entities",
+}
+# методы, на которые распространяется случайный 429 (служебные — getMe, getUpdates, вебхук — нет)
+_FLOOD_METHODS = {
+    "sendmessage", "editmessagetext", "deletemessage", "sendchataction",
+    "answercallbackquery", "sendinvoice", "answerprecheckoutquery",
+}
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^>]*>")
+_HTML_TAGS = {"b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a", "code", "pre",
+              "span", "tg-spoiler", "tg-emoji", "blockquote"}
+
+
+@dataclass
+class MockTelegramConfig:
+    latency: str = "fixed"            # fixed | uniform | normal | lognormal | exp
+    latency_ms: float = 30.0
+    latency_jitter_ms: float = 10.0
+    rate_429: float = 0.0             # доля случайных 429 на отправку сообщений
+    retry_after_s: int = 1
+    flood_per_chat_s: float = 0.0     # мин. интервал между сообщениями в один чат (0 — выкл.)
+    flood_global_rps: float = 0.0     # лимит сообщений в секунду на бота (0 — выкл.)
+    blocked_chats: list[int] = field(default_factory=list)
+    auto_pay: bool = False
+    seed: int | None = None
+
+
+def _parse_html(text: str) -> str | None:
+    """Visible text of Telegram HTML, or None if Telegram would fail to parse it."""
+    stack = []
+    for m in _TAG_RE.finditer(text):
+        closing, name = m.group(1), m.group(2).lower()
+        if name not in _HTML_TAGS:
+            return None
+        if not closing:
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return None
+    if stack or re.search(r"<(?![a-zA-Z/])", text):
+        return None
+    return unescape(_TAG_RE.sub("", text))
+
+
+def _error(code: int, description: str, **parameters) -> web.Response:
+    body = {"ok": False, "error_code": code, "description": description}
+    if parameters:
+        body["parameters"] = parameters
+    return web.json_response(body, status=code)
+
+
+def _ok(result) -> web.Response:
+    return web.json_response({"ok": True, "result": result})
+
+
+class MockTelegram:
+    def __init__(self, config: MockTelegramConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.calls: list[dict] = []
+        self.stats: dict[str, int] = {}
+        self.t0 = time.monotonic()
+        # апдейты для getUpdates и вебхук
+        self._updates: list[dict] = []
+        self._update_id = 0
+        self._new_update = asyncio.Event()
+        self.webhook: dict | None = None
+        self._session: aiohttp.ClientSession | None = None
+        # состояние "серверной" стороны
+        self._message_id: dict[int, int] = {}
+        self.messages: dict[tuple[int, int], dict] = {}
+        self.files: dict[str, bytes] = {}
+        self.commands: list = []
+        self._invoices: dict[str, dict] = {}
+        self._chat_sent_at: dict[int, float] = {}
+        self._global_sent: list[float] = []
+        # наблюдатели вызовов (src.loadgen): callback(record) после каждого вызова
+        self.observers: list = []
+
+    def _count(self, key: str):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    # --- Bot API ---
+    async def api(self, request: web.Request) -> web.Response:
+        token, method = request.match_info["token"], request.match_info["method"]
+        params = await self._params(request)
+        started = time.monotonic()
+        if method.lower() != "getupdates":
+            await asyncio.sleep(sample_latency_s(self.rng, self.config.latency, self.config.latency_ms,
+                                                 self.config.latency_jitter_ms))
+        resp = await self._dispatch(token, method, params)
+        status = resp.status
+        record = {
+            "t": round(started - self.t0, 4), "method": method, "params": params,
+            "status": status, "ms": round((time.monotonic() - started) * 1000, 2),
+        }
+        self.calls.append(record)
+        self._count(f"{method}.{status}")
+        for observer in self.observers:
+            observer(record)
+        return resp
+
+    async def _params(self, request: web.Request) -> dict:
+        params = dict(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+            return params
+        form = await request.post()
+        for k, v in form.items():
+            if isinstance(v, web.FileField):
+                params[k] = {"upload": v.filename}
+            elif k in _JSON_PARAMS:
+                try:
+                    params[k] = json.loads(v)
+                except ValueError:
+                    params[k] = v
+            else:
+                params[k] = v
+        return params
+
+    async def _dispatch(self, token: str, method: str, p: dict) -> web.Response:
+        handler = getattr(self, "m_" + method.lower(), None)
+        if handler is None:
+            return _error(404, "Not Found: method not found")
+        if method.lower() in ("sendmessage", "editmessagetext", "sendinvoice"):
+            limited = self._flood_check(int(p.get("chat_id", 0)))
+            if limited:
+                return limited
+        if method.lower() in _FLOOD_METHODS and self.rng.random() < self.config.rate_429:
+            return _error(429, f"Too Many Requests: retry after {self.config.retry_after_s}",
+                          retry_after=self.config.retry_after_s)
+        try:
+            return await handler(token, p)
+        except (KeyError, ValueError) as e:
+            return _error(400, f"Bad Request: {e}")
+
+    def _flood_check(self, chat_id: int) -> web.Response | None:
+        c = self.config
+        if chat_id in c.blocked_chats:
+            return _error(403, "Forbidden: bot was blocked by the user")
+        now = time.monotonic()
+        if c.flood_per_chat_s:
+            last = self._chat_sent_at.get(chat_id)
+            if last is not None and now - last < c.flood_per_chat_s:
+                wait = max(1, int(c.flood_per_chat_s - (now - last) + 0.999))
+                return _error(429, f"Too Many Requests: retry after {wait}", retry_after=wait)
+        if c.flood_global_rps:
+            self._global_sent = [t for t in self._global_sent if now - t < 1.0]
+            if len(self._global_sent) >= c.flood_global_rps:
+                return _error(429, "Too Many Requests: retry after 1", retry_after=1)
+            self._global_sent.append(now)
+        self._chat_sent_at[chat_id] = now
+        return None
+
+    def _bot_user(self, token: str) -> dict:
+        bot_id = int(token.split(":", 1)[0]) if token.split(":", 1)[0].isdigit() else 1
+        return {"id": bot_id, "is_bot": True, "first_name": "MockBot", "username": "mock_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    def _store_message(self, token: str, chat_id: int, **content) -> dict:
+        mid = self._message_id.get(chat_id, 0) + 1
+        self._message_id[chat_id] = mid
+        msg = {"message_id": mid, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+               "from": self._bot_user(token), **content}
+        self.messages[(chat_id, mid)] = msg
+        return msg
+
+    def _check_text(self, p: dict, key: str = "text") -> tuple[str | None, web.Response | None]:
+        text = p.get(key, "")
+        visible = _parse_html(text) if (p.get("parse_mode") or "").upper() == "HTML" else text
+        if visible is None:
+            return None, _error(400, "Bad Request: can't parse entities: unsupported start tag or unmatched end tag")
+        if not visible.strip():
+            return None, _error(400, "Bad Request: message text is empty")
+        if utf16_len(visible) > TELEGRAM_LIMIT:
+            return None, _error(400, "Bad Request: message is too long")
+        return visible, None
+
+    async def m_getme(self, token, p):
+        return _ok(self._bot_user(token))
+
+    async def m_getupdates(self, token, p):
+        offset = int(p.get("offset") or 0)
+        limit = int(p.get("limit") or 100)
+        timeout = float(p.get("timeout") or 0)
+        if self.webhook:
+            return _error(409, "Conflict: can't use getUpdates method while webhook is active")
+        if offset:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return _ok(self._updates[:limit])
+
+    async def m_setwebhook(self, token, p):
+        self.webhook = {"url": p["url"], "secret_token": p.get("secret_token", "")}
+        # накопленное для getUpdates теперь уходит на вебхук
+        pending, self._updates = self._updates, []
+        for u in pending:
+            asyncio.get_running_loop().create_task(self._post_webhook(u))
+        return _ok(True)
+
+    async def m_deletewebhook(self, token, p):
+        self.webhook = None
+        if p.get("drop_pending_updates") in ("true", True):
+            self._updates = []
+        return _ok(True)
+
+    async def m_getwebhookinfo(self, token, p):
+        return _ok({"url": (self.webhook or {}).get("url", ""), "has_custom_certificate": False,
+                    "pending_update_count": len(self._updates)})
+
+    async def m_sendmessage(self, token, p):
+        _, err = self._check_text(p)
+        if err:
+            return err
+        content = {"text": p["text"]}
+        if p.get("reply_markup"):
+            content["reply_markup"] = p["reply_markup"]
+        return _ok(self._store_message(token, int(p["chat_id"]), **content))
+
+    async def m_editmessagetext(self, token, p):
+        key = (int(p["chat_id"]), int(p["message_id"]))
+        msg = self.messages.get(key)
+        if not msg:
+            return _error(400, "Bad Request: message to edit not found")
+        _, err = self._check_text(p)
+        if err:
+            return err
+        if msg.get("text") == p["text"] and msg.get("reply_markup") == p.get("reply_markup"):
+            return _error(400, "Bad Request: message is not modified")
+        msg.update(text=p["text"], edit_date=int(time.time()))
+        msg.pop("reply_markup", None)
+        if p.get("reply_markup"):
+            msg["reply_markup"] = p["reply_markup"]
+        return _ok(msg)
+
+    async def m_deletemessage(self, token, p):
+        if self.messages.pop((int(p["chat_id"]), int(p["message_id"])), None) is None:
+            return _error(400, "Bad Request: message to delete not found")
+        return _ok(True)
+
+    async def m_sendchataction(self, token, p):
+        return _ok(True)
+
+    async def m_answercallbackquery(self, token, p):
+        return _ok(True)
+
+    async def m_setmycommands(self, token, p):
+        self.commands = p.get("commands") or []
+        return _ok(True)
+
+    async def m_getmycommands(self, token, p):
+        return _ok(self.commands)
+
+    async def m_deletemycommands(self, token, p):
+        self.commands = []
+        return _ok(True)
+
+    async def m_sendinvoice(self, token, p):
+        chat_id = int(p["chat_id"])
+        amount = sum(int(x["amount"]) for x in p.get("prices") or [])
+        invoice = {"title": p["title"], "description": p.get("description", ""), "start_parameter": "",
+                   "currency": p["currency"], "total_amount": amount}
+        msg = self._store_message(token, chat_id, invoice=invoice)
+        if self.config.auto_pay:
+            query_id = f"pcq{chat_id}_{msg['message_id']}"
+            self._invoices[query_id] = {"chat_id": chat_id, "payload": p["payload"], "currency": p["currency"],
+                                        "total_amount": amount}
+            self.push(self._pre_checkout(chat_id, query_id, p["payload"], p["currency"], amount))
+        return _ok(msg)
+
+    async def m_answerprecheckoutquery(self, token, p):
+        inv = self._invoices.pop(p["pre_checkout_query_id"], None)
+        if inv and p.get("ok") in ("true", True):
+            self.push(self._payment_message(inv["chat_id"], inv["payload"], inv["currency"], inv["total_amount"]))
+        return _ok(True)
+
+    async def m_getfile(self, token, p):
+        file_id = p["file_id"]
+        if file_id not in self.files:
+            return _error(400, "Bad Request: invalid file_id")
+        return _ok({"file_id": file_id, "file_unique_id": "u" + file_id, "file_size": len(self.files[file_id]),
+                    "file_path": f"photos/{file_id}.jpg"})
+
+    async def file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["path"].rsplit("/", 1)[-1].rsplit(".", 1)[0]
+        data = self.files.get(file_id)
+        self._count("file.download")
+        if data is None:
+            return web.Response(status=404)
+        await asyncio.sleep(sample_latency_s(self.rng, self.config.latency, self.config.latency_ms,
+                                             self.config.latency_jitter_ms))
+        return web.Response(body=data, content_type="image/jpeg")
+
+    # --- simulated users ---
+    def push(self, update: dict) -> int:
+        """Assign an update_id and deliver the update (webhook if set, otherwise getUpdates)."""
+        self._update_id += 1
+        update = {**update, "update_id": self._update_id}
+        if self.webhook:
+            asyncio.get_running_loop().create_task(self._post_webhook(update))
+        else:
+            self._updates.append(update)
+            self._new_update.set()
+        self._count("updates")
+        return self._update_id
+
+    async def _post_webhook(self, update: dict):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook.get("secret_token", "")}
+        try:
+            async with self._session.post(self.webhook["url"], json=update, headers=headers) as resp:
+                self._count(f"webhook.{resp.status}")
+        except Exception as e:
+            self._count("webhook.error")
+            log.warning("Webhook delivery failed: %s", e)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+
+    def _user_message(self, user_id: int, **content) -> dict:
+        # входящие сообщения делят нумерацию с исходящими, как в личном чате
+        mid = self._message_id.get(user_id, 0) + 1
+        self._message_id[user_id] = mid
+        return {"message": {"message_id": mid, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                            "from": self._user(user_id), **content}}
+
+    def _pre_checkout(self, user_id: int, query_id: str, payload: str, currency: str, amount: int) -> dict:
+        return {"pre_checkout_query": {"id": query_id, "from": self._user(user_id), "currency": currency,
+                                       "total_amount": amount, "invoice_payload": payload}}
+
+    def _payment_message(self, user_id: int, payload: str, currency: str = "XTR", amount: int = 1) -> dict:
+        charge = f"mock_{user_id}_{self._update_id + 1}"
+        return self._user_message(user_id, successful_payment={
+            "currency": currency, "total_amount": amount, "invoice_payload": payload,
+            "telegram_payment_charge_id": charge, "provider_payment_charge_id": charge,
+        })
+
+    def _photo(self, user_id: int, data: bytes | None = None) -> list[dict]:
+        file_id = f"photo{user_id}_{len(self.files) + 1}"
+        self.files[file_id] = data or _synthetic_jpeg(self.rng)
+        return [{"file_id": file_id, "file_unique_id": "u" + file_id, "width": 768, "height": 1024,
+                 "file_size": len(self.files[file_id])}]
+
+    def build_update(self, spec: dict) -> dict:
+        if "update" in spec:
+            return spec["update"]
+        user_id = int(spec["user_id"])
+        if "text" in spec:
+            text = spec["text"]
+            content = {"text": text}
+            if text.startswith("/"):
+                cmd = text.split()[0]
+                content["entities"] = [{"type": "bot_command", "offset": 0, "length": len(cmd)}]
+            return self._user_message(user_id, **content)
+        if "callback_data" in spec:
+            # кнопка под последним сообщением бота в этом чате
+            mid = spec.get("message_id") or self._message_id.get(user_id, 0)
+            message = self.messages.get((user_id, mid)) or {
+                "message_id": mid, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}}
+            return {"callback_query": {"id": f"cq{user_id}_{self._update_id + 1}", "from": self._user(user_id),
+                                       "chat_instance": str(user_id), "data": spec["callback_data"], "message": message}}
+        if "photo" in spec:
+            data = spec["photo"].encode("latin-1") if isinstance(spec["photo"], str) else None
+            return self._user_message(user_id, photo=self._photo(user_id, data))
+        if "pre_checkout" in spec:
+            return self._pre_checkout(user_id, f"pcq{user_id}_{self._update_id + 1}", spec["pre_checkout"],
+                                      "XTR", int(spec.get("total_amount", 1)))
+        if "successful_payment" in spec:
+            return self._payment_message(user_id, spec["successful_payment"], "XTR", int(spec.get("total_amount", 1)))
+        raise ValueError("unknown update spec")
+
+    async def post_updates(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        specs = data if isinstance(data, list) else [data]
+        try:
+            ids = [self.push(self.build_update(s)) for s in specs]
+        except (KeyError, ValueError) as e:
+            return web.json_response({"error": str(e)}, status=400)
+        return web.json_response({"update_ids": ids})
+
+    # --- control ---
+    async def get_calls(self, request: web.Request) -> web.Response:
+        method = request.query.get("method")
+        chat_id = request.query.get("chat_id")
+        calls = [c for c in self.calls
+                 if (not method or c["method"].lower() == method.lower())
+                 and (not chat_id or str(c["params"].get("chat_id")) == chat_id)]
+        return web.json_response(calls)
+
+    async def clear_calls(self, request: web.Request) -> web.Response:
+        self.calls.clear()
+        return web.json_response({"ok": True})
+
+    async def get_config(self, request: web.Request) -> web.Response:
+        return web.json_response(asdict(self.config))
+
+    async def set_config(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        known = {f.name for f in fields(MockTelegramConfig)}
+        for k, v in data.items():
+            if k in known:
+                setattr(self.config, k, v)
+        if "seed" in data:
+            self.rng.seed(data["seed"])
+        return web.json_response(asdict(self.config))
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "pending_updates": len(self._updates)})
+
+    async def _close(self, app: web.Application):
+        if self._session:
+            await self._session.close()
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.api)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.file)
+        app.router.add_post("/_mock/updates", self.post_updates)
+        app.router.add_get("/_mock/calls", self.get_calls)
+        app.router.add_delete("/_mock/calls", self.clear_calls)
+        app.router.add_get("/_mock/config", self.get_config)
+        app.router.add_post("/_mock/config", self.set_config)
+        app.router.add_get("/_mock/stats", self.get_stats)
+        app.on_cleanup.append(self._close)
+        return app
+
+
+def _synthetic_jpeg(rng: random.Random) -> bytes:
+    """A palm-coloured 768x1024 JPEG with a few dark "lines" (enough for the photo pipeline)."""
+    if Image is None:
+        return b"\xff\xd8\xff\xd9"
+    img = Image.new("RGB", (768, 1024), (rng.randint(190, 225), rng.randint(150, 180), rng.randint(120, 150)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(4):
+        y = rng.randint(300, 800)
+        draw.line([(100, y), (400, y + rng.randint(-120, 120)), (680, y + rng.randint(-60, 60))],
+                  fill=(120, 80, 70), width=6)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the Telegram Bot API for the bot")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    defaults = MockTelegramConfig()
+    for f in fields(MockTelegramConfig):
+        flag = "--" + f.name.replace("_", "-")
+        if f.name == "latency":
+            parser.add_argument(flag, default=defaults.latency, choices=["fixed", "uniform", "normal", "lognormal", "exp"])
+        elif f.name == "seed":
+            parser.add_argument(flag, type=int, default=None)
+        elif f.name == "blocked_chats":
+            parser.add_argument(flag, type=int, nargs="*", default=[])
+        elif f.name == "auto_pay":
+            parser.add_argument(flag, action="store_true")
+        else:
+            parser.add_argument(flag, type=type(getattr(defaults, f.name)), default=getattr(defaults, f.name))
+    args = parser.parse_args()
+    config = MockTelegramConfig(**{f.name: getattr(args, f.name) for f in fields(MockTelegramConfig)})
+
+    logging.basicConfig(format="%(asctime)s [%(levelname)s] %(name)s: %(message)s", level=logging.INFO)
+    log.info("Mock Telegram Bot API on http://%s:%s (%s)", args.host, args.port, asdict(config))
+    web.run_app(MockTelegram(config).build_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# src/outbox.py
+"""
+Durable outbox for report delivery.
+
+Generation and delivery are separate: a finished report is rendered into chunks and
+written to the `outbox` table (one row per message, ordered by seq), and the background
+sender delivers them. A failed send never loses the LLM result and never triggers
+regeneration:
+  - RetryAfter pauses the shared Telegram token bucket and reschedules the message;
+  - network errors and timeouts are retried with jittered exponential backoff
+    (src.retry) up to OUTBOX_MAX_ATTEMPTS;
+  - an HTML parse error switches the message to plain text and sends it again;
+  - Forbidden (bot blocked) fails the chat's remaining messages.
+Messages of one chat go strictly in order; different chats are delivered concurrently.
+Pending rows survive a restart: the sender picks them up from post_init. `stop` (from
+post_shutdown) lets sends already in flight finish and record their status before the
+task ends, so a message is not sent a second time after the restart. Sent rows stay
+in the table, so `resend` can deliver a past report again without rendering it.
+"""
+import asyncio
+import json
+import logging
+import re
+import time
+from datetime import datetime
+from html import unescape
+from typing import Iterable
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from . import retry, tracing
+from .config import OUTBOX_MAX_ATTEMPTS, OUTBOX_CONCURRENCY
+from .ratelimit import TELEGRAM_BUCKET, retry_after_seconds
+from .storage import _conn
+
+log = logging.getLogger("astro-num-bot.outbox")
+
+_POLICY = retry.RetryPolicy(max_retries=OUTBOX_MAX_ATTEMPTS, base_delay_s=1.0, max_delay_s=60.0, max_retry_after_s=3600.0)
+
+_wake: asyncio.Event | None = None
+_task: asyncio.Task | None = None
+_stopping = False
+# сколько ждём отправки, которые уже в полёте, прежде чем отменить задачу
+_STOP_GRACE_S = 10.0
+
+
+def init_outbox_db():
+    con = _conn(); cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS outbox(
+        id               INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id         INTEGER,
+        chat_id          INTEGER,
+        seq              INTEGER,
+        kind             TEXT,
+        text             TEXT,
+        reply_markup     TEXT,
+        status           TEXT,
+        attempts         INTEGER DEFAULT 0,
+        next_attempt_at  REAL,
+        last_error       TEXT,
+        created_at       TEXT,
+        sent_at          TEXT
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(status, next_attempt_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox(chat_id, status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_order ON outbox(order_id, seq)")
+    con.commit(); con.close()
+
+
+def enqueue(chat_id: int, chunks: Iterable[str], *, order_id: int | None = None,
+            kind: str = "html", tail: tuple[str, InlineKeyboardMarkup | None] | None = None) -> int:
+    """Store messages for delivery (chunks in order, then an optional (text, keyboard) tail)."""
+    now = datetime.utcnow().isoformat()
+    due = time.time()
+    rows = [(order_id, chat_id, seq, kind, text, None, "pending", due, now) for seq, text in enumerate(chunks)]
+    if tail:
+        text, markup = tail
+        rows.append((order_id, chat_id, len(rows), "text", text,
+                     json.dumps(markup.to_dict()) if markup else None, "pending", due, now))
+    con = _conn(); cur = con.cursor()
+    cur.executemany(
+        """INSERT INTO outbox(order_id, chat_id, seq, kind, text, reply_markup, status, next_attempt_at, created_at)
+           VALUES(?,?,?,?,?,?,?,?,?)""",
+        rows,
+    )
+    con.commit(); con.close()
+    wake()
+    return len(rows)
+
+
+def resend(order_id: int, chat_id: int) -> int:
+    """Queue the messages of the order's first delivery again (as finally sent); 0 if there are none."""
+    now = datetime.utcnow().isoformat()
+    con = _conn(); cur = con.cursor()
+    # все строки одного enqueue() имеют одинаковый created_at
+    cur.execute(
+        """INSERT INTO outbox(order_id, chat_id, seq, kind, text, reply_markup, status, next_attempt_at, created_at)
+           SELECT order_id, ?, seq, kind, text, reply_markup, 'pending', ?, ? FROM outbox
+           WHERE order_id=? AND created_at=(SELECT MIN(created_at) FROM outbox WHERE order_id=?)
+           ORDER BY seq""",
+        (chat_id, time.time(), now, order_id, order_id),
+    )
+    n = cur.rowcount
+    con.commit(); con.close()
+    if n:
+        wake()
+    return n
+
+
+def has_pending(order_id: int, chat_id: int) -> bool:
+    """True while messages of the order are still waiting to be sent to this chat."""
+    con = _conn(); cur = con.cursor()
+    cur.execute("SELECT 1 FROM outbox WHERE order_id=? AND chat_id=? AND status='pending' LIMIT 1", (order_id, chat_id))
+    row = cur.fetchone()
+    con.close()
+    return row is not None
+
+
+def wake():
+    if _wake is not None:
+        _wake.set()
+
+
+def _due_heads(now: float, limit: int) -> list[tuple]:
+    """First pending message of every chat whose turn has come."""
+    con = _conn(); cur = con.cursor()
+    cur.execute(
+        """SELECT id, chat_id, kind, text, reply_markup, attempts, order_id, seq FROM outbox o
+           WHERE status='pending' AND next_attempt_at<=?
+             AND NOT EXISTS (SELECT 1 FROM outbox p WHERE p.chat_id=o.chat_id AND p.status='pending' AND p.id<o.id)
+           ORDER BY id LIMIT ?""",
+        (now, limit),
+    )
+    rows = cur.fetchall()
+    con.close()
+    return rows
+
+
+def _next_due() -> float | None:
+    con = _conn(); cur = con.cursor()
+    cur.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status='pending'")
+    row = cur.fetchone()
+    con.close()
+    return row[0] if row else None
+
+
+def _update(row_id: int, **fields):
+    cols = ", ".join(f"{k}=?" for k in fields)
+    con = _conn(); cur = con.cursor()
+    cur.execute(f"UPDATE outbox SET {cols} WHERE id=?", (*fields.values(), row_id))
+    con.commit(); con.close()
+
+
+def _fail_chat(chat_id: int, error: str):
+    con = _conn(); cur = con.cursor()
+    cur.execute("UPDATE outbox SET status='failed', last_error=? WHERE chat_id=? AND status='pending'", (error, chat_id))
+    con.commit(); con.close()
+
+
+def to_plain_text(html: str) -> str:
+    return unescape(re.sub(r"<[^>]+>", "", html))
+
+
+async def _deliver(bot, row: tuple):
+    row_id, chat_id, kind, text, markup_json, attempts, order_id, seq = row
+    markup = InlineKeyboardMarkup.de_json(json.loads(markup_json), bot) if markup_json else None
+    try:
+        # ожидание токена входит в спан: для пользователя это тоже задержка доставки
+        with tracing.span("deliver", order_id=order_id, seq=seq):
+            await TELEGRAM_BUCKET.acquire()
+            await bot.send_message(
+                chat_id=chat_id, text=text, reply_markup=markup,
+                parse_mode="HTML" if kind == "html" else None,
+            )
+    except RetryAfter as e:
+        delay = retry.backoff_delay(_POLICY, attempts, retry_after_seconds(e))
+        TELEGRAM_BUCKET.pause(delay)
+        _update(row_id, next_attempt_at=time.time() + delay, last_error=str(e))
+        return
+    except Forbidden as e:
+        _fail_chat(chat_id, str(e))
+        return
+    except BadRequest as e:
+        if kind == "html" and "parse" in str(e).lower():
+            # Сломанная разметка — отправим тот же текст без HTML
+            log.warning("Outbox #%s: HTML rejected (%s), falling back to plain text", row_id, e)
+            _update(row_id, kind="text", text=to_plain_text(text), last_error=str(e))
+            return
+        log.warning("Outbox #%s failed: %s", row_id, e)
+        _update(row_id, status="failed", attempts=attempts + 1, last_error=str(e))
+        return
+    except Exception as e:
+        # сеть, таймауты и прочие временные сбои — повтор с backoff
+        if attempts + 1 >= _POLICY.max_retries:
+            log.warning("Outbox #%s gave up after %s attempts: %s", row_id, attempts + 1, e)
+            _update(row_id, status="failed", attempts=attempts + 1, last_error=str(e))
+        else:
+            delay = retry.backoff_delay(_POLICY, attempts)
+            _update(row_id, attempts=attempts + 1, next_attempt_at=time.time() + delay, last_error=str(e))
+        return
+    _update(row_id, status="sent", attempts=attempts + 1, sent_at=datetime.utcnow().isoformat())
+
+
+async def run(bot):
+    """Sender loop: deliver due heads concurrently, then sleep until woken or the next retry is due."""
+    global _wake
+    _wake = asyncio.Event()
+    while not _stopping:
+        try:
+            # сбрасываем до выборки, чтобы не потерять enqueue между выборкой и ожиданием
+            _wake.clear()
+            heads = _due_heads(time.time(), OUTBOX_CONCURRENCY)
+            if _stopping:
+                break
+            if heads:
+                await asyncio.gather(*(_deliver(bot, row) for row in heads), return_exceptions=True)
+                continue
+            nxt = _next_due()
+            timeout = None if nxt is None else max(0.05, nxt - time.time())
+            try:
+                await asyncio.wait_for(_wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception("Outbox sender error: %s", e)
+            await asyncio.sleep(1.0)
+
+
+def start(bot) -> asyncio.Task:
+    global _task, _stopping
+    _stopping = False
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(run(bot))
+    return _task
+
+
+async def stop():
+    """Finish the sends in flight, then end the sender (cancel it after _STOP_GRACE_S)."""
+    global _task, _stopping
+    if _task is None:
+        return
+    _stopping = True
+    wake()
+    try:
+        await asyncio.wait_for(asyncio.shield(_task), timeout=_STOP_GRACE_S)
+    except asyncio.TimeoutError:
+        log.warning("Outbox sender did not finish in %ss, cancelling", _STOP_GRACE_S)
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+    _task = None
@@ -0,0 +1,155 @@
+# src/palm_cache.py
+"""
+Near-duplicate cache of palm vision reports.
+
+Users re-send the same palm photo after a failed attempt and testers reuse the same
+images, so every processed image gets a 64-bit perceptual hash (DCT pHash, computed in
+the palm_image pool on the final downscaled/cropped image). Reports are stored in SQLite
+under (phash, context hash); a lookup returns the closest stored report whose Hamming
+distance is within PALM_CACHE_MAX_DIST and whose context (prompt version, model, name,
+hand, user text) matches exactly. Old entries expire after PALM_CACHE_TTL_DAYS and the
+table is capped at PALM_CACHE_MAX_ROWS, least recently used first.
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+
+from .config import PALM_CACHE, PALM_CACHE_MAX_DIST, PALM_CACHE_MAX_ROWS, PALM_CACHE_TTL_DAYS
+from .storage import _conn
+
+try:
+    import numpy as np
+except ImportError:  # опциональная зависимость — без неё кэш просто не работает
+    np = None
+
+log = logging.getLogger("astro-num-bot.palm_cache")
+
+_HASH_SIDE = 32
+_DCT_KEEP = 8
+_dct_matrix = None
+
+
+def init_palm_cache_db():
+    con = _conn(); cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS palm_vision_cache(
+        id          INTEGER PRIMARY KEY AUTOINCREMENT,
+        phash       INTEGER,
+        ctx_hash    TEXT,
+        report_json TEXT,
+        model       TEXT,
+        prompt_key  TEXT,
+        hits        INTEGER DEFAULT 0,
+        created_at  TEXT,
+        last_hit_at TEXT
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_palm_vision_cache_ctx ON palm_vision_cache(ctx_hash)")
+    con.commit(); con.close()
+
+
+def _dct(n: int):
+    global _dct_matrix
+    if _dct_matrix is None:
+        k = np.arange(n)[:, None]
+        i = np.arange(n)[None, :]
+        _dct_matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    return _dct_matrix
+
+
+def phash(img) -> str | None:
+    """64-bit pHash of a PIL image as 16 hex chars. Runs in a palm_image pool worker."""
+    if np is None:
+        return None
+    from PIL import Image
+    small = img.convert("L").resize((_HASH_SIDE, _HASH_SIDE), Image.LANCZOS)
+    m = _dct(_HASH_SIDE)
+    coeffs = m @ np.asarray(small, dtype=np.float64) @ m.T
+    low = coeffs[:_DCT_KEEP, :_DCT_KEEP].flatten()
+    # DC-коэффициент не участвует в медиане — он отражает только общую яркость
+    bits = low > np.median(low[1:])
+    value = 0
+    for b in bits:
+        value = (value << 1) | int(b)
+    return f"{value:016x}"
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _to_db(h: str) -> int:
+    # SQLite INTEGER знаковый: переводим 64-битный хэш в диапазон int64
+    v = int(h, 16)
+    return v - (1 << 64) if v >= (1 << 63) else v
+
+
+def _from_db(v: int) -> int:
+    return v + (1 << 64) if v < 0 else v
+
+
+def context_hash(**parts) -> str:
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def lookup(h: str | None, ctx_hash: str, max_dist: int = PALM_CACHE_MAX_DIST) -> dict | None:
+    """Closest cached report within max_dist for this context: {"id", "distance", "report"} or None."""
+    if not PALM_CACHE or not h:
+        return None
+    target = int(h, 16)
+    min_created = (datetime.utcnow() - timedelta(days=PALM_CACHE_TTL_DAYS)).isoformat()
+    con = _conn(); cur = con.cursor()
+    cur.execute(
+        "SELECT id, phash FROM palm_vision_cache WHERE ctx_hash=? AND created_at>=?",
+        (ctx_hash, min_created),
+    )
+    best = None
+    for row_id, stored in cur.fetchall():
+        d = hamming(target, _from_db(stored))
+        if d <= max_dist and (best is None or d < best[1]):
+            best = (row_id, d)
+    if best is None:
+        con.close()
+        return None
+    cur.execute("SELECT report_json FROM palm_vision_cache WHERE id=?", (best[0],))
+    report = json.loads(cur.fetchone()[0])
+    cur.execute(
+        "UPDATE palm_vision_cache SET hits=hits+1, last_hit_at=? WHERE id=?",
+        (datetime.utcnow().isoformat(), best[0]),
+    )
+    con.commit(); con.close()
+    return {"id": best[0], "distance": best[1], "report": report}
+
+
+def store(h: str | None, ctx_hash: str, report: dict, *, model: str = "", prompt_key: str = ""):
+    if not PALM_CACHE or not h:
+        return
+    now = datetime.utcnow().isoformat()
+    con = _conn(); cur = con.cursor()
+    cur.execute(
+        """INSERT INTO palm_vision_cache(phash, ctx_hash, report_json, model, prompt_key, hits, created_at, last_hit_at)
+           VALUES(?,?,?,?,?,0,?,?)""",
+        (_to_db(h), ctx_hash, json.dumps(report, ensure_ascii=False), model, prompt_key, now, now),
+    )
+    con.commit(); con.close()
+    evict()
+
+
+def evict(max_rows: int = PALM_CACHE_MAX_ROWS, ttl_days: float = PALM_CACHE_TTL_DAYS) -> int:
+    """Drop expired rows, then the least recently used ones above max_rows. Returns rows removed."""
+    min_created = (datetime.utcnow() - timedelta(days=ttl_days)).isoformat()
+    con = _conn(); cur = con.cursor()
+    cur.execute("DELETE FROM palm_vision_cache WHERE created_at<?", (min_created,))
+    removed = cur.rowcount
+    cur.execute(
+        """DELETE FROM palm_vision_cache WHERE id IN (
+               SELECT id FROM palm_vision_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?
+           )""",
+        (max_rows,),
+    )
+    removed += cur.rowcount
+    con.commit(); con.close()
+    if removed:
+        log.info("palm vision cache: evicted %d rows", removed)
+    return removed
@@ -0,0 +1,109 @@
+# src/palm_detect.py
+"""
+CPU-only palm localization used to crop photos to the hand before the vision call.
+
+MediaPipe Hands (if installed) gives 21 landmarks; the crop is their bounding box plus
+a margin. Without MediaPipe a classical skin segmentation in YCbCr (NumPy) is used: the
+crop is the trimmed extent of skin pixels. Both run inside the palm_image process
+pool; `init_worker()` loads the model once per worker and `warm_up()` pays the first
+inference cost at startup, so per-photo detection stays in tens of milliseconds.
+"""
+import logging
+
+try:
+    import numpy as np
+except ImportError:  # опциональная зависимость
+    np = None
+
+log = logging.getLogger("astro-num-bot.palm_detect")
+
+# Детекцию гоняем на уменьшенной копии — для рамки этого достаточно
+DETECT_SIDE = 256
+# Доля кожи ниже порога — считаем, что руки в кадре нет
+_MIN_SKIN_FRACTION = 0.04
+
+_hands = None  # mediapipe Hands, по одному на процесс-воркер
+
+
+def init_worker():
+    """Process pool initializer: load the landmark model once per worker."""
+    global _hands
+    if _hands is not None:
+        return
+    try:
+        import mediapipe as mp
+    except ImportError:
+        _hands = False  # нет mediapipe — работаем на сегментации кожи
+        return
+    try:
+        _hands = mp.solutions.hands.Hands(
+            static_image_mode=True, max_num_hands=1, model_complexity=0, min_detection_confidence=0.3,
+        )
+    except Exception as e:
+        # mediapipe стоит, но без mp.solutions.hands (другая версия) — об этом надо знать
+        log.warning("mediapipe %s: Hands unavailable (%s), falling back to skin segmentation",
+                    getattr(mp, "__version__", "?"), e)
+        _hands = False
+
+
+def warm_up() -> str:
+    """Run one dummy detection so the first real photo doesn't pay model init costs."""
+    init_worker()
+    if np is not None:
+        detect(np.zeros((DETECT_SIDE, DETECT_SIDE, 3), dtype=np.uint8))
+    return "mediapipe" if _hands else "skin"
+
+
+def _skin_mask(rgb: "np.ndarray") -> "np.ndarray":
+    r, g, b = (rgb[..., i].astype(np.float32) for i in range(3))
+    cr = 128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+    cb = 128 - 0.168736 * r - 0.331264 * g + 0.5 * b
+    return (cr >= 133) & (cr <= 173) & (cb >= 77) & (cb <= 127)
+
+
+def detect(rgb: "np.ndarray") -> dict:
+    """
+    rgb: HxWx3 uint8 (already downscaled to ~DETECT_SIDE).
+    Returns {"box": (x0, y0, x1, y1) in relative coords or None, "score": float, "method": str}.
+    """
+    if _hands is None:
+        init_worker()
+    if _hands:
+        res = _hands.process(rgb)
+        if res.multi_hand_landmarks:
+            pts = res.multi_hand_landmarks[0].landmark
+            xs = [p.x for p in pts]; ys = [p.y for p in pts]
+            score = 1.0
+            if res.multi_handedness:
+                score = float(res.multi_handedness[0].classification[0].score)
+            return {"box": (min(xs), min(ys), max(xs), max(ys)), "score": score, "method": "mediapipe"}
+
+    mask = _skin_mask(rgb)
+    frac = float(mask.mean()) if mask.size else 0.0
+    if frac < _MIN_SKIN_FRACTION:
+        return {"box": None, "score": frac, "method": "skin"}
+    ys, xs = np.nonzero(mask)
+    h, w = mask.shape
+    # обрезаем выбросы (фон "под кожу"), берём 2..98 перцентили
+    x0, x1 = np.percentile(xs, [2, 98]) / w
+    y0, y1 = np.percentile(ys, [2, 98]) / h
+    # оценка "рука в кадре": насколько плотно кожа заполняет найденную рамку
+    box_area = max(1e-6, (x1 - x0) * (y1 - y0))
+    score = float(min(1.0, frac / box_area))
+    return {"box": (float(x0), float(y0), float(x1), float(y1)), "score": score, "method": "skin"}
+
+
+def crop_box(box, size: tuple[int, int], margin: float) -> tuple[int, int, int, int] | None:
+    """Relative box -> pixel crop with margin, clamped to the image; None if the crop is pointless."""
+    if not box:
+        return None
+    w, h = size
+    x0, y0, x1, y1 = box
+    mx, my = (x1 - x0) * margin, (y1 - y0) * margin
+    left, top = max(0, int((x0 - mx) * w)), max(0, int((y0 - my) * h))
+    right, bottom = min(w, int((x1 + mx) * w)), min(h, int((y1 + my) * h))
+    if right - left < w * 0.2 or bottom - top < h * 0.2:
+        return None  # слишком маленькая рамка — скорее ошибка детекции
+    if (right - left) * (bottom - top) > 0.92 * w * h:
+        return None  # рука и так занимает весь кадр
+    return left, top, right, bottom
@@ -0,0 +1,141 @@
+# src/palm_image.py
+"""
+Palm photo preprocessing before the vision call.
+
+Vision latency and token cost grow with the number of pixels, so the photo is
+EXIF-oriented, cropped to the palm (src.palm_detect, PALM_CROP), downscaled to
+PALM_IMAGE_MAX_SIDE, optionally contrast-normalized or converted to grayscale
+(PALM_IMAGE_MODE) and re-encoded as a compact JPEG/WebP data URI. The CPU work runs
+in a small process pool so it never blocks the event loop; each worker loads the hand
+detector once and `warm_up()` primes all workers at startup. The perceptual hash of the
+processed image (info["phash"]) feeds the near-duplicate cache in src.palm_cache.
+
+Without Pillow installed the original bytes are passed through unchanged.
+"""
+import asyncio
+import base64
+import io
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from . import palm_cache, palm_detect, palm_quality
+from .config import (
+    PALM_IMAGE_MAX_SIDE, PALM_IMAGE_MODE, PALM_IMAGE_FORMAT, PALM_IMAGE_QUALITY, PALM_IMAGE_WORKERS,
+    PALM_CROP, PALM_CROP_MARGIN,
+)
+
+try:
+    from PIL import Image, ImageOps, ImageStat
+except ImportError:  # опциональная зависимость
+    Image = None
+
+log = logging.getLogger("astro-num-bot.palm_image")
+
+# Ниже этого стандартного отклонения яркости считаем фото "плоским" и растягиваем контраст
+_LOW_CONTRAST_STDDEV = 40.0
+
+
+def _crop_to_palm(img, margin: float) -> tuple[object, dict]:
+    if palm_detect.np is None:
+        return img, {"method": "none"}
+    small = img.convert("RGB")
+    small.thumbnail((palm_detect.DETECT_SIDE, palm_detect.DETECT_SIDE))
+    det = palm_detect.detect(palm_detect.np.asarray(small))
+    box = palm_detect.crop_box(det["box"], img.size, margin)
+    info = {"method": det["method"], "score": round(det["score"], 3), "box": list(box) if box else None}
+    return (img.crop(box) if box else img), info
+
+
+def preprocess(data: bytes, max_side: int = PALM_IMAGE_MAX_SIDE, mode: str = PALM_IMAGE_MODE,
+               fmt: str = PALM_IMAGE_FORMAT, quality: int = PALM_IMAGE_QUALITY,
+               crop: bool = PALM_CROP, crop_margin: float = PALM_CROP_MARGIN) -> tuple[bytes, str, dict]:
+    """Runs in a worker process. Returns (encoded bytes, mime type, info)."""
+    t0 = time.perf_counter()
+    img = Image.open(io.BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+    orig_w, orig_h = img.size
+    crop_info = None
+    if crop:
+        img, crop_info = _crop_to_palm(img, crop_margin)
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    img = img.convert("RGB")
+
+    applied = []
+    if mode == "gray":
+        img = ImageOps.grayscale(img)
+        applied.append("gray")
+    elif mode == "autocontrast" or (mode == "auto" and ImageStat.Stat(img.convert("L")).stddev[0] < _LOW_CONTRAST_STDDEV):
+        img = ImageOps.autocontrast(img, cutoff=1)
+        applied.append("autocontrast")
+    image_hash = palm_cache.phash(img)
+
+    buf = io.BytesIO()
+    if fmt == "webp":
+        img.save(buf, format="WEBP", quality=quality, method=4)
+        mime = "image/webp"
+    else:
+        img.save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+        mime = "image/jpeg"
+    out = buf.getvalue()
+    return out, mime, {
+        "orig_size": [orig_w, orig_h], "size": list(img.size),
+        "orig_bytes": len(data), "bytes": len(out),
+        "applied": applied, "crop": crop_info, "phash": image_hash, "prep_ms": round((time.perf_counter() - t0) * 1000, 1),
+    }
+
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PALM_IMAGE_WORKERS, initializer=palm_detect.init_worker)
+    return _pool
+
+
+async def warm_up():
+    """Start all pool workers and run one dummy detection in each (called once at bot startup)."""
+    if Image is None:
+        return
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    methods = await asyncio.gather(
+        *(loop.run_in_executor(pool, palm_detect.warm_up) for _ in range(PALM_IMAGE_WORKERS)),
+        return_exceptions=True,
+    )
+    log.info("palm image workers warmed up: %s", methods)
+
+
+def to_data_uri(data: bytes, mime: str = "image/jpeg") -> str:
+    return f"data:{mime};base64," + base64.b64encode(data).decode("ascii")
+
+
+async def prepare_for_vision(data: bytes, **kwargs) -> tuple[str, dict]:
+    """Preprocess in the process pool and return (data URI, info). Falls back to the original bytes."""
+    if Image is None:
+        return to_data_uri(data), {"bytes": len(data), "applied": ["passthrough"]}
+    loop = asyncio.get_running_loop()
+    try:
+        out, mime, info = await loop.run_in_executor(_get_pool(), _preprocess_call, data, kwargs)
+    except Exception as e:
+        log.warning("palm preprocessing failed, sending original: %s", e)
+        return to_data_uri(data), {"bytes": len(data), "applied": ["passthrough"], "error": str(e)}
+    return to_data_uri(out, mime), info
+
+
+async def check_quality(data: bytes) -> dict:
+    """Run the palm_quality gate in the pool. Errors never block the user: the photo is accepted."""
+    if Image is None:
+        return {"ok": True, "reasons": [], "metrics": {"skipped": True}}
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_get_pool(), palm_quality.assess, data)
+    except Exception as e:
+        log.warning("palm quality check failed, accepting photo: %s", e)
+        return {"ok": True, "reasons": [], "metrics": {"error": str(e)}}
+
+
+def _preprocess_call(data: bytes, kwargs: dict):
+    return preprocess(data, **kwargs)
@@ -0,0 +1,88 @@
+# src/palm_quality.py
+"""
+Fast local quality check for palm photos, run in photo_router before anything is paid for.
+
+Checks (on a ~512px grayscale copy, NumPy only):
+  - resolution: the short side of the original must be at least PALM_MIN_SIDE;
+  - blur: variance of the 4-neighbour Laplacian below PALM_BLUR_MIN_VAR means blurry;
+  - exposure: mean luminance and the share of crushed shadows / blown highlights;
+  - hand presence: coarse score from src.palm_detect (landmarks or skin segmentation).
+Poor photos are rejected instantly with a retake hint instead of going to the vision model.
+"""
+import io
+
+from . import palm_detect
+from .config import PALM_MIN_SIDE, PALM_BLUR_MIN_VAR, PALM_HAND_MIN_SCORE
+
+try:
+    import numpy as np
+    from PIL import Image, ImageOps
+except ImportError:  # опциональные зависимости — без них проверка пропускается
+    np = None
+
+_ANALYZE_SIDE = 512
+
+HINTS = {
+    "small": "фото слишком маленькое — отправь его как обычное фото, не превью",
+    "blurry": "фото размыто — держи телефон неподвижно и дай камере сфокусироваться на ладони",
+    "dark": "слишком темно — сфотографируй при дневном свете или включи свет",
+    "overexposed": "фото пересвечено — убери вспышку и прямой свет на ладонь",
+    "no_hand": "не видно ладони — сфотографируй раскрытую ладонь крупно, чтобы она занимала большую часть кадра",
+}
+
+
+def assess(data: bytes) -> dict:
+    """Runs in a palm_image pool worker. Returns {"ok", "reasons", "metrics"}."""
+    if np is None:
+        return {"ok": True, "reasons": [], "metrics": {"skipped": True}}
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    w, h = img.size
+    reasons = []
+    if min(w, h) < PALM_MIN_SIDE:
+        reasons.append("small")
+
+    rgb = img.convert("RGB")
+    rgb.thumbnail((_ANALYZE_SIDE, _ANALYZE_SIDE))
+    gray = np.asarray(rgb.convert("L"), dtype=np.float32)
+
+    # Лапласиан 4-соседей без OpenCV
+    lap = (
+        -4.0 * gray[1:-1, 1:-1]
+        + gray[:-2, 1:-1] + gray[2:, 1:-1]
+        + gray[1:-1, :-2] + gray[1:-1, 2:]
+    )
+    blur_var = float(lap.var()) if lap.size else 0.0
+    if blur_var < PALM_BLUR_MIN_VAR:
+        reasons.append("blurry")
+
+    mean = float(gray.mean())
+    dark_frac = float((gray < 20).mean())
+    bright_frac = float((gray > 245).mean())
+    if mean < 45 or dark_frac > 0.5:
+        reasons.append("dark")
+    elif mean > 220 or bright_frac > 0.4:
+        reasons.append("overexposed")
+
+    small = rgb.copy()
+    small.thumbnail((palm_detect.DETECT_SIDE, palm_detect.DETECT_SIDE))
+    det = palm_detect.detect(np.asarray(small))
+    hand_score = det["score"] if det["box"] else 0.0
+    if hand_score < PALM_HAND_MIN_SCORE:
+        reasons.append("no_hand")
+
+    return {
+        "ok": not reasons,
+        "reasons": reasons,
+        "metrics": {
+            "size": [w, h], "blur_var": round(blur_var, 1), "mean": round(mean, 1),
+            "dark_frac": round(dark_frac, 3), "bright_frac": round(bright_frac, 3),
+            "hand_score": round(hand_score, 3), "hand_method": det["method"],
+        },
+    }
+
+
+def retake_hint(reasons: list[str]) -> str:
+    lines = ["Фото не подходит для разбора 🙏"]
+    lines += ["• " + HINTS[r] for r in reasons if r in HINTS]
+    lines.append("\nПришли, пожалуйста, новое фото правой ладони.")
+    return "\n".join(lines)
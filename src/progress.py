@@ -0,0 +1,240 @@
+# src/progress.py
+"""
+Progress feedback while a report is being generated.
+
+`GenerationStatus` wraps one generation job (20–60 s of waiting on the LLM):
+  - it sends one status message and then only edits it: title, stage and, while the job
+    waits for a free slot of GENERATION_QUEUE (GEN_CONCURRENCY jobs at a time), its
+    place in the queue;
+  - a heartbeat task repeats ChatAction.TYPING every TYPING_INTERVAL_S (Telegram shows
+    the indicator for about 5 s) until the job ends or is cancelled.
+Heartbeat calls are optional traffic: they go through `TELEGRAM_BUCKET.try_acquire`
+with a reserve, so under load (or during a RetryAfter pause) they are skipped instead of
+delaying real messages, and status edits are coalesced to one per STATUS_EDIT_MIN_S.
+
+Generation code reports progress without passing the status around:
+`progress.stage("…")` and `progress.done()` act on the job of the current task
+(a context variable), and are no-ops outside of one.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+
+from telegram.constants import ChatAction
+from telegram.error import RetryAfter
+
+from .config import GEN_CONCURRENCY, TYPING_INTERVAL_S, STATUS_EDIT_MIN_S
+from .ratelimit import TELEGRAM_BUCKET, retry_after_seconds
+
+log = logging.getLogger("astro-num-bot.progress")
+
+# необязательные вызовы не берут последние токены: половина burst остаётся настоящим сообщениям
+_RESERVE = TELEGRAM_BUCKET.capacity / 2
+
+
+class GenerationQueue:
+    """FIFO of generation jobs with at most `limit` running; knows each waiter's position."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._running: set = set()
+        self._waiting: list[tuple[object, asyncio.Future]] = []
+
+    def position(self, job) -> int:
+        """1-based place in the queue, 0 if the job is running (or unknown)."""
+        for i, (j, _) in enumerate(self._waiting):
+            if j is job:
+                return i + 1
+        return 0
+
+    async def enter(self, job):
+        if len(self._running) < self.limit and not self._waiting:
+            self._running.add(job)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting.append((job, fut))
+        await fut
+
+    def leave(self, job):
+        if job in self._running:
+            self._running.discard(job)
+            while self._waiting and len(self._running) < self.limit:
+                nxt, fut = self._waiting.pop(0)
+                if not fut.done():
+                    self._running.add(nxt)
+                    fut.set_result(None)
+        else:
+            self._waiting = [(j, f) for j, f in self._waiting if j is not job]
+        # у оставшихся сдвинулась позиция
+        for j, _ in self._waiting:
+            j.poke()
+
+    def report(self) -> str:
+        return f"Генерация: выполняется {len(self._running)} из {self.limit}, в очереди {len(self._waiting)}"
+
+
+GENERATION_QUEUE = GenerationQueue(GEN_CONCURRENCY)
+
+_current: contextvars.ContextVar["GenerationStatus | None"] = contextvars.ContextVar("generation_status", default=None)
+
+
+class GenerationStatus:
+    def __init__(self, bot, chat_id: int, title: str, queue: GenerationQueue = GENERATION_QUEUE):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.title = title
+        self.queue = queue
+        self._stage = "Пишу разбор…"
+        self._done = False
+        self._changed = asyncio.Event()
+        self._message = None
+        self._shown = ""
+        self._edited_at = 0.0
+        self._task: asyncio.Task | None = None
+        self._token = None
+        self._closing = False
+
+    # --- API for generation code ---
+    def stage(self, text: str):
+        self._stage = text
+        self.poke()
+
+    def done(self):
+        self._done = True
+
+    def poke(self):
+        self._changed.set()
+
+    # --- lifecycle ---
+    async def __aenter__(self):
+        self._token = _current.set(self)
+        try:
+            entering = asyncio.ensure_future(self.queue.enter(self))
+            # даём enter() встать в очередь, чтобы первый же статус показал позицию
+            await asyncio.sleep(0)
+            await self._send_status()
+            self._task = asyncio.create_task(self._heartbeat())
+            await entering
+            self.poke()
+        except BaseException as e:
+            entering.cancel()
+            await self._cleanup()
+            if isinstance(e, asyncio.CancelledError):
+                self._drop_status()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._cleanup()
+        if exc_type is asyncio.CancelledError:
+            self._drop_status()
+            return False
+        await self._final_status()
+        return False
+
+    def _drop_status(self):
+        # задачу отменили — ждать нельзя, убираем статус в фоне
+        if self._message:
+            asyncio.get_running_loop().create_task(self._final_status())
+
+    async def _cleanup(self):
+        self.queue.leave(self)
+        if self._task:
+            # флаг нужен помимо cancel(): wait_for в 3.11 теряет отмену, если событие пришло одновременно
+            self._closing = True
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._token is not None:
+            _current.reset(self._token)
+            self._token = None
+
+    # --- Telegram calls ---
+    def _text(self) -> str:
+        pos = self.queue.position(self)
+        stage = f"В очереди: {pos}-й. Начнём, как только освободится место." if pos else self._stage
+        return f"⏳ {self.title}\n{stage}"
+
+    async def _send_status(self):
+        text = self._text()
+        await TELEGRAM_BUCKET.acquire()
+        try:
+            self._message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+            self._shown = text
+            self._edited_at = time.monotonic()
+        except Exception as e:
+            log.warning("Status message for chat %s failed: %s", self.chat_id, e)
+
+    async def _final_status(self):
+        if not self._message:
+            return
+        try:
+            await TELEGRAM_BUCKET.acquire()
+            if self._done:
+                await self._message.edit_text(f"✅ {self.title}: готово, отправляю.")
+            else:
+                # об ошибке генерация уже написала сама — статус больше не нужен
+                await self._message.delete()
+        except Exception as e:
+            log.debug("Final status for chat %s failed: %s", self.chat_id, e)
+
+    async def _optional(self, make_call) -> bool:
+        """Run an optional Bot API call if the bucket allows it now."""
+        if not TELEGRAM_BUCKET.try_acquire(reserve=_RESERVE):
+            return False
+        try:
+            await make_call()
+        except RetryAfter as e:
+            TELEGRAM_BUCKET.pause(retry_after_seconds(e))
+        except Exception as e:
+            log.debug("Heartbeat call for chat %s failed: %s", self.chat_id, e)
+        return True
+
+    async def _heartbeat(self):
+        next_typing = 0.0
+        while not self._closing:
+            # сбрасываем до работы, чтобы не потерять poke() во время вызова API
+            self._changed.clear()
+            now = time.monotonic()
+            text = self._text()
+            waits = []
+            if self._message and text != self._shown:
+                edit_in = self._edited_at + STATUS_EDIT_MIN_S - now
+                if edit_in <= 0:
+                    if await self._optional(lambda: self._message.edit_text(text)):
+                        self._shown = text
+                        self._edited_at = time.monotonic()
+                    else:
+                        waits.append(1.0)
+                else:
+                    waits.append(edit_in)
+            # пока стоим в очереди, "печатает…" не показываем
+            if self.queue.position(self) == 0:
+                if now >= next_typing:
+                    ok = await self._optional(
+                        lambda: self.bot.send_chat_action(chat_id=self.chat_id, action=ChatAction.TYPING)
+                    )
+                    next_typing = now + (TYPING_INTERVAL_S if ok else 1.0)
+                waits.append(next_typing - time.monotonic())
+            timeout = max(0.05, min(waits)) if waits else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+def stage(text: str):
+    """Set the stage shown in the current job's status message (no-op outside a job)."""
+    job = _current.get()
+    if job:
+        job.stage(text)
+
+
+def done():
+    """Mark the current job as delivered successfully."""
+    job = _current.get()
+    if job:
+        job.done()
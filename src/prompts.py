@@ -0,0 +1,254 @@
+# src/prompts.py
+"""
+Prompt registry: every prompt the bot sends to an LLM has a stable id and version.
+
+Static prompts (system / schema instructions) are plain text. Dynamic prompts use
+`{field}` placeholders and are parsed once at registration, so rendering is a simple
+join. Token counts are computed once per template (tiktoken if installed, otherwise a
+~4 chars/token estimate).
+
+Messages are always built static-first (system, schema, then the per-user part) so the
+prompt prefix is byte-identical across calls and provider-side prompt caching can kick
+in. `record_usage()` collects cached-token counts reported by the providers; `report()`
+renders render counts and prompt-cache hit rates for the admin.
+"""
+import hashlib
+import string
+import threading
+
+try:  # опционально: точный подсчёт токенов
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _ENCODING = None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    return max(1, len(text) // 4)
+
+
+class PromptTemplate:
+    """A versioned prompt. `key` (id@vN) is what goes into order meta and cache keys."""
+
+    def __init__(self, id: str, version: int, text: str, *, static: bool = True):
+        self.id = id
+        self.version = version
+        self.text = text
+        self.static = static
+        self.key = f"{id}@v{version}"
+        self.fingerprint = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        # Разбираем шаблон один раз: [(литерал, имя_поля | None), ...]
+        self._parts: list[tuple[str, str | None]] = (
+            [(text, None)] if static
+            else [(lit, field) for lit, field, _spec, _conv in string.Formatter().parse(text)]
+        )
+        self._tokens: int | None = None
+
+    @property
+    def tokens(self) -> int:
+        """Token count of the literal (static) part of the template, computed once."""
+        if self._tokens is None:
+            self._tokens = count_tokens("".join(lit for lit, _ in self._parts))
+        return self._tokens
+
+    def render(self, **values) -> str:
+        _bump(self.key, "renders")
+        if self.static:
+            return self.text
+        return "".join(lit + (str(values.get(field, "")) if field else "") for lit, field in self._parts)
+
+
+_REGISTRY: dict[str, PromptTemplate] = {}
+_stats: dict[str, dict[str, int]] = {}
+_stats_lock = threading.Lock()
+
+
+def _bump(key: str, field: str, n: int = 1):
+    with _stats_lock:
+        st = _stats.setdefault(key, {})
+        st[field] = st.get(field, 0) + n
+
+
+def register(id: str, version: int, text: str, *, static: bool = True) -> PromptTemplate:
+    tpl = PromptTemplate(id, version, text, static=static)
+    _REGISTRY[id] = tpl
+    return tpl
+
+
+def get(id: str) -> PromptTemplate:
+    return _REGISTRY[id]
+
+
+def render(id: str, **values) -> str:
+    return _REGISTRY[id].render(**values)
+
+
+def prefix_key(*ids: str) -> str:
+    """Stable key of a static message prefix, e.g. 'system@v1+natal.developer@v1'."""
+    return "+".join(_REGISTRY[i].key for i in ids)
+
+
+def record_usage(key: str, raw: dict | None):
+    """Accumulate prompt / cached-prompt tokens from an OpenAI-like or Gemini usage block."""
+    if not isinstance(raw, dict):
+        return
+    usage = raw.get("usage") or {}
+    meta = raw.get("usageMetadata") or {}
+    prompt_tokens = usage.get("prompt_tokens") or meta.get("promptTokenCount") or 0
+    details = usage.get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens") or meta.get("cachedContentTokenCount") or 0
+    _bump(key, "calls")
+    _bump(key, "prompt_tokens", int(prompt_tokens))
+    _bump(key, "cached_tokens", int(cached))
+    if cached:
+        _bump(key, "cache_hits")
+
+
+def report() -> str:
+    lines = ["Промпты:"]
+    for tpl in _REGISTRY.values():
+        st = _stats.get(tpl.key, {})
+        lines.append(f"• {tpl.key} [{tpl.fingerprint}] ~{tpl.tokens} tok, рендеров: {st.get('renders', 0)}")
+    calls = {k: v for k, v in _stats.items() if v.get("calls")}
+    if calls:
+        lines.append("")
+        lines.append("Кэш промптов у провайдера:")
+        for key, st in sorted(calls.items()):
+            pt = st.get("prompt_tokens", 0)
+            ct = st.get("cached_tokens", 0)
+            ratio = (100.0 * ct / pt) if pt else 0.0
+            lines.append(
+                f"• {key}: вызовов {st['calls']}, с попаданием {st.get('cache_hits', 0)}, "
+                f"кэшировано {ct}/{pt} tok ({ratio:.0f}%)"
+            )
+    return "\n".join(lines)
+
+
+# --- LLM: Prompt builders for detailed numerology report ---
+SYSTEM_PROMPT = register("system", 1, (
+    "Вы — команда AstroMagic: практикующие астрологи и нумерологи. "
+    "Готовьте развёрнутый, художественно-эзотерический, но структурированный отчёт на русском, "
+    "используя ТОЛЬКО переданные данные. Проверяйте согласованность и мягко отмечайте расхождения. "
+    "Без фатализма и без медицинских/финансовых советов."
+)).text
+
+DEVELOPER_PROMPT = register("numerology.developer", 1, (
+    "Правила вывода: верните СТРОГО один JSON-объект ТОЛЬКО в теле ответа,\n"
+    "без markdown, без пояснений, без комментариев, без подсказок языка.\n"
+    "JSON должен быть МИНИФИЦИРОВАН (в одну строку, без пробелов и переносов),\n"
+    "чтобы исключить артефакты форматирования.\n"
+    "{"
+    "\"title\": str,"
+    "\"summary\": str,"
+    "\"life_path\":{\"value\":int,\"meaning\":str,\"strengths\":[str],\"risks\":[str],\"advice\":[str]},"
+    "\"pythagoras_matrix\":{"
+      "\"grid_text\": str,"
+      "\"lines_overview\":[{\"axis\":str,\"total\":int,\"tone\":str,\"comment\":str}],"
+      "\"digits\":[{\"digit\":int,\"count\":int,\"meaning\":str,\"advice\":str}],"
+      "\"missing\":[int],\"dominant\":[int]"
+    "},"
+    "\"practical_recs\":{\"week\":[str],\"month\":[str],\"focus_areas\":[str]},"
+    "\"data_notes\":[str]"
+    "}"
+)).text
+
+register("numerology.user", 1, (
+    "Ниже — данные пользователя для нумерологического разбора. Проверьте согласованность и подготовьте JSON отчёт.\n\n"
+    "full_name: {full_name}\n"
+    "dob_ddmmyyyy: {dob_ddmmyyyy}\n"
+    "life_path: {life_path}\n\n"
+    "pythagoras_counts:\n{pythagoras_counts}\n\n"
+    "pythagoras_lines:\n{pythagoras_lines}\n\n"
+    "pythagoras_ext:\n{pythagoras_ext}\n"
+), static=False)
+
+
+# --- LLM: Prompt builders for detailed natal report ---
+NATAL_DEVELOPER_PROMPT = register("natal.developer", 1, (
+    "Правила вывода: верните СТРОГО один JSON-объект ТОЛЬКО в теле ответа,\n"
+    "без markdown/комментариев/подсказок языка. Объект ДОЛЖЕН быть минифицирован (в одну строку).\n"
+    "{"
+    "\"title\":str,"
+    "\"summary\":str,"
+    "\"birth\":{\"full_name\":str,\"date\":str,\"time\":(str|null),\"city\":str,\"timezone_note\":str},"
+    "\"chart\":{"
+      "\"sun\":{\"sign\":str,\"comment\":str},"
+      "\"moon\":{\"sign\":str,\"comment\":str},"
+      "\"ascendant\":{\"sign\":str,\"comment\":str}"
+    "},"
+    "\"houses\":[{\"house\":int,\"topic\":str,\"comment\":str}],"
+    "\"aspects\":[{\"pair\":str,\"type\":str,\"tightness\":str,\"meaning\":str}],"
+    "\"numerology\":{\"life_path\":{\"value\":int,\"comment\":str}},"
+    "\"practical_recs\":{\"week\":[str],\"month\":[str],\"focus_areas\":[str]},"
+    "\"data_notes\":[str]"
+    "}"
+)).text
+
+register("natal.user", 1, (
+    "Данные пользователя для астрологического разбора (Наталка PRO). "
+    "Проверьте согласованность и подготовьте JSON отчёт по схеме.\n\n"
+    "full_name: {full_name}\n"
+    "date_ddmmyyyy: {date}\n"
+    "time_hhmm: {time}\n"
+    "city_country: {city}\n"
+    "life_path: {life_path}\n"
+    "timezone_hint: если время неизвестно — добавьте в data_notes допущение про полдень/локальную зону."
+), static=False)
+
+
+# --- LLM: Prompt for Palmistry (Хиромантия) ---
+PALM_DEVELOPER_PROMPT = register("palm.developer", 1, (
+    "Верните СТРОГО один JSON-объект ТОЛЬКО в теле ответа, без markdown/комментариев. "
+    "JSON ДОЛЖЕН быть минифицирован (в одну строку). Строго избегайте построчного/помесячного перечня букв — "
+    "не раскладывайте текст по символам. Все списки возвращайте как массивы строк. "
+    "Для каждой линии (сердца, головы, жизни) добавьте 3–5 детализированных наблюдений. "
+    "Используйте художественные метафоры и образные описания: не только факты, но и интерпретацию "
+    "(например: ‘линия сердца тянется мягко, как река — это указывает на…’). "
+    "Для холмов укажите степень выраженности и значение через образы (например: ‘Холм Венеры сияет теплом…’). "
+    "В summary дайте цельный художественный портрет, как будто вы рассказываете историю судьбы человека, "
+    "с плавными переходами и тёплым, поддерживающим тоном. Избегайте медицинских/финансовых советов.\n"
+    "Структура:"
+    "{"
+    "\"title\":str,"
+    "\"summary\":str,"
+    "\"hand_overview\":{\"dominant\":(str|null),\"general\":[str]},"
+    "\"lines\":{"
+      "\"heart\":{\"tone\":str,\"details\":[str]},"
+      "\"head\":{\"tone\":str,\"details\":[str]},"
+      "\"life\":{\"tone\":str,\"details\":[str]},"
+      "\"fate\":{\"present\":bool,\"details\":[str]}"
+    "},"
+    "\"mounts\":[{\"name\":str,\"expression\":str,\"comment\":str}],"
+    "\"patterns\":[str],"
+    "\"practical_recs\":{\"week\":[str],\"month\":[str],\"focus_areas\":[str]},"
+    "\"data_notes\":[str]"
+    "}"
+)).text
+
+register("palm.user", 1, (
+    "Хиромантия (разбор по фото ладони). "
+    "Напишите образный, но структурированный отчёт на русском по схеме JSON. "
+    "Не давайте медицинских/финансовых советов. Учитывайте, что модель НЕ видит само фото; "
+    "используйте мягкие формулировки и допускайте неопределённость.\n\n"
+    "full_name: {full_name}\n"
+    "dominant_hand: {dominant_hand}\n"
+    "user_context: {user_context}\n"
+    "photo_provided: {photo_provided}\n"
+    "telegram_file_id: {tg_file_id}\n"
+    "Пояснение: если чего-то нельзя утверждать без визуального подтверждения, добавляйте сноску в data_notes."
+), static=False)
+
+# Vision: статическая инструкция + схема идут первыми, персональные данные — отдельной частью после них
+PALM_VISION_PROMPT = register("palm.vision", 2, (
+    "Ты практикующий хиромант и эзотерический рассказчик. На основе ПРИЛОЖЕННОГО ФОТО правой ладони выполни визуальный анализ. "
+    "Опиши не только факты, но и их смысл через мягкие метафоры и образные формулировки (без эзотерического пафоса). "
+    "Верни СТРОГО один минифицированный JSON (в одну строку) по следующей схеме. "
+) + PALM_DEVELOPER_PROMPT).text
+
+register("palm.vision.user", 2, (
+    "Имя: {full_name}. Доминирующая рука: {dominant_hand}. Контекст: {user_context}."
+), static=False)
@@ -0,0 +1,77 @@
+# src/ratelimit.py
+"""
+Token bucket shared by everything that sends Telegram messages in bulk.
+
+Telegram allows a bot roughly 30 messages per second across all chats; going above
+that earns 429 RetryAfter for the whole bot. `TELEGRAM_BUCKET` refills at TG_GLOBAL_RATE
+tokens per second with a burst of TG_GLOBAL_BURST, and `pause()` stops every waiter
+until a RetryAfter window is over, so concurrent senders back off together.
+"""
+import asyncio
+import time
+
+from .config import TG_GLOBAL_RATE, TG_GLOBAL_BURST
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, n: float = 1.0):
+        """Wait until n tokens are available (and no pause is active), then take them."""
+        # Под замком ждущие обслуживаются по очереди, без голодания
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                await asyncio.sleep((n - self._tokens) / self.rate)
+
+    def try_acquire(self, n: float = 1.0, reserve: float = 0.0) -> bool:
+        """Take n tokens only if nobody is waiting and `reserve` tokens remain; never waits.
+
+        For optional calls (typing, status edits) that must not delay real messages.
+        """
+        now = time.monotonic()
+        if now < self._paused_until or self._lock.locked():
+            return False
+        self._refill(now)
+        if self._tokens - n < reserve:
+            return False
+        self._tokens -= n
+        return True
+
+    def pause(self, seconds: float):
+        """Block all acquirers for `seconds` (e.g. Telegram RetryAfter) and drop the burst."""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0.0
+            self._updated = until
+
+    @property
+    def paused_for(self) -> float:
+        return max(0.0, self._paused_until - time.monotonic())
+
+
+TELEGRAM_BUCKET = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_BURST)
+
+
+def retry_after_seconds(e) -> float:
+    """RetryAfter.retry_after is int seconds in PTB 21 and a timedelta in newer versions."""
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
@@ -0,0 +1,122 @@
+# src/retry.py
+"""
+Retry policy for LLM provider calls.
+
+On 429/503 a provider is retried (instead of immediately falling over to the next
+model/provider) after the delay it asks for in Retry-After, or after an exponential
+backoff with full jitter. Retries are bounded both by the per-provider policy and by
+the request deadline set with `deadline()` around the whole LLM request, so a slow
+retry never pushes a report past its time budget.
+
+Per-provider overrides come from the environment, e.g. OPENAI_RETRY_MAX=3,
+MISTRAL_RETRY_BASE_S=1.0, GEMINI_RETRY_CAP_S=4; defaults are LLM_RETRY_* in config.
+"""
+import contextlib
+import contextvars
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+
+from .config import LLM_RETRY_MAX, LLM_RETRY_BASE_S, LLM_RETRY_CAP_S, LLM_RETRY_AFTER_MAX_S
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_retries: int = LLM_RETRY_MAX
+    base_delay_s: float = LLM_RETRY_BASE_S
+    max_delay_s: float = LLM_RETRY_CAP_S
+    max_retry_after_s: float = LLM_RETRY_AFTER_MAX_S
+    retry_statuses: tuple[int, ...] = (429, 503)
+
+
+def _policy_from_env(provider: str) -> RetryPolicy:
+    prefix = provider.upper()
+    return RetryPolicy(
+        max_retries=int(os.getenv(f"{prefix}_RETRY_MAX", LLM_RETRY_MAX)),
+        base_delay_s=float(os.getenv(f"{prefix}_RETRY_BASE_S", LLM_RETRY_BASE_S)),
+        max_delay_s=float(os.getenv(f"{prefix}_RETRY_CAP_S", LLM_RETRY_CAP_S)),
+        max_retry_after_s=float(os.getenv(f"{prefix}_RETRY_AFTER_MAX_S", LLM_RETRY_AFTER_MAX_S)),
+    )
+
+
+POLICIES: dict[str, RetryPolicy] = {
+    name: _policy_from_env(name) for name in ("openai", "mistral", "mistral_vision", "gemini")
+}
+
+
+def policy_for(provider: str) -> RetryPolicy:
+    return POLICIES.get(provider) or POLICIES.setdefault(provider, _policy_from_env(provider))
+
+
+def parse_retry_after(value) -> float | None:
+    """Retry-After is either delta-seconds or an HTTP-date."""
+    if value is None or value == "":
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(str(value)).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def backoff_delay(policy: RetryPolicy, attempt: int, retry_after=None, rng: random.Random | None = None) -> float:
+    """Retry-After if the server sent one (capped), otherwise full jitter: U(0, min(cap, base * 2**attempt))."""
+    ra = parse_retry_after(retry_after)
+    if ra is not None:
+        return min(ra, policy.max_retry_after_s)
+    ceiling = min(policy.max_delay_s, policy.base_delay_s * (2 ** attempt))
+    return (rng or random).uniform(0.0, ceiling)
+
+
+# --- Дедлайн запроса (общий для всех попыток/провайдеров внутри одного LLM-запроса) ---
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("llm_deadline", default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds: float):
+    """Set a monotonic deadline for the enclosed LLM request; an outer, earlier deadline wins."""
+    new = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(min(new, outer) if outer is not None else new)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float | None:
+    d = _deadline.get()
+    return None if d is None else d - time.monotonic()
+
+
+# --- Счётчики ---
+_stats: dict[str, dict[str, float]] = {}
+_stats_lock = threading.Lock()
+
+
+def count(provider: str, field: str, n: float = 1):
+    with _stats_lock:
+        st = _stats.setdefault(provider, {})
+        st[field] = st.get(field, 0) + n
+
+
+def report() -> str:
+    if not _stats:
+        return "Вызовов LLM пока не было."
+    lines = ["LLM-вызовы по провайдерам:"]
+    for provider, st in sorted(_stats.items()):
+        sent = int(st.get("requests", 0))
+        ok = int(st.get("ok", 0))
+        lines.append(
+            f"• {provider}: запросов {sent}, успешных {ok}, "
+            f"429/503: {int(st.get('throttled', 0))}, ретраев {int(st.get('retries', 0))} "
+            f"(ожидание {st.get('retry_sleep_s', 0):.1f}s), "
+            f"упёрлись в дедлайн {int(st.get('deadline_exhausted', 0))}"
+        )
+    return "\n".join(lines)
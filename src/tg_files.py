@@ -0,0 +1,97 @@
+# src/tg_files.py
+"""
+Async Telegram file resolution on top of the bot's own HTTP client.
+
+`getFile` results are cached by `file_unique_id` for TG_FILE_PATH_TTL_S (Telegram keeps
+download links valid for at least an hour), and the downloaded bytes are kept in a
+bounded in-memory LRU (TG_FILE_CACHE_MAX_MB), so a photo is fetched from Telegram once
+and every downstream consumer (quality check, preprocessing, vision) gets bytes
+without extra round trips. Concurrent requests for the same file share one download.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from .config import TG_FILE_PATH_TTL_S, TG_FILE_CACHE_MAX_MB
+
+log = logging.getLogger("astro-num-bot.tg_files")
+
+
+class TelegramFileCache:
+    def __init__(self, path_ttl_s: float = TG_FILE_PATH_TTL_S, max_bytes: int = int(TG_FILE_CACHE_MAX_MB * 1024 * 1024)):
+        self.path_ttl_s = path_ttl_s
+        self.max_bytes = max_bytes
+        self._files: dict[str, tuple[object, float]] = {}      # unique_id -> (telegram.File, expires_at)
+        self._unique_by_id: dict[str, str] = {}                # file_id -> unique_id
+        self._bytes: OrderedDict[str, bytes] = OrderedDict()   # unique_id -> bytes (LRU)
+        self._bytes_total = 0
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.stats = {"path_hits": 0, "path_misses": 0, "bytes_hits": 0, "bytes_misses": 0}
+
+    async def resolve(self, bot, file_id: str, file_unique_id: str | None = None):
+        """Return telegram.File (with file_path) for file_id, calling getFile at most once per TTL."""
+        uid = file_unique_id or self._unique_by_id.get(file_id)
+        if uid:
+            cached = self._files.get(uid)
+            if cached and cached[1] > time.monotonic():
+                self.stats["path_hits"] += 1
+                return cached[0]
+        self.stats["path_misses"] += 1
+        tg_file = await bot.get_file(file_id)
+        uid = tg_file.file_unique_id or uid or file_id
+        self._unique_by_id[file_id] = uid
+        self._files[uid] = (tg_file, time.monotonic() + self.path_ttl_s)
+        self._prune_paths()
+        return tg_file
+
+    async def get_bytes(self, bot, file_id: str, file_unique_id: str | None = None) -> bytes:
+        uid = file_unique_id or self._unique_by_id.get(file_id)
+        if uid and uid in self._bytes:
+            self.stats["bytes_hits"] += 1
+            self._bytes.move_to_end(uid)
+            return self._bytes[uid]
+        key = uid or file_id
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            self.stats["bytes_misses"] += 1
+            tg_file = await self.resolve(bot, file_id, uid)
+            data = bytes(await tg_file.download_as_bytearray())
+            self._store(tg_file.file_unique_id or key, data)
+            fut.set_result(data)
+            return data
+        except BaseException as e:
+            fut.set_exception(e)
+            # исключение уже отдано ждущим; чтобы не было "Future exception was never retrieved"
+            fut.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def _store(self, uid: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        old = self._bytes.pop(uid, None)
+        if old is not None:
+            self._bytes_total -= len(old)
+        self._bytes[uid] = data
+        self._bytes_total += len(data)
+        while self._bytes_total > self.max_bytes and self._bytes:
+            _, evicted = self._bytes.popitem(last=False)
+            self._bytes_total -= len(evicted)
+
+    def _prune_paths(self):
+        now = time.monotonic()
+        expired = [uid for uid, (_, exp) in self._files.items() if exp <= now]
+        for uid in expired:
+            self._files.pop(uid, None)
+        if expired:
+            alive = set(self._files)
+            self._unique_by_id = {fid: uid for fid, uid in self._unique_by_id.items() if uid in alive or uid in self._bytes}
+
+
+FILE_CACHE = TelegramFileCache()
@@ -0,0 +1,188 @@
+# src/tg_html.py
+"""
+Splitting Telegram HTML into messages.
+
+Telegram limits a message to 4096 characters of *visible* text after entity parsing,
+counted in UTF-16 code units: tags are free, `&amp;` is one unit, an emoji outside the
+BMP is two. `HtmlChunker` packs text up to that limit, prefers to break at a newline in
+the second half of a chunk, and when a chunk has to end inside <b>, <i>, <a> and the like
+it closes the open tags and reopens them at the start of the next chunk, so every chunk
+parses on its own. Input is consumed incrementally (`feed` / `close`), each token is
+moved at most once per flush, so splitting is linear in the input size.
+
+`iter_chunks` drives the chunker from a generator of HTML lines (the report renderers
+in bot.py), so a chunk can be sent as soon as it is full while later sections are still
+being rendered, and memory stays bounded by one chunk plus the current line.
+"""
+import re
+from html import unescape
+from typing import Iterable, Iterator
+
+TELEGRAM_LIMIT = 4096
+
+_TOKEN_RE = re.compile(r"<[^>]*>|&#?\w+;|[^<&\n]+|\n|[<&]")
+_TAG_NAME_RE = re.compile(r"</?\s*([a-zA-Z][\w-]*)")
+_PARTIAL_ENTITY_RE = re.compile(r"&#?\w{0,10}")
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+class HtmlChunker:
+    def __init__(self, limit: int = TELEGRAM_LIMIT):
+        self.limit = limit
+        self._buf: list[str] = []
+        self._size = 0
+        self._stack: list[tuple[str, str]] = []        # (name, raw open tag)
+        # последняя точка после "\n": (индекс в _buf, размер до неё, открытые теги в ней)
+        self._break: tuple[int, int, list] | None = None
+        self._pending = ""                             # хвост feed(), который может быть началом тега
+
+    def feed(self, html: str) -> list[str]:
+        """Add HTML; returns the chunks that are complete now."""
+        data = self._pending + html
+        # оборванный в конце тег или сущность — ждём продолжения в следующем feed()
+        cut = data.rfind("<")
+        if cut == -1 or ">" in data[cut:]:
+            cut = data.rfind("&")
+            if cut != -1 and not _PARTIAL_ENTITY_RE.fullmatch(data[cut:]):
+                cut = -1
+        if cut != -1:
+            data, self._pending = data[:cut], data[cut:]
+        else:
+            self._pending = ""
+        out: list[str] = []
+        for m in _TOKEN_RE.finditer(data):
+            self._token(m.group(0), out)
+        return out
+
+    def close(self) -> list[str]:
+        """Flush the rest; returns the final chunks."""
+        out: list[str] = []
+        if self._pending:
+            for m in _TOKEN_RE.finditer(self._pending):
+                self._token(m.group(0), out)
+            self._pending = ""
+        self._emit(len(self._buf), list(self._stack), out)
+        return out
+
+    # --- internals ---
+    def _token(self, tok: str, out: list[str]):
+        if tok.startswith("<") and len(tok) > 1 and tok.endswith(">"):
+            m = _TAG_NAME_RE.match(tok)
+            if m:
+                name = m.group(1).lower()
+                if tok.startswith("</"):
+                    for i in range(len(self._stack) - 1, -1, -1):
+                        if self._stack[i][0] == name:
+                            del self._stack[i]
+                            break
+                elif not tok.endswith("/>"):
+                    self._stack.append((name, tok))
+            self._buf.append(tok)
+            return
+        if tok == "\n":
+            self._add_text(tok, 1, out)
+            self._break = (len(self._buf), self._size, list(self._stack))
+            return
+        if tok.startswith("&") and len(tok) > 1:
+            self._add_text(tok, utf16_len(unescape(tok)), out)
+            return
+        if tok in ("<", "&"):
+            tok = "&lt;" if tok == "<" else "&amp;"
+            self._add_text(tok, 1, out)
+            return
+        # обычный текст: если не помещается даже в пустой чанк — режем по словам
+        while True:
+            units = utf16_len(tok)
+            if self._size + units <= self.limit:
+                self._add_text(tok, units, out)
+                return
+            if self._flush_at_break(out):
+                continue
+            room = self.limit - self._size
+            head, tok = _split_text(tok, room)
+            if head:
+                self._buf.append(head)
+                self._size += utf16_len(head)
+            self._emit(len(self._buf), list(self._stack), out)
+
+    def _add_text(self, tok: str, units: int, out: list[str]):
+        if self._size + units > self.limit and not self._flush_at_break(out):
+            self._emit(len(self._buf), list(self._stack), out)
+        self._buf.append(tok)
+        self._size += units
+
+    def _flush_at_break(self, out: list[str]) -> bool:
+        """End the chunk at the last newline if that keeps at least half of the limit."""
+        if not self._break or self._break[1] < self.limit // 2:
+            return False
+        idx, _, stack = self._break
+        self._emit(idx, stack, out)
+        return True
+
+    def _emit(self, idx: int, stack: list, out: list[str]):
+        head, rest = self._buf[:idx], self._buf[idx:]
+        chunk = "".join(head) + "".join(f"</{name}>" for name, _ in reversed(stack))
+        if _has_visible_text(chunk):
+            out.append(chunk.strip())
+        # переоткрываем теги, открытые в точке разреза
+        self._buf = [raw for _, raw in stack] + rest
+        self._size = sum(_visible_units(t) for t in rest)
+        self._break = None
+
+
+def _visible_units(tok: str) -> int:
+    if tok.startswith("<") and tok.endswith(">"):
+        return 0
+    if tok.startswith("&") and tok.endswith(";"):
+        return utf16_len(unescape(tok))
+    return utf16_len(tok)
+
+
+def _has_visible_text(chunk: str) -> bool:
+    return bool(unescape(re.sub(r"<[^>]*>", "", chunk)).strip())
+
+
+def _split_text(text: str, room: int) -> tuple[str, str]:
+    """Longest prefix of text within `room` UTF-16 units, preferably ending after a space."""
+    units = 0
+    end = 0
+    for i, ch in enumerate(text):
+        w = 2 if ord(ch) > 0xFFFF else 1
+        if units + w > room:
+            break
+        units += w
+        end = i + 1
+    if end == 0:
+        return "", text
+    space = text.rfind(" ", 0, end)
+    if end < len(text) and space > end // 2:
+        end = space + 1
+    return text[:end], text[end:]
+
+
+def split_html(html: str, limit: int = TELEGRAM_LIMIT) -> list[str]:
+    """Split Telegram HTML into the fewest well-formed messages of at most `limit` visible units."""
+    if not html or not html.strip():
+        return []
+    chunker = HtmlChunker(limit)
+    return chunker.feed(html.strip()) + chunker.close()
+
+
+def iter_chunks(lines: Iterable[str], limit: int = TELEGRAM_LIMIT, empty: str | None = None) -> Iterator[str]:
+    """Lazily pack HTML lines (joined with newlines) into messages; `empty` is yielded if nothing was."""
+    chunker = HtmlChunker(limit)
+    produced = False
+    first = True
+    for line in lines:
+        for chunk in chunker.feed(line if first else "\n" + line):
+            produced = True
+            yield chunk
+        first = False
+    for chunk in chunker.close():
+        produced = True
+        yield chunk
+    if not produced and empty:
+        yield empty
@@ -0,0 +1,222 @@
+# src/tracing.py
+"""
+Order lifecycle tracing: how long each stage between payment and delivery takes.
+
+A span is a timed stage of one order:
+  payment     — successful_payment_handler (begin_flow — starting the flow inside it);
+  input       — parsing/validating the user's data (text_router) or the palm photo check (photo_router);
+  generate    — a whole generate_and_send_* call;
+  llm.<name>  — one LLM provider attempt (openai, gemini, mistral, vision), failed ones included;
+  render      — rendering the report into chunks and writing them to the outbox;
+  deliver     — one outbox send (waiting for the token bucket included).
+
+Handlers call `bind(order_id)` once the order is known; spans opened later in the same
+task (and in tasks it starts) pick the order up from a context variable, so LLM helpers
+don't need an order argument. The outbox sender passes order_id explicitly. Spans without
+an order are not recorded.
+
+The `spans` table is append-only. Finished spans are buffered in memory; the background
+task `run` writes them with one executemany (in a worker thread) every TRACE_FLUSH_S
+seconds, or sooner when TRACE_FLUSH_BATCH spans are waiting, so tracing adds no SQLite
+write to the hot path. `report` gives per-product, per-stage percentiles and the
+end-to-end "payment → last chunk delivered" time for /latency.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from .config import TRACE_FLUSH_BATCH, TRACE_FLUSH_S, TRACE_RETENTION_DAYS
+from .storage import _conn
+
+log = logging.getLogger("astro-num-bot.tracing")
+
+_order: contextvars.ContextVar[int | None] = contextvars.ContextVar("trace_order", default=None)
+_buffer: list[tuple] = []
+_task: asyncio.Task | None = None
+_full: asyncio.Event | None = None
+
+
+def init_tracing_db():
+    con = _conn(); cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS spans(
+        id           INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id     INTEGER,
+        stage        TEXT,
+        started_at   REAL,
+        duration_ms  REAL,
+        ok           INTEGER,
+        attrs_json   TEXT
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_spans_started ON spans(started_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_spans_order ON spans(order_id)")
+    # старые спаны не нужны: храним TRACE_RETENTION_DAYS
+    cur.execute("DELETE FROM spans WHERE started_at < ?", (time.time() - TRACE_RETENTION_DAYS * 86400,))
+    con.commit(); con.close()
+
+
+def bind(order_id: int | None):
+    """Attach the current task (and tasks started from it) to an order."""
+    if order_id:
+        _order.set(order_id)
+
+
+def record(stage: str, started_at: float, duration_ms: float, *, order_id: int | None = None,
+           ok: bool = True, attrs: dict | None = None):
+    order_id = order_id or _order.get()
+    if not order_id:
+        return
+    _buffer.append((order_id, stage, started_at, round(duration_ms, 2), int(ok),
+                    json.dumps(attrs, ensure_ascii=False) if attrs else None))
+    if len(_buffer) >= TRACE_FLUSH_BATCH and _full is not None:
+        # пишет фоновая задача, здесь только будим её
+        _full.set()
+
+
+@contextmanager
+def span(stage: str, *, order_id: int | None = None, **attrs):
+    """Time a block; an exception marks the span failed and propagates."""
+    started_at = time.time()
+    t0 = time.perf_counter()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        # заказ берём на выходе: внутри блока его мог привязать bind()
+        record(stage, started_at, (time.perf_counter() - t0) * 1000, order_id=order_id, ok=ok, attrs=attrs or None)
+
+
+def traced(stage: str):
+    """Decorator form of `span` for coroutine functions."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def inner(*args, **kwargs):
+            with span(stage):
+                return await fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def flush():
+    global _buffer
+    if not _buffer:
+        return
+    # подмена списка, а не copy+clear: flush идёт в потоке, record() может дописать спан
+    rows, _buffer = _buffer, []
+    try:
+        con = _conn(); cur = con.cursor()
+        cur.executemany(
+            "INSERT INTO spans(order_id, stage, started_at, duration_ms, ok, attrs_json) VALUES(?,?,?,?,?,?)",
+            rows,
+        )
+        con.commit(); con.close()
+    except Exception as e:
+        log.warning("Failed to write %s spans: %s", len(rows), e)
+
+
+async def run():
+    global _full
+    _full = asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(_full.wait(), timeout=TRACE_FLUSH_S)
+        except asyncio.TimeoutError:
+            pass
+        _full.clear()
+        writing = asyncio.ensure_future(asyncio.to_thread(flush))
+        try:
+            await asyncio.shield(writing)
+        except asyncio.CancelledError:
+            # отмена не останавливает поток — дожидаемся записи, чтобы stop() не писал параллельно
+            await writing
+            raise
+
+
+def start() -> asyncio.Task:
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(run())
+    return _task
+
+
+async def stop():
+    """Cancel the background flush, wait for it to end, then write what is buffered."""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            # ждём задачу: иначе её to_thread(flush) может писать одновременно с финальным flush
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    flush()
+
+
+def _pct(values: list[float], q: float) -> float:
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _fmt_ms(ms: float) -> str:
+    return f"{ms / 1000:.1f}s" if ms >= 1000 else f"{ms:.0f}ms"
+
+
+def report(hours: float, products: dict[str, str]) -> str:
+    """Per-product stage percentiles over the last `hours`; `products` maps payload -> title."""
+    flush()
+    con = _conn(); cur = con.cursor()
+    cur.execute(
+        """SELECT o.payload, s.order_id, s.stage, s.started_at, s.duration_ms, s.ok, s.attrs_json
+           FROM spans s JOIN orders o ON o.id = s.order_id
+           WHERE s.started_at >= ? ORDER BY s.order_id, s.started_at""",
+        (time.time() - hours * 3600,),
+    )
+    rows = cur.fetchall()
+    con.close()
+    if not rows:
+        return f"Спанов за последние {hours:g} ч нет."
+
+    stages: dict[str, dict[str, list[float]]] = {}
+    failed: dict[tuple[str, str], int] = {}
+    orders: dict[int, dict] = {}
+    for payload, order_id, stage, started_at, duration_ms, ok, attrs_json in rows:
+        if ok:
+            stages.setdefault(payload, {}).setdefault(stage, []).append(duration_ms)
+        else:
+            failed[(payload, stage)] = failed.get((payload, stage), 0) + 1
+        o = orders.setdefault(order_id, {"payload": payload, "paid": None, "delivered": None, "seq": -1, "resent": False})
+        if stage in ("payment", "begin_flow"):
+            # в TEST_MODE оплаты нет, заказ начинается с begin_flow
+            o["paid"] = min(o["paid"] or started_at, started_at)
+        elif stage == "deliver" and ok and not o["resent"]:
+            seq = json.loads(attrs_json or "{}").get("seq", 0)
+            # /my_reports шлёт отчёт заново с seq 0 — это уже не первая доставка
+            if seq <= o["seq"]:
+                o["resent"] = True
+                continue
+            o["seq"] = seq
+            o["delivered"] = started_at + duration_ms / 1000
+
+    # оплата → последний доставленный чанк (включает время, пока пользователь вводит данные)
+    for o in orders.values():
+        if o["paid"] and o["delivered"] and o["delivered"] > o["paid"]:
+            stages.setdefault(o["payload"], {}).setdefault("итого", []).append((o["delivered"] - o["paid"]) * 1000)
+
+    out = [f"Задержки по этапам за {hours:g} ч (n · p50 / p95 / p99):"]
+    for payload in sorted(stages):
+        out.append(f"\n{products.get(payload, payload)}")
+        for stage in sorted(stages[payload], key=lambda s: (s == "итого", s)):
+            values = sorted(stages[payload][stage])
+            line = (f"  {stage}: {len(values)} · {_fmt_ms(_pct(values, 0.5))} / "
+                    f"{_fmt_ms(_pct(values, 0.95))} / {_fmt_ms(_pct(values, 0.99))}")
+            if failed.get((payload, stage)):
+                line += f", ошибок {failed[(payload, stage)]}"
+            out.append(line)
+    return "\n".join(out)
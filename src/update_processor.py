@@ -0,0 +1,102 @@
+# src/update_processor.py
+"""
+Concurrent update processing with per-user ordering.
+
+With `Application.concurrent_updates(PerUserUpdateProcessor(...))` every update runs as
+its own task, so one user's 30-second LLM report no longer stalls everybody else. Updates
+of the same user (or chat, for updates without a user) are still handled strictly one
+after another, in arrival order, so the `user_data` flow/state machine sees them
+sequentially.
+
+Order of gates matters: an update first waits for its user's lock and only then takes a
+slot of the global UPDATES_CONCURRENCY semaphore, so a user who floods the bot queues
+behind their own lock instead of occupying global slots. PTB's own semaphore
+(UPDATES_PENDING_MAX) only bounds the number of pending update tasks.
+
+Queue wait (per-user lock and global slot) is recorded for /updates_stats.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from .config import UPDATES_CONCURRENCY, UPDATES_PENDING_MAX
+
+
+def _pct(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent: int = UPDATES_CONCURRENCY, max_pending: int = UPDATES_PENDING_MAX, window: int = 2000):
+        super().__init__(max_pending)
+        self._global = asyncio.Semaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        # key -> [lock, число апдейтов, ждущих или выполняющихся под этим ключом]
+        self._locks: dict[int, list] = {}
+        self._user_wait_ms: deque[float] = deque(maxlen=window)
+        self._global_wait_ms: deque[float] = deque(maxlen=window)
+        self.in_flight = 0
+        self.max_backlog = 0
+        self.processed = 0
+
+    @staticmethod
+    def _key(update: object) -> int | None:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        key = self._key(update)
+        t0 = time.monotonic()
+        if key is None:
+            await self._run(coroutine, t0)
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.max_backlog = max(self.max_backlog, entry[1])
+        try:
+            async with entry[0]:
+                self._user_wait_ms.append((time.monotonic() - t0) * 1000)
+                await self._run(coroutine, time.monotonic())
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+    async def _run(self, coroutine: "Awaitable[Any]", t0: float):
+        async with self._global:
+            self._global_wait_ms.append((time.monotonic() - t0) * 1000)
+            self.in_flight += 1
+            try:
+                await coroutine
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def report(self) -> str:
+        uw = sorted(self._user_wait_ms)
+        gw = sorted(self._global_wait_ms)
+        return (
+            f"Обработка апдейтов: параллельно до {self.max_concurrent}, сейчас {self.in_flight}, "
+            f"всего {self.processed}; пользователей в работе {len(self._locks)}, "
+            f"макс. очередь одного пользователя {self.max_backlog}\n"
+            f"Ожидание своей очереди: p50 {_pct(uw, 0.5):.1f} ms, p95 {_pct(uw, 0.95):.1f} ms\n"
+            f"Ожидание общего слота: p50 {_pct(gw, 0.5):.1f} ms, p95 {_pct(gw, 0.95):.1f} ms"
+        )
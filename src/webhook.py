@@ -0,0 +1,191 @@
+# src/webhook.py
+"""
+Webhook mode (BOT_MODE=webhook): an embedded aiohttp server instead of long polling.
+
+Telegram POSTs updates to WEBHOOK_PATH. Every request must carry the
+X-Telegram-Bot-Api-Secret-Token header equal to WEBHOOK_SECRET (derived from the bot
+token when unset, so all instances behind a load balancer agree). Valid updates are
+decoded and put on the Application's update_queue, and the HTTP response is returned
+right away; handlers run as usual. GET /healthz reports liveness, queue depth and
+latency percentiles.
+
+When WEBHOOK_URL is set the webhook is registered with Telegram on startup
+(with WEBHOOK_MAX_CONNECTIONS); without it the server just listens, which is how
+recorded updates are replayed locally:
+
+    curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \\
+         -H "Content-Type: application/json" -d @update.json http://127.0.0.1:8080/telegram
+
+Update-to-handler latency is measured in both modes: an update is stamped when it enters
+the process (webhook request or the polling updater putting it on the queue) and
+observed by a group -100 TypeHandler, see `UpdateLatency`.
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+import signal
+import time
+from collections import deque
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application, ContextTypes
+
+from .config import (
+    BOT_TOKEN, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_MAX_CONNECTIONS,
+)
+
+log = logging.getLogger("astro-num-bot.webhook")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def secret_token() -> str:
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    # Telegram допускает только A-Z, a-z, 0-9, _ и -; hex подходит
+    return hashlib.sha256(("webhook:" + BOT_TOKEN).encode("utf-8")).hexdigest()[:32]
+
+
+class UpdateLatency:
+    """Ingress -> first handler latency over the last `window` updates."""
+
+    def __init__(self, window: int = 2000):
+        self._ingress: dict[int, float] = {}
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def mark(self, update_id: int | None, t: float | None = None):
+        if update_id is not None and update_id not in self._ingress:
+            self._ingress[update_id] = t if t is not None else time.monotonic()
+            if len(self._ingress) > 10_000:
+                # апдейт, который никто не обработал, не должен копиться вечно
+                for key in list(self._ingress)[:5_000]:
+                    self._ingress.pop(key, None)
+
+    def observe(self, update_id: int | None) -> float | None:
+        t0 = self._ingress.pop(update_id, None)
+        if t0 is None:
+            return None
+        ms = (time.monotonic() - t0) * 1000
+        self._samples.append(ms)
+        return ms
+
+    def summary(self) -> dict:
+        values = sorted(self._samples)
+        if not values:
+            return {"count": 0}
+
+        def pct(q: float) -> float:
+            return round(values[min(len(values) - 1, int(round(q * (len(values) - 1))))], 2)
+
+        return {"count": len(values), "p50_ms": pct(0.5), "p95_ms": pct(0.95), "p99_ms": pct(0.99), "max_ms": round(values[-1], 2)}
+
+
+LATENCY = UpdateLatency()
+
+
+def report(mode: str) -> str:
+    st = LATENCY.summary()
+    if not st["count"]:
+        return f"Режим: {mode}. Апдейтов с замером пока не было."
+    return (
+        f"Режим: {mode}. Задержка «апдейт пришёл → хендлер» по последним {st['count']}:\n"
+        f"p50 {st['p50_ms']} ms, p95 {st['p95_ms']} ms, p99 {st['p99_ms']} ms, max {st['max_ms']} ms"
+    )
+
+
+class TimedUpdateQueue(asyncio.Queue):
+    """update_queue that stamps ingress time, so polling gets the same latency metric."""
+
+    def put_nowait(self, item):
+        LATENCY.mark(getattr(item, "update_id", None))
+        super().put_nowait(item)
+
+    async def put(self, item):
+        LATENCY.mark(getattr(item, "update_id", None))
+        await super().put(item)
+
+
+async def track_update(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Group -100 TypeHandler: runs before every other handler."""
+    if isinstance(update, Update):
+        LATENCY.observe(update.update_id)
+
+
+def build_web_app(application: Application) -> web.Application:
+    secret = secret_token()
+    started = time.monotonic()
+
+    async def on_update(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=403)
+        t0 = time.monotonic()
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            log.warning("Bad webhook payload: %s", e)
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+        LATENCY.mark(update.update_id, t0)
+        await application.update_queue.put(update)
+        return web.Response(status=200)
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.json_response({
+            "ok": application.running,
+            "mode": "webhook",
+            "uptime_s": round(time.monotonic() - started, 1),
+            "update_queue": application.update_queue.qsize(),
+            "latency": LATENCY.summary(),
+        })
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, on_update)
+    app.router.add_get("/healthz", healthz)
+    return app
+
+
+async def serve(application: Application):
+    """Full webhook lifecycle: init -> post_init -> start -> HTTP server -> SIGTERM/SIGINT -> shutdown."""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret_token(),
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        log.info("Webhook registered at %s%s", WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH)
+    else:
+        log.info("WEBHOOK_URL is not set: listening locally without registering the webhook")
+    await application.start()
+
+    runner = web.AppRunner(build_web_app(application), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT)
+    await site.start()
+    log.info("Webhook server listening on %s:%s", WEBHOOK_LISTEN, WEBHOOK_PORT)
+    # SIGTERM приходит при каждом редеплое: без обработчика процесс умрёт, не выполнив finally
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: остаётся KeyboardInterrupt
+    try:
+        await stop.wait()
+        log.info("Stop signal received, shutting down")
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)